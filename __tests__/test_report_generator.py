@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+"""ทดสอบโปรแกรมสร้างใบรายงาน.py (รันด้วย: python -m pytest __tests__)"""
+import gzip
+import http.client
+import importlib.util
+import io
+import json
+import os
+import zipfile
+import threading
+from datetime import datetime
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'โปรแกรมสร้างใบรายงาน.py')
+_spec = importlib.util.spec_from_file_location('report_generator', _PATH)
+rg = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(rg)
+
+HEADER = ','.join(rg.RAW_COLUMNS_AB)
+
+
+def _export(rows):
+    """ไฟล์ CSV แบบที่ export จาก sheet กะ A: rows = [(เวลาบันทึก, ลำดับ, วันที่, เครื่อง, มิเตอร์เริ่ม, มิเตอร์เลิก)]"""
+    lines = [HEADER]
+    for saved_at, seq, day, machine, start, end in rows:
+        cells = [''] * len(rg.RAW_COLUMNS_AB)
+        cells[0], cells[1], cells[2], cells[3] = saved_at, str(seq), day, machine
+        cells[rg.RAW_COLUMNS_AB.index('มิเตอร์เริ่มงาน กะ A')] = str(start)
+        cells[rg.RAW_COLUMNS_AB.index('มิเตอร์เลิกงาน กะ A')] = str(end)
+        cells[rg.RAW_COLUMNS_AB.index('ความยาวตัดม้วน กะ A')] = str(end - start)
+        lines.append(','.join(cells))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def _read_all(name, content, **kwargs):
+    chunks = rg.iter_generic_chunks(content, name, rg.EXPECTED_COLUMN_COUNT_AB, rg.RAW_COLUMNS_AB, **kwargs)
+    return rg.pd.concat(list(chunks), ignore_index=True)
+
+
+def _latest(name, content):
+    return rg.latest_per_machine(
+        rg.iter_generic_chunks(content, name, rg.EXPECTED_COLUMN_COUNT_AB, rg.RAW_COLUMNS_AB)
+    )
+
+
+def test_latest_row_follows_save_time_not_set_number():
+    # ลำดับชุดข้อมูลที่ นับใหม่ทุกครั้งที่บันทึก: ครั้งที่แก้ไขตอนบ่ายได้ลำดับ 1 แม้บันทึกหลังรอบเช้า (ลำดับ 3)
+    morning = ('17/9/2568 08:00:00', 3, '17/9/2568', 'M3', 0, 30)
+    correction = ('17/9/2568 15:00:00', 1, '17/9/2568', 'M3', 0, 99)
+    for rows in ([morning, correction], [correction, morning]):
+        df = _read_all('a.csv', _export(rows))
+        for chunks in (df, [df.iloc[:1], df.iloc[1:]]):
+            latest = rg.latest_per_machine(chunks)
+            assert len(latest) == 1
+            assert float(latest['ความยาวตัดม้วน กะ A'].iloc[0]) == 99
+
+
+def test_injected_clock_sets_order_prefix_and_cache_key():
+    morning, evening, next_month = (lambda: datetime(2025, 9, 17, 8, 0), lambda: datetime(2025, 9, 17, 20, 0),
+                                    lambda: datetime(2025, 10, 1, 8, 0))
+    codes = rg.pd.DataFrame({'ขนาดหน้าผ้า (รหัส)': ['1625800', None]})
+    df, _unmapped = rg.assign_production_code(codes.copy(), clock=morning)
+    assert df['เลขที่ใบสั่งผลิต'].iloc[0] == '680901'
+    df, _unmapped = rg.assign_production_code(codes.copy(), clock=next_month)
+    assert df['เลขที่ใบสั่งผลิต'].iloc[0] == '681001'
+    # run_date ที่กำหนดชนะ clock
+    df, _unmapped = rg.assign_production_code(codes.copy(), run_date=datetime(2025, 9, 17), clock=next_month)
+    assert df['เลขที่ใบสั่งผลิต'].iloc[0] == '680901'
+
+    sources = [('a.csv', b'a'), ('b.csv', b'b')]
+    assert rg.report_cache_key(sources, clock=morning) == rg.report_cache_key(sources, clock=evening)
+    assert rg.report_cache_key(sources, clock=morning) != rg.report_cache_key(sources, clock=next_month)
+
+
+def _meter_end(sources):
+    latest_a, _latest_b = rg._read_latest_rows(sources, sources, run_date=rg._resolve_run_date('2025-09-17'))
+    row = latest_a[latest_a['เครื่องทอ NO'] == 'CL1']
+    return float(row['มิเตอร์เลิกงาน กะ A'].iloc[0])
+
+
+def test_merge_keeps_later_save_with_same_set_number():
+    # ลำดับชุดข้อมูลที่ นับ 1 ใหม่ทุกครั้งที่บันทึก: สองครั้งในวันเดียวกันของ CL1 ต่างกันแค่เวลาบันทึก
+    first = ('17/9/2568 08:00:00', 1, '17/9/2568', 'CL1', 1000, 1100)
+    correction = ('17/9/2568 14:00:00', 1, '17/9/2568', 'CL1', 1000, 1500)
+    live = ('live.csv', _export([first, correction]))
+    backup = ('backup.csv', _export([first]))
+    assert _meter_end([live]) == 1500
+    assert _meter_end([live, backup]) == 1500
+    assert _meter_end([backup, live]) == 1500
+
+
+def test_merge_drops_replayed_save():
+    save = ('17/9/2568 08:00:00', 1, '17/9/2568', 'CL1', 1000, 1100)
+    merged = list(rg.merge_export_chunks([
+        rg.iter_generic_chunks(_export([save]), name, rg.EXPECTED_COLUMN_COUNT_AB, rg.RAW_COLUMNS_AB)
+        for name in ('live.csv', 'backup.csv')
+    ]))
+    assert sum(len(c) for c in merged) == 1
+
+
+def test_ledger_lots_follow_the_data_not_the_file_bytes(tmp_path):
+    rows = [('17/9/2568 08:00:00', 1, '17/9/2568', 'CL1', 1000, 1100),
+            ('17/9/2568 08:00:00', 2, '17/9/2568', 'CL2', 2000, 2300)]
+    utf8 = _export(rows)
+    # export ใหม่ของข้อมูลชุดเดิม: คนละ encoding = bytes ต่างกัน
+    exports = [('a.csv', utf8), ('a_cp874.csv', utf8.decode('utf-8').encode('cp874')), ('a.csv', utf8)]
+    ledger = rg.LotLedger(str(tmp_path / 'lots.db'))
+    lots = []
+    for name, content in exports:
+        shift_b = _latest('b.csv', _export([('17/9/2568 20:00:00', 1, '17/9/2568', 'CL3', 500, 500)]))
+        primary, _extra = rg.build_report_frames(
+            _latest(name, content), shift_b, run_date=rg._resolve_run_date('2025-09-17'), ledger=ledger
+        )
+        lots.append([v for v in primary['Lot.No'].tolist() if isinstance(v, str) and v])
+    assert lots[0] == lots[1] == lots[2] == ['68091701', '68091702']
+
+
+def test_layout_cache_keys_on_header_row_only(tmp_path):
+    title = 'รายงานกะ A งวด 17/9/2568' + ',' * (len(rg.RAW_COLUMNS_AB) - 1) + '\n'
+    files = [
+        ('a1.csv', title.encode('utf-8') + _export([('17/9/2568 08:00:00', 1, '17/9/2568', 'CL1', 1000, 1100)])),
+        ('a2.csv', title.replace('17/9', '18/9').encode('utf-8')
+         + _export([('18/9/2568 08:00:00', 1, '18/9/2568', 'CL2', 2000, 2300),
+                    ('18/9/2568 09:00:00', 2, '18/9/2568', 'CL3', 10, 20)])),
+    ]
+    cache = rg.LayoutCache(str(tmp_path / 'layouts.json'))
+    layouts = []
+    for name, content in files:
+        df = _read_all(name, content, layout_cache=cache)
+        rg.pd.testing.assert_frame_equal(df, _read_all(name, content))
+        probe = next(rg._iter_raw_chunks(content, '.csv', cache.probe_rows, 'utf-8', {}))
+        layouts.append(cache.match(probe, '.csv'))
+    # คนละชื่อรายงาน คนละข้อมูล แต่แถวหัวตารางเดียวกัน = layout เดียว
+    assert len(rg.LayoutCache(str(tmp_path / 'layouts.json')).layouts) == 1
+    assert layouts[0] == layouts[1] and layouts[0][0] == 1
+
+
+def _xlsx_export(rows):
+    """ไฟล์ xlsx แบบที่ export จาก sheet: แถวชื่อรายงาน, หัวตาราง แล้วข้อมูล rows (ค่าตามชนิดเดิมของแต่ละช่อง)"""
+    wb = rg.openpyxl.Workbook()
+    ws = wb.active
+    ws.append(['รายงานการผลิต แผนกผลิต 2'])
+    ws.append(rg.RAW_COLUMNS_AB)
+    for row in rows:
+        ws.append(row)
+    buf = rg.io.BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+
+def _cells(df):
+    return [[(type(v).__name__, None if rg.pd.isna(v) else v) for v in df[c]] for c in df.columns]
+
+
+def test_parse_cache_round_trip_keeps_values_and_types(tmp_path, monkeypatch):
+    pytest.importorskip('pyarrow')
+    width = len(rg.RAW_COLUMNS_AB)
+    rows = [
+        [datetime(2025, 9, 17, 8, 5, 30), 1, datetime(2025, 9, 17), 'CL1', 'ผ้าใบ 60"', 1000, 1100.5]
+        + [None] * (width - 7),
+        ['17/9/2568 14:00:00', 2, datetime(2025, 9, 17), 'CL1 ตัดม้วนครั้งที่ 2', None, 'ยกเลิก', 0]
+        + ['หมายเหตุ ไทย'] + [None] * (width - 8),
+        [None, None, datetime(2025, 9, 18), 'CL2', 3, 2.25, -7] + [''] * (width - 7),
+    ]
+    sources = [('a.xlsx', _xlsx_export(rows)), ('a.csv', _export([
+        ('17/9/2568 08:00:00', 1, '17/9/2568', 'CL1', 1000, 1100),
+        ('', '', '18/9/2568', 'CL2 ตัดม้วนที่ครั้ง 3', 0, 0),
+    ]))]
+    cache = rg.ParseCache(str(tmp_path / 'parsed'))
+    for name, content in sources:
+        plain = _read_all(name, content)
+        assert len(plain) == (3 if name.endswith('.xlsx') else 2)
+        assert _cells(_read_all(name, content, parse_cache=cache)) == _cells(plain)
+        # ครั้งที่สองต้องโหลดจากแคช ไม่ parse ไฟล์ใหม่
+        with monkeypatch.context() as m:
+            m.setattr(rg, '_iter_raw_chunks', lambda *a, **k: pytest.fail('parsed again'))
+            cached = _read_all(name, content, parse_cache=cache)
+        rg.pd.testing.assert_frame_equal(cached, plain)
+        assert _cells(cached) == _cells(plain)
+    assert len(os.listdir(tmp_path / 'parsed')) == 2
+
+
+def test_parse_cache_evicts_least_recently_used(tmp_path):
+    pytest.importorskip('pyarrow')
+    cache = rg.ParseCache(str(tmp_path / 'parsed'))
+    frame = rg.pd.DataFrame({'วันที่': rg.pd.to_datetime(['2025-09-17'] * 50), 'เครื่องทอ NO': ['CL1'] * 50})
+    for age, key in enumerate(['old', 'middle', 'new']):
+        with cache.writer(key, {}) as write:
+            write(frame)
+        os.utime(cache._file(key), (1000 + age, 1000 + age))
+    assert cache.load('old') is not None  # อ่านแล้ว = ใช้ล่าสุด
+    sizes = {key: os.path.getsize(cache._file(key)) for key in ('old', 'middle', 'new')}
+    cache.max_bytes = sizes['old'] + sizes['new']
+    cache.evict()
+    assert sorted(os.listdir(tmp_path / 'parsed')) == ['new.parquet', 'old.parquet']
+
+
+def _three_day_rows():
+    return [(f'{day}/9/2568 {hour:02d}:00:00', seq, f'{day}/9/2568', machine, 100 * seq, 100 * seq + day)
+            for day in (16, 17, 18) for hour, seq, machine in ((8, 1, 'CL1'), (9, 2, 'CL2'), (20, 1, 'CL1'))]
+
+
+def _projected(full, columns, date_window):
+    """ผลที่ควรได้: อ่านทั้งไฟล์แล้วเลือกคอลัมน์/ช่วงวันที่เอง"""
+    start, end = date_window
+    keep = (full['วันที่'] >= start) & (full['วันที่'] < end)
+    wanted = set(columns) | {'วันที่', 'เครื่องทอ NO'}
+    out = full.loc[keep, [c for c in full.columns if c in wanted]].reset_index(drop=True)
+    return out.assign(**{'ลำดับชุดข้อมูลที่': rg.pd.to_numeric(out['ลำดับชุดข้อมูลที่'])})
+
+
+def test_column_projection_and_date_window_match_full_read(tmp_path):
+    columns = rg.REPORT_SOURCE_COLUMNS['A']
+    window = (rg.pd.Timestamp(2025, 9, 17), rg.pd.Timestamp(2025, 9, 18))
+    rows = _three_day_rows()
+    xlsx_rows = [[saved, seq, datetime(2025, 9, int(day.split('/')[0])), machine]
+                 + [None] * (rg.RAW_COLUMNS_AB.index('มิเตอร์เริ่มงาน กะ A') - 4) + [start, end]
+                 for saved, seq, day, machine, start, end in rows]
+    cache = rg.ParseCache(str(tmp_path / 'parsed')) if rg.pq is not None else None
+    for name, content in (('a.csv', _export(rows)), ('a.xlsx', _xlsx_export(xlsx_rows))):
+        expected = _projected(_read_all(name, content), columns, window)
+        assert len(expected) == 3 and set(expected['วันที่']) == {window[0]}
+        assert list(expected.columns) == [c for c in rg.RAW_COLUMNS_AB if c in set(columns)]
+        projected = _read_all(name, content, columns=columns, date_window=window, chunksize=2)
+        rg.pd.testing.assert_frame_equal(projected, expected)
+        if cache is not None:
+            _read_all(name, content, parse_cache=cache)  # แคชเก็บทั้งไฟล์
+            cached = _read_all(name, content, parse_cache=cache, columns=columns, date_window=window)
+            rg.pd.testing.assert_frame_equal(cached, expected)
+
+
+def _zip(members):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, content in members:
+            zf.writestr(name, content)
+    return buf.getvalue()
+
+
+def test_compressed_exports_are_detected_by_magic_bytes():
+    csv = _export(_three_day_rows())
+    xlsx = _xlsx_export([['17/9/2568 08:00:00', 1, datetime(2025, 9, 17), 'CL1', None, 1000, 1100]])
+    notes = 'หมายเหตุ,ผู้บันทึก\nสำรองจาก Drive,admin\n'.encode('utf-8')
+    cases = [
+        # (ชื่อไฟล์, เนื้อไฟล์, ไฟล์ต้นฉบับ, ชื่อไฟล์ที่ต้องอ่านใน archive)
+        ('a.csv.gz', gzip.compress(csv), ('a.csv', csv), 'a.csv.gz'),
+        ('a.xlsx.gz', gzip.compress(xlsx), ('a.xlsx', xlsx), 'a.xlsx.gz'),
+        ('backup.csv', gzip.compress(csv), ('a.csv', csv), 'backup.csv'),  # นามสกุลไม่ตรง: ดูจาก magic bytes
+        ('backup.zip', _zip([('notes.csv', notes), ('กะA/a.csv', csv)]), ('a.csv', csv), 'กะA/a.csv'),
+        ('backup.zip', _zip([('a.xlsx', xlsx), ('notes.csv', notes)]), ('a.xlsx', xlsx), 'a.xlsx'),
+        ('backup', _zip([('a.xlsx', xlsx)]), ('a.xlsx', xlsx), 'a.xlsx'),
+    ]
+    for name, content, (plain_name, plain), member in cases:
+        meta = {}
+        df = _read_all(name, content, meta=meta)
+        rg.pd.testing.assert_frame_equal(df, _read_all(plain_name, plain))
+        assert meta['member'] == member
+    # xlsx ที่ไม่ได้บีบอัดก็เป็น zip: ต้องไม่ถูกมองเป็น archive
+    assert rg.export_members(xlsx, 'a.xlsx') == [('a.xlsx', '.xlsx', None)]
+
+
+@pytest.fixture
+def report_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), rg.ReportRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address
+    server.shutdown()
+    server.server_close()
+
+
+def _post_report(address, headers, body=b''):
+    conn = http.client.HTTPConnection(*address, timeout=10)
+    try:
+        conn.putrequest('POST', '/report', skip_accept_encoding=True)
+        for key, value in headers.items():
+            conn.putheader(key, value)
+        conn.endheaders(body or None)
+        resp = conn.getresponse()
+        return resp.status, resp.read().decode('utf-8')
+    finally:
+        conn.close()
+
+
+def test_serve_rejects_bad_uploads_before_reading(report_server):
+    status, _ = _post_report(report_server, {})
+    assert status == 411
+    status, _ = _post_report(report_server, {'Content-Length': '0'})
+    assert status == 400
+    status, _ = _post_report(report_server, {'Content-Length': 'abc'})
+    assert status == 400
+    # ประกาศขนาดเกินแต่ไม่ส่งข้อมูล: ต้องตอบ 413 ทันทีโดยไม่รออ่าน body
+    status, body = _post_report(report_server, {'Content-Length': str(rg.MAX_UPLOAD_BYTES + 1)})
+    assert status == 413 and str(rg.MAX_UPLOAD_BYTES) in body
+    status, _ = _post_report(report_server, {'Content-Length': '5', 'Content-Type': 'text/plain'}, b'hello')
+    assert status == 400
+
+
+class _RecordingClient(rg.SheetsClient):
+    """SheetsClient ที่จำ range ที่ขอและจำนวนแถวที่ได้รับในแต่ละคำขอ"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.requests = []
+
+    def batch_get(self, spreadsheet_id, ranges):
+        blocks = super().batch_get(spreadsheet_id, ranges)
+        self.requests.append((list(ranges), sum(len(b) for b in blocks)))
+        return blocks
+
+
+@pytest.fixture
+def fake_sheets():
+    pytest.importorskip('pyarrow')
+    server = ThreadingHTTPServer(('127.0.0.1', 0), rg.FakeSheetsHandler)
+    server.sheets = {}
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _sheet_append(server, spreadsheet_id, sheet_name, rows):
+    conn = http.client.HTTPConnection(*server.server_address, timeout=10)
+    try:
+        a1 = rg.quote(rg._a1_range(sheet_name, 1, 1), safe='')
+        conn.request('POST', f'/v4/spreadsheets/{spreadsheet_id}/values/{a1}:append',
+                     body=json.dumps({'values': rows}).encode('utf-8'), headers={'Content-Type': 'application/json'})
+        resp = conn.getresponse()
+        assert resp.status == 200, resp.read()
+        return json.loads(resp.read())['updates']['updatedRows']
+    finally:
+        conn.close()
+
+
+def _mirror_frame(mirror):
+    return rg.pd.concat(list(mirror.iter_chunks()), ignore_index=True)
+
+
+def test_sheet_mirror_pulls_only_new_rows(fake_sheets, tmp_path):
+    spreadsheet_id, sheet_name = rg.SHEETS_SOURCES['A']
+    csv = _export(_three_day_rows())
+    values = rg.export_sheet_values(csv, 'a.csv')  # หัวตาราง + 9 แถว
+    fake_sheets.sheets[spreadsheet_id] = {sheet_name: values[:7]}
+    client = _RecordingClient(f'http://{fake_sheets.server_address[0]}:{fake_sheets.server_address[1]}')
+    mirror = rg.SheetMirror(str(tmp_path / 'parsed'), spreadsheet_id, sheet_name)
+    try:
+        assert mirror.pull(client, block_rows=4, blocks_per_request=2) == 6
+        assert mirror.state['next_row'] == 8
+        assert _sheet_append(fake_sheets, spreadsheet_id, sheet_name, values[7:]) == 3
+        client.requests.clear()
+        assert mirror.pull(client, block_rows=4, blocks_per_request=2) == 3
+    finally:
+        client.close()
+    # ดึงซ้ำเฉพาะแถวหัวตาราง + แถวสุดท้ายที่เคยดึง (ตรวจว่า sheet ไม่เปลี่ยน) แล้วจึงแถวใหม่ตั้งแต่แถวที่ 8
+    (ranges, fetched), = client.requests
+    assert ranges[:3] == [rg._a1_range(sheet_name, row, row) for row in (1, 7)] + [rg._a1_range(sheet_name, 8, 11)]
+    assert fetched == 2 + 3
+    assert mirror.state['rows'] == 9 and mirror.state['parts'] == 2
+    rg.pd.testing.assert_frame_equal(_mirror_frame(mirror), _read_all('a.csv', csv))
+    # state อยู่ในดิสก์: เปิดสำเนาใหม่แล้วอ่านได้ข้อมูลเดิม
+    reopened = rg.SheetMirror(str(tmp_path / 'parsed'), spreadsheet_id, sheet_name)
+    rg.pd.testing.assert_frame_equal(_mirror_frame(reopened), _read_all('a.csv', csv))
+
+
+@pytest.mark.parametrize('change', ['header', 'delete_earlier_row'])
+def test_sheet_mirror_resets_when_pulled_rows_change(fake_sheets, tmp_path, change):
+    spreadsheet_id, sheet_name = rg.SHEETS_SOURCES['A']
+    rows = _three_day_rows()
+    values = rg.export_sheet_values(_export(rows), 'a.csv')
+    fake_sheets.sheets[spreadsheet_id] = {sheet_name: [list(v) for v in values]}
+    client = rg.SheetsClient(f'http://{fake_sheets.server_address[0]}:{fake_sheets.server_address[1]}')
+    mirror = rg.SheetMirror(str(tmp_path / 'parsed'), spreadsheet_id, sheet_name)
+    try:
+        assert mirror.pull(client, block_rows=4) == 9
+        with fake_sheets.lock:
+            sheet = fake_sheets.sheets[spreadsheet_id][sheet_name]
+            if change == 'header':
+                # ย้ายคอลัมน์: หัวตารางเปลี่ยน แถวข้อมูลเดิมไม่เปลี่ยน
+                sheet[0] = sheet[0][:5] + [sheet[0][6], sheet[0][5]] + sheet[0][7:]
+                expected = rows
+            else:
+                del sheet[2]
+                expected = rows[:1] + rows[2:]
+        assert mirror.pull(client, block_rows=4) == len(expected)
+    finally:
+        client.close()
+    assert mirror.state['rows'] == len(expected) and mirror.state['parts'] == 1
+    if change == 'delete_earlier_row':
+        rg.pd.testing.assert_frame_equal(_mirror_frame(mirror), _read_all('a.csv', _export(expected)))
+
+
+def test_generate_report_from_sheet_mirrors_matches_files(fake_sheets, tmp_path):
+    exports = {
+        'A': _export(_three_day_rows()),
+        'B': _export([('17/9/2568 20:00:00', 1, '17/9/2568', 'CL3', 500, 500)]),
+    }
+    base_url = f'http://{fake_sheets.server_address[0]}:{fake_sheets.server_address[1]}'
+    mirrors = []
+    for shift, content in exports.items():
+        spreadsheet_id, sheet_name = rg.SHEETS_SOURCES[shift]
+        fake_sheets.sheets[spreadsheet_id] = {sheet_name: rg.export_sheet_values(content, f'{shift}.csv')}
+        mirrors.append(rg.pull_sheet(str(tmp_path / 'parsed'), spreadsheet_id, sheet_name, base_url=base_url))
+    from_sheets = rg.generate_report(*mirrors, run_date='2025-09-17', out=str(tmp_path / 'sheets.xlsx'))
+    from_files = rg.generate_report(('A.csv', exports['A']), ('B.csv', exports['B']), run_date='2025-09-17',
+                                    out=str(tmp_path / 'files.xlsx'))
+    sheets = [rg.openpyxl.load_workbook(path).active for path in (from_sheets, from_files)]
+    assert [list(r) for r in sheets[0].iter_rows(values_only=True)] == \
+        [list(r) for r in sheets[1].iter_rows(values_only=True)]
+    assert any('CL1' in (r or ()) for r in sheets[0].iter_rows(values_only=True))
+
+
+if __name__ == '__main__':
+    raise SystemExit(pytest.main([__file__, '-q']))
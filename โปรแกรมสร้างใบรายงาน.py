@@ -5,21 +5,68 @@ Automatically generated by Colab.
 
 Original file is located at
     https://colab.research.google.com/drive/1clqDwzxJXlwN37FHGp46odnSUNxPaCXW
+
+การใช้งานนอก Colab:
+    python โปรแกรมสร้างใบรายงาน.py report <ไฟล์กะA> <ไฟล์กะB> [--add-a ไฟล์กะA เพิ่มเติม] [--add-b ไฟล์กะB เพิ่มเติม]
+        [--date YYYY-MM-DD] [-o out.xlsx] [--lot-ledger lots.db]
+        [--appendix-days N] [--data-out prefix] [--cache-dir แคช] [--parse-cache แคชผลอ่านไฟล์]
+        [--layout-cache layouts.json] [--window-days N]
+    python โปรแกรมสร้างใบรายงาน.py batch <โฟลเดอร์ไฟล์รายวัน> [-o โฟลเดอร์ผลลัพธ์] [-j จำนวน process] [--data]
+        [--cache-dir แคช] [--parse-cache แคชผลอ่านไฟล์] [--layout-cache layouts.json] [--window-days N]
+    python โปรแกรมสร้างใบรายงาน.py serve [--host 127.0.0.1] [--port 8765] [-j จำนวน process] [--cache-dir แคช]
+        [--parse-cache แคชผลอ่านไฟล์] [--layout-cache layouts.json]
+    python โปรแกรมสร้างใบรายงาน.py pull [sheets:A] [sheets:B] --parse-cache แคชผลอ่านไฟล์
+        [--sheets-url URL] [--sheets-key API key] [--sheets-token token]
+    python โปรแกรมสร้างใบรายงาน.py fake-sheets <ไฟล์กะA> <ไฟล์กะB> [--host 127.0.0.1] [--port 8780]
+    (report รับ sheets:A / sheets:B แทนไฟล์ได้: ดึงแถวใหม่จาก sheet ลง --parse-cache ก่อนสร้างรายงาน)
+หรือ import แล้วเรียก generate_report(file_a, file_b, run_date, out)
+หรือ generate_report_buffer(file_a, file_b, run_date) เพื่อรับรายงานเป็น BytesIO
+หรือ generate_report_data(file_a, file_b, run_date) เพื่อรับข้อมูลที่คำนวณแล้วเป็น DataFrame (ไม่สร้าง xlsx)
 """
 
-!pip install pandas openpyxl xlsxwriter > /dev/null
+# บน Colab ให้ติดตั้งก่อน: !pip install pandas openpyxl xlsxwriter > /dev/null
+import argparse
+import codecs
+import contextlib
+import functools
+import gzip
+import hashlib
+import http.client
+import os
 import re
 import io
+import json
+import shutil
+import sqlite3
+import sys
+import threading
+import zipfile
 import pandas as pd
 import numpy as np
 import openpyxl
-from openpyxl.styles import Alignment, Border, Side, Font, PatternFill
-from openpyxl.utils import get_column_letter
+import xlsxwriter
+from xlsxwriter.utility import xl_cell_to_rowcol, xl_col_to_name
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
+from email import policy as email_policy
+from email.parser import BytesParser
+from http.client import HTTPConnection, HTTPSConnection
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlencode, urlsplit
 from zoneinfo import ZoneInfo
-from google.colab import files
 import warnings
 
+try:
+    from google.colab import files
+except ImportError:  # รันนอก Colab (CLI / import เป็นโมดูล)
+    files = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # ไม่มี pyarrow: ไม่ใช้แคชผลอ่านไฟล์ (ParseCache)
+    pa = pq = None
+
 # --------------------------------
 # กำหนดค่าคงที่
 # --------------------------------
@@ -37,10 +84,23 @@ CUT2_LIST = [m + " ตัดม้วนครั้งที่ 2" for m in PRI
 CUT3_LIST = [m + " ตัดม้วนครั้งที่ 3" for m in PRIMARY_MACHINE_ORDER]
 EXTRA_MACHINE_ORDER_FULL = CUT2_LIST + CUT3_LIST
 
-# กำหนดค่าตำแหน่งการแสดงผลใน Excel
-EXTRA_BLOCK_HEADER_EXCEL_ROW = 109
-EXTRA_BLOCK_DATA_START_EXCEL_ROW = 110
-MAX_ROW_FOR_BORDER_PRIMARY = 83
+# อัตราค่าแรงต่อหน่วยยอดทอ ตามเลขนำหน้ารหัสผ้า (รหัสที่ไม่อยู่ในตาราง = 0)
+LABOR_RATE_BY_CODE = {
+    **{n: 0.13 for n in range(12, 18)},
+    **{n: 0.14 for n in range(18, 23)},
+    **{n: 0.15 for n in range(23, 26)},
+    **{n: 0.18 for n in range(26, 31)},
+}
+# ตารางอัตราเขียนครั้งเดียวใน sheet ซ่อน แล้วสูตรค่าแรงอ้างผ่านชื่อนี้
+RATE_SHEET_NAME = 'อัตราค่าแรง'
+RATE_TABLE_NAME = 'RATE_TABLE'
+
+# กำหนดระยะห่างของแต่ละส่วนใน Excel (ตำแหน่งจริงคำนวณจากจำนวนแถวด้วย plan_layout)
+PRIMARY_BLANK_ROWS = 2      # แถวว่างมีเส้นขอบต่อท้าย primary block
+SUMMARY_GAP_ROWS = 4        # แถวว่างก่อนหัวข้อสรุปยอดผลิตประจำวัน
+EXTRA_GAP_ROWS = 8          # แถวว่างระหว่างสรุปยอดผลิตกับหัวตาราง extra block
+CUT_SUMMARY_GAP_ROWS = 2    # แถวว่างใต้ extra block ก่อนสรุปตัดม้วนครั้ง 2/3 และตารางรหัสผ้า
+CUT_HELPER_COL = 26         # คอลัมน์ AA (ซ่อน): ครั้งที่ตัดม้วนของแถวใน extra block
 
 # โครงสร้างคอลัมน์ที่สร้างเมื่ออัพโหลดไฟล์เข้ามา (กะ A/B)
 EXPECTED_COLUMN_COUNT_AB = 21
@@ -52,6 +112,9 @@ RAW_COLUMNS_AB = [
     'ความยาวตัดม้วน กะ A','ความยาวตัดม้วน กะ B',
 ]
 
+# คอลัมน์ตัวเลขของไฟล์กะ A/B (ไฟล์ CSV อ่านมาเป็นข้อความ)
+RAW_NUMERIC_COLUMNS_AB = ['ลำดับชุดข้อมูลที่'] + RAW_COLUMNS_AB[RAW_COLUMNS_AB.index('ยอดทอ กะ A'):]
+
 # คอลัมน์ที่เป็นตัวเลข (ใช้กำหนดความกว้าง/ฟอร์แมต)
 NUMERIC_DATA_COLUMNS = [
     "ยอดทอ กะ A","ยอดทอ กะ B","ความเร็วรอบ กะ A","ความเร็วรอบ กะ B",
@@ -59,6 +122,16 @@ NUMERIC_DATA_COLUMNS = [
     "มิเตอร์เริ่มงาน กะ B","มิเตอร์เลิกงาน กะ B","ความยาวตัดม้วน กะ A (เดิม)","ความยาวตัดม้วน กะ B (เดิม)",
 ]
 
+# คอลัมน์ของรายงาน (ลำดับตามคอลัมน์ A..Z ในไฟล์ Excel)
+REPORT_COLUMNS = [
+    "เครื่อง","พนักงานทอ กะ A","พนักงานทอ กะ B","ขนาดหน้าผ้า (รหัส)","Lot.No","เลขที่ใบสั่งผลิต",
+    "ยอดทอ กะ A","ยอดทอ กะ B","ความเร็วรอบ กะ A","ความเร็วรอบ กะ B",
+    "ประสิทธิภาพ (กะ A)%","ประสิทธิภาพ (กะ B)%","มิเตอร์เริ่มงาน กะ A","มิเตอร์เลิกงาน กะ A",
+    "มิเตอร์เริ่มงาน กะ B","มิเตอร์เลิกงาน กะ B","ความยาวตัดม้วน กะ A (เดิม)","ความยาวตัดม้วน กะ B (เดิม)",
+    "น้ำหนักม้วน กะ A","น้ำหนักม้วน กะ B","จำนวนแผล กะ A","จำนวนแผล กะ B",
+    "ค่าเฉลี่ย กะ A","ค่าเฉลี่ย กะ B","ค่าแรงพนักงานกะ A","ค่าแรงพนักงานกะ B",
+]
+
 # ---------------------------------------------------------------------------
 # Mapping codes (Case-Insensitive)
 # ---------------------------------------------------------------------------
@@ -111,8 +184,11 @@ def map_code(raw_value: str):
 # ฟังก์ชันกำหนดเลขที่ใบสั่งผลิต (ใช้ mapping  แบบไม่สนตัวพิมพ์ (ทั้งพิมพ์เล็ก/ใหญ่/มีช่องว่าง))
 # ---------------------------------------------------------------------------
 
-def assign_production_code(df: pd.DataFrame) -> pd.DataFrame:
-    """กำหนดค่าเลขที่ใบสั่งผลิต = YYMM + XX (XX จาก mapping case-insensitive)"""
+def assign_production_code(df: pd.DataFrame, run_date=None, clock=None):
+    """กำหนดค่าเลขที่ใบสั่งผลิต = YYMM + XX (XX จาก mapping case-insensitive)
+    map ครั้งเดียวต่อรหัสที่ไม่ซ้ำ แล้วกระจายกลับทุกแถว -> คืน (df, ชุดรหัสที่ไม่พบใน mapping)
+    clock: ฟังก์ชันคืน datetime ปัจจุบัน ใช้เมื่อไม่กำหนด run_date (None = เวลา Asia/Bangkok)
+    """
     target_col_name = 'เลขที่ใบสั่งผลิต'
     possible_source_cols = ['ขนาดหน้าผ้า (รหัส)', 'ขนาดหน้าผ้า_รหัส']
     source_col_name = None
@@ -124,183 +200,691 @@ def assign_production_code(df: pd.DataFrame) -> pd.DataFrame:
         df[target_col_name] = ''
     df[target_col_name] = df[target_col_name].astype(object)
     if source_col_name is None:
-        return df
-    try:
-        now = datetime.now(ZoneInfo('Asia/Bangkok'))
-    except Exception:
-        now = datetime.now()
+        return df, set()
+    now = _resolve_run_date(run_date, clock)
     buddhist_year = now.year + 543
     prefix = f"{buddhist_year % 100:02d}{now.month:02d}"
-    for idx, raw_val in df[source_col_name].items():
+    codes, uniques = pd.factorize(df[source_col_name])  # ค่าว่าง (NaN) -> -1
+    lookup = np.empty(len(uniques) + 1, dtype=object)  # ช่องสุดท้ายสำหรับ code -1
+    unmapped = set()
+    for i, raw_val in enumerate(uniques):
         code2 = map_code(raw_val)
         if code2:
-            df.at[idx, target_col_name] = str(prefix + code2)
-    return df
+            lookup[i] = prefix + code2
+        else:
+            key = normalize_code(raw_val)
+            if key:
+                unmapped.add(key)
+    mapped = pd.Series(lookup[codes], index=df.index, dtype=object)
+    df[target_col_name] = mapped.where(mapped.notna(), df[target_col_name])
+    return df, unmapped
 
 
 # -------------------------------------------------------------
 # ฟังก์ชันเครื่องมือ: อ่านไฟล์ จัดหัวตาราง
 # -------------------------------------------------------------
 
-def find_header_row(df, keyword='เครื่องทอ NO'):
-    for i, row in df.iterrows():
-        s = row.astype(str)
-        try:
-            if s.str.contains(keyword, na=False).any():
-                return i
-        except Exception:
-            pass
-        found = False
-        for val in s:
-            if not isinstance(val, str):
-                continue
-            v = val.strip()
-            if 'เครื่อง' in v and 'NO' in v.upper():
-                found = True
-                break
-        if found:
-            return i
-    return -1
+# จำนวนแถวแรกที่ใช้ค้นหาแถวหัวตาราง (ไฟล์ export มีส่วนหัวรายงานไม่เกินนี้)
+HEADER_SCAN_ROWS = 50
+
+
+def _normalize_col(s: object) -> str:
+    """ทำชื่อคอลัมน์ให้เป็นรูปแบบมาตรฐาน (ช่องว่างซ้ำ, ชื่อเครื่องทอ/ขนาดหน้าผ้าที่สะกดต่างกัน)"""
+    if s is None:
+        return ''
+    txt = str(s).strip()
+    txt = re.sub(r"\s+", " ", txt)
+    up = txt.upper()
+    if 'เครื่อง' in txt and 'NO' in up:
+        return 'เครื่องทอ NO'
+    if 'ขนาด' in txt and 'หน้าผ้า' in txt:
+        if 'รหัส' in txt or 'CODE' in up:
+            return 'ขนาดหน้าผ้า (รหัส)'
+        else:
+            return 'ขนาดหน้าผ้า_รหัส'
+    return txt
+
+
+def detect_header(df, keyword='เครื่องทอ NO', max_rows=HEADER_SCAN_ROWS):
+    """หาแถวหัวตารางจาก max_rows แถวแรกด้วย string op แบบ vectorized
+    คืน (ตำแหน่งแถว, {ตำแหน่งคอลัมน์: ชื่อคอลัมน์ที่ normalize แล้ว}); ถ้าไม่พบคืน (-1, {})
+    """
+    head = df.iloc[:max_rows]
+    if head.empty:
+        return -1, {}
+    cells = head.stack().astype(str).str.strip()
+    hit = (
+        cells.str.contains(keyword, regex=False)
+        | (cells.str.contains('เครื่อง', regex=False)
+           & cells.str.upper().str.contains('NO', regex=False))
+    )
+    if not hit.any():
+        return -1, {}
+    # stack() เรียงตามแถวอยู่แล้ว -> แถวแรกที่พบคือตำแหน่ง True ตัวแรก
+    header_label = hit.index[hit.values.argmax()][0]
+    header_pos = head.index.get_loc(header_label)
+    return header_pos, _header_col_map(df.iloc[header_pos])
+
+
+def _header_col_map(header_row):
+    """แถวหัวตาราง -> {ตำแหน่งคอลัมน์: ชื่อคอลัมน์ที่ normalize แล้ว}"""
+    return {pos: _normalize_col(val) for pos, val in enumerate(header_row.tolist())}
+
+
+def find_header_row(df, keyword='เครื่องทอ NO', max_rows=HEADER_SCAN_ROWS):
+    return detect_header(df, keyword, max_rows)[0]
+
+
+# รูปแบบวันที่ที่รองรับ: (regex, strptime format)
+DATE_FORMAT_CANDIDATES = [
+    (r'^(\d{1,2})/(\d{1,2})/(\d{4})$', '%d/%m/%Y'),
+    (r'^(\d{1,2})-(\d{1,2})-(\d{4})$', '%d-%m-%Y'),
+    (r'^(\d{4})-(\d{1,2})-(\d{1,2})$', '%Y-%m-%d'),
+    (r'^(\d{4})/(\d{1,2})/(\d{1,2})$', '%Y/%m/%d'),
+    (r'^(\d{1,2})/(\d{1,2})/(\d{2})$', '%d/%m/%y'),
+]
+
+
+def _normalize_buddhist_dates(values: pd.Series) -> pd.Series:
+    """แปลงปี พ.ศ. (ตัวเลข 4 หลัก > 2400) เป็น ค.ศ. ในค่าที่มี 3 ส่วนคั่นด้วย - หรือ / (vectorized)"""
+    parts = values.str.extract(r'^([^-/]*)[-/]([^-/]*)[-/]([^-/]*)$')
+    three = parts[0].notna()
+    if not three.any():
+        return values
+    for col in parts.columns:
+        token = parts[col]
+        year = pd.to_numeric(token.where(token.str.fullmatch(r'\d{4}', na=False)), errors='coerce')
+        buddhist = year > 2400
+        parts[col] = token.mask(buddhist, (year - 543).astype('Int64').astype(str))
+    sep = pd.Series(np.where(values.str.contains('-', regex=False), '-', '/'), index=values.index)
+    joined = parts[0] + sep + parts[1] + sep + parts[2]
+    return joined.where(three, values)
 
 
 def _parse_date_series(series: pd.Series) -> pd.Series:
     """Detect a dominant single date format and parse consistently.
     Steps:
-    1. Clean text & split off time part.
-    2. Convert Buddhist years (>2400) to Gregorian (year-543).
-    3. Try candidate patterns; pick the one with max successes (>=1).
-    4. Parse ONLY with that format (no infer_datetime_format) -> consistency, no warnings.
-    If none match, final fallback per-element parse with dayfirst, but without deprecated arg.
+    1. Reduce to unique values (a sheet holds only a few hundred distinct days).
+    2. Clean text & split off time part.
+    3. Convert Buddhist years (>2400) to Gregorian (year-543) on the unique values.
+    4. Try candidate patterns; pick the one matching the most rows (>=1).
+    5. Parse ONLY with that format -> consistency, no warnings; broadcast back to rows.
+    If none match, final fallback parse with dayfirst, but without deprecated arg.
+    Cost scales with distinct dates, not rows.
     """
     if series is None or series.empty:
         return pd.to_datetime(series, errors='coerce')
-    raw = series.astype(str).str.strip()
+    codes, uniques = pd.factorize(series.astype(str))
+    raw = pd.Series(uniques, dtype=object).str.strip()
     # Drop obvious blanks
-    raw = raw.replace({'': np.nan, 'None': np.nan, 'NaT': np.nan})
+    raw = raw.replace({'': np.nan, 'None': np.nan, 'NaT': np.nan}).astype(object)
     # Remove time part if present (split at first space if pattern has colon)
     cleaned = raw.str.split().str[0]
+    norm_u = _normalize_buddhist_dates(cleaned.fillna('').astype(str))
+    # จำนวนแถวของแต่ละค่า ใช้ให้น้ำหนักตอนเลือกรูปแบบ
+    freq = np.bincount(codes[codes >= 0], minlength=len(uniques))
 
+    best_fmt = None
+    best_mask = None
+    best_count = 0
+    for regex, fmt in DATE_FORMAT_CANDIDATES:
+        mask = norm_u.str.match(regex).to_numpy()
+        count = freq[mask].sum()
+        if count > best_count:
+            best_fmt, best_mask, best_count = fmt, mask, count
+    if best_fmt:
+        # Non-matching -> NaT (consistent)
+        parsed_u = pd.to_datetime(norm_u.where(best_mask), format=best_fmt, errors='coerce')
+    else:
+        # Fallback: dayfirst=True without deprecated infer flag
+        try:
+            parsed_u = pd.to_datetime(norm_u, dayfirst=True, errors='coerce')
+        except Exception:
+            parsed_u = pd.to_datetime(norm_u, errors='coerce')
+    values = parsed_u.to_numpy()
+    out = np.full(len(codes), np.datetime64('NaT'), dtype=values.dtype)
+    valid = codes >= 0
+    out[valid] = values[codes[valid]]
+    return pd.Series(out, index=series.index)
 
-    # Normalize separators and zero-pad day/month if needed later
-    # Convert Buddhist year if numeric token length 4 and > 2400
-    def adjust_buddhist(token):
-        if re.fullmatch(r'\d{4}', token):
-            yr = int(token)
-            if yr > 2400:
-                return str(yr - 543)
-        return token
 
+# จำนวน byte ต้นไฟล์ที่ใช้เดา encoding ของไฟล์ CSV
+CSV_SNIFF_BYTES = 64 * 1024
+CSV_FALLBACK_ENCODINGS = ['utf-8', 'cp874', 'latin1']
 
-    # Candidate patterns with a regex builder and corresponding strptime format
-    candidates = [
-        (re.compile(r'^(\d{1,2})/(\d{1,2})/(\d{4})$'), '%d/%m/%Y'),
-        (re.compile(r'^(\d{1,2})-(\d{1,2})-(\d{4})$'), '%d-%m-%Y'),
-        (re.compile(r'^(\d{4})-(\d{1,2})-(\d{1,2})$'), '%Y-%m-%d'),
-        (re.compile(r'^(\d{4})/(\d{1,2})/(\d{1,2})$'), '%Y/%m/%d'),
-        (re.compile(r'^(\d{1,2})/(\d{1,2})/(\d{2})$'), '%d/%m/%y'),
-    ]
 
+def sniff_csv_encoding(file_content, max_bytes=CSV_SNIFF_BYTES):
+    """เดา encoding จาก byte ช่วงต้นไฟล์: UTF-8 (มี/ไม่มี BOM) -> cp874 ถ้าไบต์สูงเป็นช่วงอักษรไทย -> latin1"""
+    prefix = bytes(file_content[:max_bytes])
+    if prefix.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    try:
+        # final=False: ยอมให้ prefix ถูกตัดกลางตัวอักษร UTF-8 หลายไบต์
+        codecs.getincrementaldecoder('utf-8')().decode(prefix, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    raw = np.frombuffer(prefix, dtype=np.uint8)
+    high = raw[raw >= 0x80]
+    # TIS-620/cp874: พยัญชนะ-สระ 0xA1-0xDA, 0xDF-0xFB (cp874 ครอบคลุม tis-620 และเครื่องหมายเพิ่มเติม)
+    thai = ((high >= 0xA1) & (high <= 0xDA)) | ((high >= 0xDF) & (high <= 0xFB))
+    if high.size and thai.mean() >= 0.8:
+        return 'cp874'
+    return 'latin1'
+
+
+# จำนวนแถวต่อ chunk ตอนอ่านไฟล์สะสม (ต้องไม่น้อยกว่า HEADER_SCAN_ROWS)
+READ_CHUNK_ROWS = 5000
+
+
+def _xlsx_cell(v):
+    # ให้ค่าตัวเลขตรงกับ pd.read_excel: float ที่เป็นจำนวนเต็มแปลงเป็น int
+    if isinstance(v, float) and v.is_integer():
+        return int(v)
+    return v
 
-    # Pre-normalize each value for buddhist year and keep mapping
-    norm_values = []
-    for v in cleaned.fillna('').tolist():
-        if not v:
-            norm_values.append('')
-            continue
-        parts = re.split(r'[-/]', v)
-        parts = [adjust_buddhist(p) for p in parts]
-        if len(parts) == 3:
-            sep = '-' if '-' in v else ('/' if '/' in v else '/')
-            v2 = sep.join(parts)
-        else:
-            v2 = v
-        norm_values.append(v2)
-    norm_ser = pd.Series(norm_values, index=series.index)
 
+_GZIP_MAGIC = b'\x1f\x8b'
+_ZIP_MAGICS = (b'PK\x03\x04', b'PK\x05\x06')
 
-    best_fmt = None
-    best_mask = None
-    for regex, fmt in candidates:
-        mask = norm_ser.str.match(regex)
-        if mask.any():
-            # success count
-            if best_fmt is None or mask.sum() > best_mask.sum():
-                best_fmt = fmt
-                best_mask = mask
-    if best_fmt:
-        parsed = pd.to_datetime(norm_ser.where(best_mask), format=best_fmt, errors='coerce')
-        # Non-matching -> NaT (consistent)
-        return parsed
-    # Fallback: dayfirst=True without deprecated infer flag
-    try:
-        return pd.to_datetime(norm_ser, dayfirst=True, errors='coerce')
-    except Exception:
-        return pd.to_datetime(norm_ser, errors='coerce')
 
+def _open_payload(file_content, container=None):
+    """เปิดข้อมูลจริงของไฟล์ export เป็น stream (คลายการบีบอัดระหว่างอ่าน ไม่ต้องแตกไฟล์ลงดิสก์)
+    container: None = ไฟล์ดิบ, ('gz',) = ไฟล์ gzip, ('zip', ชื่อ member) = ไฟล์ใน zip
+    """
+    raw = io.BytesIO(file_content)
+    if container is None:
+        return raw
+    if container[0] == 'gz':
+        return gzip.GzipFile(fileobj=raw, mode='rb')
+    return zipfile.ZipFile(raw).open(container[1])
 
-def read_generic_file(file_content, filename, expected_cols, col_names):
-    df = None
-    ext = '.' + filename.split('.')[-1].lower()
+
+def _payload_prefix(file_content, container=None, size=CSV_SNIFF_BYTES):
+    if container is None:
+        return bytes(file_content[:size])
+    with contextlib.closing(_open_payload(file_content, container)) as stream:
+        return stream.read(size)
+
+
+def export_members(file_content, filename):
+    """ข้อมูลที่อ่านได้ในไฟล์ export -> [(ชื่อ, ext, container)] (container ใช้กับ _open_payload)
+    แยกชนิดจาก magic bytes: gzip, zip ที่เป็น xlsx (มี [Content_Types].xml) หรือ zip ที่เก็บไฟล์ .xlsx/.csv;
+    ไฟล์อื่นใช้นามสกุลตามเดิม
+    """
+    def payload_ext(container):
+        return '.xlsx' if _payload_prefix(file_content, container, 4) in _ZIP_MAGICS else '.csv'
+
+    head = bytes(file_content[:4])
+    if head[:2] == _GZIP_MAGIC:
+        return [(filename, payload_ext(('gz',)), ('gz',))]
+    if head in _ZIP_MAGICS:
+        with zipfile.ZipFile(io.BytesIO(file_content)) as zf:
+            infos = zf.infolist()
+        if any(info.filename == '[Content_Types].xml' for info in infos):
+            return [(filename, '.xlsx', None)]
+        return [
+            (info.filename, payload_ext(('zip', info.filename)), ('zip', info.filename))
+            for info in infos
+            if not info.is_dir() and not info.filename.startswith('__MACOSX/')
+            and os.path.splitext(info.filename)[1].lower() in ('.xlsx', '.csv')
+        ]
+    return [(filename, '.' + filename.split('.')[-1].lower(), None)]
+
+
+def _pick_export_member(file_content, filename, col_names, encoding=None, layout_cache=None):
+    """เลือกข้อมูลใน archive ที่หัวตารางตรงกับไฟล์กะ: layout ที่เคยพบก่อน แล้วจึงเป็นไฟล์ที่หัวตารางมีชื่อคอลัมน์
+    ตรงกับ col_names มากที่สุด (เท่ากันเลือกไฟล์แรก) -> (ชื่อ, ext, container); ไม่มีข้อมูลให้อ่านคืน None
+    """
     try:
-        if ext == '.xlsx':
-            df = pd.read_excel(io.BytesIO(file_content), header=None)
-        elif ext == '.csv':
-            for enc in ['utf-8','tis-620','cp874','latin1']:
-                try:
-                    df = pd.read_csv(io.BytesIO(file_content), header=None,
-                                     on_bad_lines='skip', encoding=enc)
-                    break
-                except Exception:
+        members = export_members(file_content, filename)
+    except zipfile.BadZipFile:
+        members = [(filename, '.' + filename.split('.')[-1].lower(), None)]
+    if len(members) <= 1:
+        return members[0] if members else None
+    wanted = {_normalize_col(c) for c in col_names}
+    probe_size = max(layout_cache.probe_rows if layout_cache is not None else 0, HEADER_SCAN_ROWS)
+    best, best_score = members[0], -1
+    for member in members:
+        _, ext, container = member
+        try:
+            with contextlib.closing(
+                _iter_raw_chunks(file_content, ext, probe_size, encoding, {}, container=container)
+            ) as probe_chunks:
+                probe = next(probe_chunks, None)
+        except Exception:
+            continue
+        if probe is None or probe.empty:
+            continue
+        if layout_cache is not None and layout_cache.match(probe, ext) is not None:
+            return member
+        header_idx, col_map = detect_header(probe)
+        score = len(wanted & set(col_map.values())) if header_idx != -1 else -1
+        if score > best_score:
+            best, best_score = member, score
+    return best
+
+
+def _iter_raw_chunks(file_content, ext, chunksize, encoding, meta, usecols=None, container=None):
+    """อ่านไฟล์ทีละ chunk แบบ header=None; ทุกคอลัมน์เป็น object เหมือนอ่านทั้งไฟล์ที่มีแถวหัวตารางปนอยู่
+    usecols: อ่านเฉพาะคอลัมน์ตำแหน่งเหล่านี้ (ชื่อคอลัมน์ของ chunk = ตำแหน่งเดิม; None = ทุกคอลัมน์)
+    container: ข้อมูลอยู่ใน gzip/zip (ดู _open_payload)
+    """
+    if ext == '.xlsx':
+        # openpyxl ต้องอ่านแบบสุ่มตำแหน่ง: xlsx ที่อยู่ใน archive คลายเฉพาะไฟล์นั้นลงหน่วยความจำ
+        if container is not None:
+            with contextlib.closing(_open_payload(file_content, container)) as stream:
+                file_content = stream.read()
+        wb = openpyxl.load_workbook(io.BytesIO(file_content), read_only=True, data_only=True)
+        try:
+            rows = []
+            for row in wb.worksheets[0].iter_rows(values_only=True):
+                if all(v is None for v in row):
                     continue
-    except Exception as e:
-        print(f"[อ่านไฟล์ไม่สำเร็จ] {filename} : {e}")
-        return pd.DataFrame()
-    if df is None or df.empty:
-        return pd.DataFrame()
-    header_idx = find_header_row(df)
-    if header_idx != -1:
-        df.columns = df.iloc[header_idx]
-        df = df.iloc[header_idx+1:].reset_index(drop=True)
-    else:
-        if df.shape[1] > len(col_names):
-            df = df.iloc[:, :len(col_names)]
-        df.columns = col_names[:df.shape[1]]
-
-
-    def _normalize_col(s: object) -> str:
-        if s is None:
-            return ''
-        txt = str(s).strip()
-        txt = re.sub(r"\s+", " ", txt)
-        up = txt.upper()
-        if 'เครื่อง' in txt and 'NO' in up:
-            return 'เครื่องทอ NO'
-        if 'ขนาด' in txt and 'หน้าผ้า' in txt:
-            if 'รหัส' in txt or 'CODE' in up:
-                return 'ขนาดหน้าผ้า (รหัส)'
+                if usecols is not None:
+                    row = [row[i] if i < len(row) else None for i in usecols]
+                rows.append([_xlsx_cell(v) for v in row])
+                if len(rows) >= chunksize:
+                    yield pd.DataFrame(rows, columns=usecols, dtype=object)
+                    rows = []
+            if rows:
+                yield pd.DataFrame(rows, columns=usecols, dtype=object)
+        finally:
+            wb.close()
+    elif ext == '.csv':
+        sniffed = encoding or sniff_csv_encoding(_payload_prefix(file_content, container))
+        # ปกติ parse ครั้งเดียว; ลอง encoding อื่นเฉพาะเมื่อถอดรหัสไม่ได้ก่อนส่ง chunk แรกออกไป
+        for enc in [sniffed] + [e for e in CSV_FALLBACK_ENCODINGS if e != sniffed]:
+            emitted = False
+            try:
+                with contextlib.closing(_open_payload(file_content, container)) as stream:
+                    reader = pd.read_csv(stream, header=None, dtype=str,
+                                         usecols=usecols,
+                                         on_bad_lines='skip', encoding=enc, chunksize=chunksize)
+                    meta['encoding'] = enc
+                    for chunk in reader:
+                        emitted = True
+                        yield chunk
+                return
+            except UnicodeDecodeError:
+                if emitted:
+                    raise
+                continue
+
+
+class LayoutCache:
+    """ทะเบียน layout ของไฟล์ export (ไฟล์ JSON): fingerprint ของแถวหัวตาราง + ตำแหน่ง -> ตำแหน่งหัวตาราง
+
+    ไฟล์ที่ layout ตรงกับที่เคยพบ ข้ามการหาหัวตาราง และอ่านเฉพาะคอลัมน์ที่ใช้ตั้งแต่ chunk แรก
+    ไม่รวมแถวเหนือหัวตาราง (เช่นแถวชื่อรายงานที่มีวันที่/งวด) ไฟล์รอบใหม่จึงยังตรงกับ layout เดิม
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, encoding='utf-8') as fh:
+                self.layouts = json.load(fh)
+        except (FileNotFoundError, ValueError):
+            self.layouts = {}
+
+    @property
+    def probe_rows(self):
+        """จำนวนแถวต้นไฟล์ที่ต้องอ่านมาเทียบ (0 = ยังไม่รู้จัก layout ใดเลย)"""
+        return max((entry['header_idx'] + 1 for entry in self.layouts.values()), default=0)
+
+    @staticmethod
+    def fingerprint(header_row, header_idx, ext):
+        """hash ของข้อความในแถวหัวตาราง (ตัดช่องว่างท้ายแถว), ตำแหน่งแถว และนามสกุลไฟล์"""
+        cells = ['' if v is None or (not isinstance(v, str) and pd.isna(v)) else str(v) for v in header_row]
+        while cells and cells[-1] == '':
+            cells.pop()
+        payload = f'{ext}\x1e{int(header_idx)}\x1e' + '\x1f'.join(cells)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def match(self, probe, ext):
+        """(header_idx, col_map) ของ layout ที่ตรงกับแถวต้นไฟล์ probe; ไม่พบคืน None"""
+        for header_idx in sorted({entry['header_idx'] for entry in self.layouts.values()}):
+            if len(probe) <= header_idx:
+                break
+            if self.fingerprint(probe.iloc[header_idx].tolist(), header_idx, ext) in self.layouts:
+                return header_idx, _header_col_map(probe.iloc[header_idx])
+        return None
+
+    def remember(self, df, ext, header_idx, col_map=None):
+        """บันทึก layout ใหม่ (เขียนไฟล์แบบ atomic; process อื่นเขียนพร้อมกันอย่างมากแค่ทับรายการกัน)
+
+        col_map ไม่ได้เก็บ: ชื่อคอลัมน์อิงตำแหน่งตาม col_names และ match สร้างจากแถวหัวตาราง
+        """
+        fp = self.fingerprint(df.iloc[header_idx].tolist(), header_idx, ext)
+        if fp in self.layouts:
+            return
+        self.layouts[fp] = {'header_idx': int(header_idx)}
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as fh:
+            json.dump(self.layouts, fh, ensure_ascii=False, indent=1)
+        os.replace(tmp, self.path)
+
+
+# -------------------------------------------------------------
+# แคชผลอ่านไฟล์ export (Parquet): ไฟล์สะสมชุดเดิมที่อัพโหลดซ้ำไม่ต้อง parse xlsx ใหม่
+# -------------------------------------------------------------
+
+PARSE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+_PARSE_CACHE_META_KEY = b'pd2_parse'
+
+
+def _encode_cell(v):
+    """ค่าในคอลัมน์ object -> ข้อความที่มีตัวอักษรบอกชนิดนำหน้า (คืนชนิดเดิมได้ครบ: int/str ปนกันได้)"""
+    if v is None or (isinstance(v, float) and np.isnan(v)):
+        return None
+    if isinstance(v, (bool, np.bool_)):
+        return 'b1' if v else 'b0'
+    if isinstance(v, (int, np.integer)):
+        return f'i{v}'
+    if isinstance(v, (float, np.floating)):
+        return f'f{float(v)!r}'
+    if isinstance(v, str):
+        return 's' + v
+    if isinstance(v, datetime):
+        return 't' + v.isoformat()
+    raise TypeError(f"ชนิดข้อมูล {type(v).__name__} เก็บในแคชไม่ได้")
+
+
+def _decode_cell(text):
+    tag, body = text[0], text[1:]
+    if tag == 's':
+        return body
+    if tag == 'i':
+        return int(body)
+    if tag == 'f':
+        return float(body)
+    if tag == 'b':
+        return body == '1'
+    return datetime.fromisoformat(body)
+
+
+class ParseCache:
+    """แคชผลอ่านไฟล์ export ที่จัดหัวตาราง/วันที่แล้ว เป็นไฟล์ Parquet ตาม hash ของเนื้อไฟล์
+
+    เกิน max_bytes รวม: ลบไฟล์ที่ใช้ล่าสุดนานที่สุดก่อน (LRU ตามเวลาแก้ไขไฟล์ ซึ่งอัพเดตทุกครั้งที่อ่าน)
+    คอลัมน์ object (จาก xlsx) เก็บเป็นข้อความที่มีชนิดนำหน้า อ่านกลับได้ค่าและชนิดเดิมทุกช่อง
+    """
+
+    def __init__(self, path, max_bytes=PARSE_CACHE_MAX_BYTES):
+        if pq is None:
+            raise ImportError("ParseCache ต้องติดตั้ง pyarrow ก่อน (pip install pyarrow)")
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, file_content, *params):
+        h = hashlib.sha256(file_content)
+        h.update(json.dumps([params, _program_digest()], ensure_ascii=False, default=str).encode('utf-8'))
+        return h.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.parquet')
+
+    def load(self, key, meta=None, columns=None, date_window=None):
+        """DataFrame จากแคช (None = ไม่พบ); เติม meta ที่บันทึกไว้ตอนอ่านไฟล์ครั้งแรก
+
+        columns/date_window: อ่านเฉพาะคอลัมน์และช่วงวันที่ที่ขอจากไฟล์ Parquet (ดู _select_rows)
+        """
+        path = self._file(key)
+        try:
+            schema = pq.read_schema(path)
+            filters = []
+            if date_window is not None and 'วันที่' in schema.names:
+                start, end = date_window
+                if start is not None:
+                    filters.append(('วันที่', '>=', pd.Timestamp(start)))
+                if end is not None:
+                    filters.append(('วันที่', '<', pd.Timestamp(end)))
+            table = pq.read_table(
+                path,
+                columns=[c for c in schema.names if c in columns] if columns is not None else None,
+                filters=filters or None,
+            )
+            os.utime(path)
+        except (FileNotFoundError, pa.ArrowInvalid):
+            return None
+        info = json.loads(schema.metadata[_PARSE_CACHE_META_KEY])
+        df = table.to_pandas()
+        for col, dtype in info['dtypes'].items():
+            if col not in df.columns:
+                continue
+            if dtype == 'tagged':
+                codes, uniques = pd.factorize(df[col])
+                lookup = np.empty(len(uniques) + 1, dtype=object)  # ช่องสุดท้ายสำหรับ code -1 (ค่าว่าง)
+                lookup[:-1] = [_decode_cell(u) for u in uniques]
+                df[col] = pd.Series(lookup[codes], index=df.index, dtype=object)
             else:
-                return 'ขนาดหน้าผ้า_รหัส'
-        return txt
-    df.rename(columns=_normalize_col, inplace=True)
+                df[col] = df[col].astype(dtype)
+        if meta is not None:
+            meta.update(info['meta'])
+            if 'col_map' in meta:
+                meta['col_map'] = {int(k): v for k, v in meta['col_map'].items()}
+        return df
 
+    @contextlib.contextmanager
+    def writer(self, key, meta):
+        """เขียนแคชทีละ chunk: write(df); ออกจาก with ปกติ = บันทึก, มี exception = ทิ้ง"""
+        path = self._file(key)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        state = {'writer': None, 'failed': False}
+
+        def write(df):
+            if state['failed']:
+                return
+            try:
+                if state['writer'] is None:
+                    state['dtypes'] = {
+                        c: 'tagged' if df[c].dtype == object else str(df[c].dtype) for c in df.columns
+                    }
+                    info = {'dtypes': state['dtypes'], 'meta': meta}
+                    schema = pa.Schema.from_pandas(self._encode(df, state['dtypes']), preserve_index=False)
+                    # คอลัมน์ที่ว่างทั้ง chunk แรกต้องเป็น string ด้วย (ไม่ใช่ null) ให้ chunk ถัดไปเขียนได้
+                    for i, field in enumerate(schema):
+                        if state['dtypes'][field.name] in ('tagged', 'str', 'string'):
+                            schema = schema.set(i, pa.field(field.name, pa.string()))
+                    state['schema'] = schema.with_metadata({
+                        _PARSE_CACHE_META_KEY: json.dumps(info, ensure_ascii=False, default=str)
+                    })
+                    state['writer'] = pq.ParquetWriter(tmp, state['schema'])
+                table = pa.Table.from_pandas(
+                    self._encode(df, state['dtypes']), schema=state['schema'], preserve_index=False
+                )
+                state['writer'].write_table(table)
+            except (TypeError, ValueError, pa.ArrowException) as e:
+                print(f"[ไม่เก็บแคชผลอ่านไฟล์] {e}")
+                state['failed'] = True
+
+        try:
+            yield write
+        except BaseException:
+            state['failed'] = True
+            raise
+        finally:
+            if state['writer'] is not None:
+                state['writer'].close()
+                if state['failed']:
+                    os.remove(tmp)
+                else:
+                    os.replace(tmp, path)
+                    self.evict()
+
+    @staticmethod
+    def _encode(df, dtypes):
+        out = {}
+        for col in df.columns:
+            if dtypes[col] == 'tagged':
+                out[col] = pd.Series(df[col].map(_encode_cell), dtype=object)
+            elif dtypes[col] in ('str', 'string'):
+                out[col] = df[col].astype(object).where(df[col].notna(), None)
+            else:
+                out[col] = df[col]
+        return pd.DataFrame(out, index=df.index)
+
+    def evict(self):
+        """ลบไฟล์ที่ใช้ล่าสุดนานที่สุดจนขนาดรวมไม่เกิน max_bytes"""
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.parquet'):
+                try:
+                    st = os.stat(os.path.join(self.path, name))
+                except FileNotFoundError:  # process อื่นลบไปแล้ว
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _mtime, size, _name in entries)
+        for _mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(self.path, name))
+            total -= size
 
-    if df.shape[1] < expected_cols:
-        df.columns = col_names[:df.shape[1]]
-    else:
-        df = df.iloc[:, :expected_cols]
-        df.columns = col_names
 
+def _select_rows(df, columns=None, date_window=None):
+    """เลือกเฉพาะคอลัมน์ใน columns (ตามลำดับใน df) และแถวที่ 'วันที่' อยู่ในช่วง date_window = (start, end)
 
+    start/end เป็น None ได้ (ไม่จำกัดด้านนั้น); end ไม่รวม; เลือกคอลัมน์แล้ว 'ลำดับชุดข้อมูลที่' เป็นตัวเลข
+    """
+    if date_window is not None and 'วันที่' in df.columns:
+        start, end = date_window
+        keep = pd.Series(True, index=df.index)
+        if start is not None:
+            keep &= df['วันที่'] >= start
+        if end is not None:
+            keep &= df['วันที่'] < end
+        if not keep.all():
+            df = df[keep]
+    if columns is not None:
+        df = df[[c for c in df.columns if c in columns]]
+        if 'ลำดับชุดข้อมูลที่' in df.columns:
+            df = df.assign(**{'ลำดับชุดข้อมูลที่': pd.to_numeric(df['ลำดับชุดข้อมูลที่'], errors='coerce')})
+    return df
+
+
+def iter_generic_chunks(file_content, filename, expected_cols, col_names, encoding=None,
+                        chunksize=READ_CHUNK_ROWS, meta=None, parse_cache=None, layout_cache=None,
+                        columns=None, date_window=None):
+    """อ่านไฟล์ .xlsx/.csv ทีละ chunk -> DataFrame ที่จัดหัวตาราง/วันที่แล้ว (ใช้หน่วยความจำตามขนาด chunk)
+    หัวตารางหาจาก chunk แรก; ตรวจสัดส่วนแถวที่ไม่มีเครื่องทอ/วันที่เมื่ออ่านครบทั้งไฟล์
+    ไฟล์ .gz และ .zip (เช่น backup จาก Drive) อ่านจาก stream ที่คลายระหว่างอ่าน; zip ที่มีหลายไฟล์
+    เลือกไฟล์ตามหัวตาราง (ดู _pick_export_member)
+    meta: dict ที่จะถูกเติม 'encoding' (CSV), 'header_idx', 'col_map', 'member' (ชื่อไฟล์ที่อ่านใน archive)
+    parse_cache: ParseCache (ถ้ามี) ไฟล์ที่เคยอ่านแล้วโหลดจากแคชแทนการ parse
+    layout_cache: LayoutCache (ถ้ามี) ไฟล์ที่ layout ตรงกับที่เคยพบ ข้ามการหาหัวตาราง
+    columns: อ่านเฉพาะคอลัมน์เหล่านี้ (ชื่อใน col_names; 'วันที่' และ 'เครื่องทอ NO' อ่านเสมอ)
+    date_window: (start, end) คืนเฉพาะแถวที่ start <= 'วันที่' < end (ตรวจสัดส่วนแถวเสียยังนับทั้งไฟล์)
+    """
+    meta = {} if meta is None else meta
+    if columns is not None:
+        columns = set(columns) | {'วันที่', 'เครื่องทอ NO'}
+    member = _pick_export_member(file_content, filename, col_names, encoding, layout_cache)
+    if member is None:
+        print(f"[อ่านไฟล์ไม่สำเร็จ] {filename} : ไม่พบไฟล์ .xlsx/.csv ใน zip")
+        return
+    member_name, ext, container = member
+    if container is not None:
+        meta['member'] = member_name
+    if parse_cache is None:
+        yield from _iter_parsed_chunks(
+            file_content, filename, expected_cols, col_names, encoding, chunksize, meta, layout_cache,
+            columns, date_window, ext, container,
+        )
+        return
+    key = parse_cache.key(file_content, ext, expected_cols, list(col_names), encoding, container)
+    cached = parse_cache.load(key, meta, columns=columns, date_window=date_window)
+    if cached is not None:
+        for start in range(0, len(cached), chunksize):
+            yield _select_rows(cached.iloc[start:start + chunksize], columns).reset_index(drop=True)
+        return
+    # แคชเก็บทั้งไฟล์ (ใช้ได้กับทุกชุดคอลัมน์/ช่วงวันที่) แล้วค่อยเลือกส่วนที่ขอ
+    with parse_cache.writer(key, meta) as write:
+        for df in _iter_parsed_chunks(
+            file_content, filename, expected_cols, col_names, encoding, chunksize, meta, layout_cache,
+            ext=ext, container=container,
+        ):
+            write(df)
+            df = _select_rows(df, columns, date_window)
+            if not df.empty:
+                yield df.reset_index(drop=True)
+
+
+def _label_chunk(df, usecols, names):
+    """chunk ดิบ (ชื่อคอลัมน์ = ตำแหน่ง) -> ชื่อคอลัมน์ตาม names, 'วันที่' เป็น datetime, 'เครื่องทอ NO' ตัดช่องว่าง"""
+    df = df.reindex(columns=usecols)
+    df.columns = names
     if 'วันที่' in df.columns:
         df['วันที่'] = _parse_date_series(df['วันที่'])
     if 'เครื่องทอ NO' in df.columns:
         df['เครื่องทอ NO'] = df['เครื่องทอ NO'].astype(str).str.strip()
+    return df
 
 
-    total = len(df)
+def _iter_parsed_chunks(file_content, filename, expected_cols, col_names, encoding, chunksize, meta,
+                        layout_cache=None, columns=None, date_window=None, ext=None, container=None):
+    if ext is None:
+        ext = '.' + filename.split('.')[-1].lower()
+    header = usecols = None
+    probe_size = layout_cache.probe_rows if layout_cache is not None else 0
+    if columns is not None or probe_size:
+        # อ่านแถวต้นไฟล์ก่อน: รู้หัวตาราง (จาก layout ที่รู้จักหรือหาใหม่) และคอลัมน์ที่ต้องอ่านก่อนอ่านทั้งไฟล์
+        with contextlib.closing(
+            _iter_raw_chunks(file_content, ext, max(probe_size, HEADER_SCAN_ROWS), encoding, {}, container=container)
+        ) as probe_chunks:
+            try:
+                probe = next(probe_chunks, None)
+            except Exception:
+                probe = None
+        if probe is not None and not probe.empty:
+            if layout_cache is not None:
+                header = layout_cache.match(probe, ext)
+            if header is None:
+                header = detect_header(probe)
+                if layout_cache is not None and header[0] != -1:
+                    layout_cache.remember(probe, ext, *header)
+            width = min(probe.shape[1], expected_cols, len(col_names))
+            usecols = [i for i in range(width) if columns is None or col_names[i] in columns]
+    raw_chunks = _iter_raw_chunks(
+        file_content, ext, max(chunksize, HEADER_SCAN_ROWS), encoding, meta, usecols=usecols,
+        container=container,
+    )
+    try:
+        df = next(raw_chunks, None)
+    except Exception as e:
+        print(f"[อ่านไฟล์ไม่สำเร็จ] {filename} : {e}")
+        return
+    if df is None or df.empty:
+        return
+    if header is None:
+        header = detect_header(df)
+        if layout_cache is not None and header[0] != -1:
+            layout_cache.remember(df, ext, *header)
+    header_idx, col_map = header
+    meta['header_idx'], meta['col_map'] = header_idx, col_map
+    if header_idx != -1:
+        df = df.iloc[header_idx+1:]
+    # ชื่อคอลัมน์สุดท้ายอิงตำแหน่งตาม col_names เสมอ (ตัดส่วนเกินจาก expected_cols)
+    if usecols is None:
+        usecols = list(range(min(df.shape[1], expected_cols, len(col_names))))
+    names = [col_names[i] for i in usecols]
+
+    total = missing_date = missing_machine = 0
+    while df is not None:
+        df = _label_chunk(df, usecols, names)
+        total += len(df)
+        missing_date += df['วันที่'].isna().sum() if 'วันที่' in df.columns else len(df)
+        missing_machine += df['เครื่องทอ NO'].isna().sum() if 'เครื่องทอ NO' in df.columns else len(df)
+        if {'วันที่', 'เครื่องทอ NO'}.issubset(df.columns):
+            df = df.dropna(subset=['วันที่', 'เครื่องทอ NO'])
+        df = _select_rows(df, columns, date_window)
+        if not df.empty:
+            yield df.reset_index(drop=True)
+        df = next(raw_chunks, None)
+
     if total > 0:
-        missing_date = df['วันที่'].isna().sum() if 'วันที่' in df.columns else total
-        missing_machine = df['เครื่องทอ NO'].isna().sum() if 'เครื่องทอ NO' in df.columns else total
         pct_missing_machine = missing_machine / total
         if pct_missing_machine > 0.5:
             raise ValueError(f"ไฟล์ {filename}: มากกว่า 50% ของแถวไม่มีค่า 'เครื่องทอ NO' ({missing_machine}/{total})")
@@ -308,11 +892,203 @@ def read_generic_file(file_content, filename, expected_cols, col_names):
             warnings.warn(f"ไฟล์ {filename}: มากกว่า 50% ของแถวไม่สามารถแปลง 'วันที่' ได้ ({missing_date}/{total}). ผลการเรียง/เลือกแถวอาจผิดพลาด", UserWarning)
 
 
-    if {'วันที่', 'เครื่องทอ NO'}.issubset(df.columns):
-        df.dropna(subset=['วันที่', 'เครื่องทอ NO'], inplace=True)
+def read_generic_file(file_content, filename, expected_cols, col_names, encoding=None, parse_cache=None,
+                      layout_cache=None, columns=None, date_window=None):
+    """อ่านไฟล์ .xlsx/.csv (หรือใน .gz/.zip) ทั้งไฟล์ -> DataFrame ที่จัดหัวตาราง/วันที่แล้ว
+    encoding: encoding ของ CSV ที่รู้อยู่แล้ว (เช่นจาก cache ของแหล่งข้อมูลเดิม) ถ้าไม่ระบุจะเดาจาก byte ต้นไฟล์;
+    encoding ที่ใช้จริงคืนกลับใน df.attrs['encoding']
+    parse_cache: ParseCache (ถ้ามี) ใช้ผลอ่านเดิมของไฟล์ที่เนื้อหาเหมือนกัน
+    layout_cache: LayoutCache (ถ้ามี) ใช้ตำแหน่งหัวตารางเดิมของไฟล์ที่ layout เหมือนกัน
+    columns/date_window: อ่านเฉพาะคอลัมน์และช่วงวันที่ที่ใช้ (ดู iter_generic_chunks)
+    """
+    meta = {}
+    chunks = list(iter_generic_chunks(
+        file_content, filename, expected_cols, col_names, encoding=encoding, meta=meta,
+        parse_cache=parse_cache, layout_cache=layout_cache, columns=columns, date_window=date_window,
+    ))
+    if not chunks:
+        return pd.DataFrame()
+    df = pd.concat(chunks, ignore_index=True)
+    if 'encoding' in meta:
+        df.attrs['encoding'] = meta['encoding']
     return df
 
 
+def latest_per_machine(chunks):
+    """ลดข้อมูลสะสมให้เหลือแถวล่าสุดของแต่ละ 'เครื่องทอ NO' ทีละ chunk (หน่วยความจำ ~ จำนวนเครื่อง + 1 chunk)
+    ล่าสุด = 'วันที่' มากสุด -> 'เวลาบันทึก' ล่าสุด -> 'ลำดับชุดข้อมูลที่' มากสุด -> แถวที่อยู่หลังสุดในไฟล์
+    ('ลำดับชุดข้อมูลที่' นับใหม่ทุกครั้งที่บันทึก จึงใช้ตัดสินได้เฉพาะแถวในการบันทึกครั้งเดียวกัน)
+    chunks: DataFrame เดียว หรือ iterable ของ DataFrame (เช่นจาก iter_generic_chunks)
+    """
+    if isinstance(chunks, pd.DataFrame):
+        chunks = [chunks]
+    latest = None
+    seen = 0
+    memo = {}
+    for chunk in chunks:
+        chunk = _ensure_cols(chunk)
+        if 'เวลาบันทึก' in chunk.columns:
+            chunk['_ts'] = _parse_timestamp_series(chunk['เวลาบันทึก'], memo)
+        else:
+            chunk['_ts'] = pd.NaT
+        if 'ลำดับชุดข้อมูลที่' in chunk.columns:
+            chunk['_seq'] = pd.to_numeric(chunk['ลำดับชุดข้อมูลที่'], errors='coerce')
+        else:
+            chunk['_seq'] = np.nan
+        chunk['_pos'] = np.arange(seen, seen + len(chunk))
+        seen += len(chunk)
+        if latest is not None:
+            chunk = pd.concat([latest, chunk], ignore_index=True)
+        latest = (chunk
+                  .sort_values(['วันที่', '_ts', '_seq', '_pos'], ascending=False,
+                               na_position='last', kind='mergesort')
+                  .drop_duplicates('เครื่องทอ NO', keep='first'))
+    if latest is None:
+        return _ensure_cols(pd.DataFrame())
+    return latest.drop(columns=['_ts', '_seq', '_pos']).reset_index(drop=True)
+
+
+def _parse_timestamp_series(series: pd.Series, memo=None) -> pd.Series:
+    """'เวลาบันทึก' (วันที่ + เวลา, ปี พ.ศ. ได้) -> datetime; ไม่มีเวลา = เที่ยงคืน, วันที่แปลงไม่ได้ = NaT
+    memo: dict ค่าที่แปลงแล้ว ใช้ร่วมกันระหว่าง chunk ของไฟล์เดียวกัน (แปลงเฉพาะค่าที่ยังไม่เคยพบ)
+    """
+    memo = {} if memo is None else memo
+    codes, uniques = pd.factorize(series.to_numpy(dtype=object))
+    new = pd.Series([u for u in uniques if u not in memo], dtype=object)
+    if len(new):
+        raw = new.astype(str)
+        hms = raw.str.extract(r'(\d{1,2}):(\d{2})(?::(\d{2}))?').astype(float).fillna(0)
+        parsed = _parse_date_series(raw) + pd.to_timedelta(hms[0] * 3600 + hms[1] * 60 + hms[2], unit='s')
+        memo.update(zip(new, parsed.to_numpy(dtype='datetime64[ns]')))
+    values = np.array([memo[u] for u in uniques], dtype='datetime64[ns]')
+    out = np.full(len(codes), np.datetime64('NaT'), dtype=values.dtype)
+    valid = codes >= 0
+    out[valid] = values[codes[valid]]
+    return pd.Series(out, index=series.index)
+
+
+def _cell_hash(s):
+    """hash ของแต่ละช่องแบบเทียบเป็นข้อความ: ค่าเดียวกันจาก xlsx (ตัวเลข) และ CSV (ข้อความ) ได้ hash เดียวกัน"""
+    if s.dtype.kind == 'M':
+        return pd.util.hash_array(s.to_numpy())
+    values = s.to_numpy(dtype=object, na_value='')
+    if not isinstance(s.dtype, pd.StringDtype):
+        values = np.array([v if isinstance(v, str) else str(v) for v in values], dtype=object)
+    return pd.util.hash_array(values)
+
+
+def _combine_hashes(arrays):
+    combined = np.zeros(len(arrays[0]), dtype=np.uint64)
+    for h in arrays:
+        combined = combined * np.uint64(0x100000001B3) ^ h
+    return combined
+
+
+def _merge_keys(chunk, src, start, memo=None):
+    """คอลัมน์ช่วยของ merge_export_chunks: ลำดับ (_d, _t, _n, _src, _pos) และ hash สำหรับตัดแถวซ้ำ"""
+    d = chunk['วันที่']
+    t = _parse_timestamp_series(chunk['เวลาบันทึก'], memo) if 'เวลาบันทึก' in chunk.columns else d
+    if 'ลำดับชุดข้อมูลที่' in chunk.columns:
+        seq = pd.to_numeric(chunk['ลำดับชุดข้อมูลที่'], errors='coerce')
+    else:
+        seq = pd.Series(np.nan, index=chunk.index)
+    t = t.fillna(d)
+    exact = _combine_hashes([_cell_hash(chunk[c]) for c in chunk.columns])
+    # 'ลำดับชุดข้อมูลที่' นับใหม่ทุกครั้งที่บันทึก: แถวซ้ำ = การบันทึกครั้งเดียวกัน (เวลาบันทึกเดียวกันด้วย)
+    seq_hash = _combine_hashes([
+        _cell_hash(chunk['เครื่องทอ NO']), _cell_hash(d), _cell_hash(t),
+        pd.util.hash_array(seq.to_numpy(dtype=float)),
+    ])
+    return chunk.assign(
+        _d=d, _t=t, _n=seq, _src=src, _pos=np.arange(start, start + len(chunk)),
+        # แถวที่ไม่มีลำดับชุดข้อมูล ใช้ hash ทั้งแถวแทน (ซ้ำได้เฉพาะแบบเหมือนกันทุกคอลัมน์)
+        _exact=exact, _seq=np.where(seq.notna().to_numpy(), seq_hash, exact),
+    )
+
+
+def merge_export_chunks(streams):
+    """รวมไฟล์ export หลายไฟล์ของกะเดียวกัน (เช่นไฟล์จาก sheet ปัจจุบัน + backup จาก Drive) แบบ k-way merge ทีละ chunk
+
+    streams: iterable ของ chunk (เช่นจาก iter_generic_chunks) แต่ละไฟล์เรียงตาม 'วันที่'/'เวลาบันทึก' อยู่แล้ว
+    คืน chunk ที่เรียงตาม 'วันที่' -> 'เวลาบันทึก' -> 'ลำดับชุดข้อมูลที่' -> ลำดับไฟล์ -> ลำดับแถว
+    และตัดแถวซ้ำระหว่างรวม: แถวที่เหมือนกันทุกคอลัมน์ และแถวของเครื่องเดียวกันที่ 'วันที่', 'เวลาบันทึก' และ
+    'ลำดับชุดข้อมูลที่' ซ้ำกัน (บันทึกครั้งเดียวกันที่ export ต่างรูปแบบ; เก็บแถวแรกตามลำดับข้างต้น)
+    หน่วยความจำ ~ 1 chunk ต่อไฟล์ (+ แถวที่เวลาบันทึกเดียวกัน) + key ของแถวในวันที่ยังรวมไม่เสร็จ
+    """
+    streams = [iter(s) for s in streams]
+    buffers = [None] * len(streams)
+    done = [False] * len(streams)
+    read = [0] * len(streams)
+    memos = [{} for _ in streams]
+    last_key = [None] * len(streams)
+    seen = {}  # วันที่ -> hash ของแถวที่ส่งออกแล้ว
+    ordered = True
+
+    def read_more(i):
+        nonlocal ordered
+        for chunk in streams[i]:
+            if chunk.empty:
+                continue
+            buf = _merge_keys(chunk, i, read[i], memos[i])
+            read[i] += len(chunk)
+            d, t = buf['_d'].to_numpy(), buf['_t'].to_numpy()
+            in_order = np.all((d[1:] > d[:-1]) | ((d[1:] == d[:-1]) & (t[1:] >= t[:-1])))
+            if not in_order or (last_key[i] is not None and (d[0], t[0]) < last_key[i]):
+                # ไฟล์ไม่เรียงตามเวลา: ยังส่งออกครบทุกแถว แต่ต้องจำ key ทุกวันที่ไว้ตัดแถวซ้ำ
+                ordered = False
+            last_key[i] = (d[-1], t[-1])
+            buffers[i] = buf if buffers[i] is None or buffers[i].empty else pd.concat([buffers[i], buf])
+            return
+        done[i] = True
+
+    while True:
+        for i in range(len(streams)):
+            if not done[i] and (buffers[i] is None or buffers[i].empty):
+                read_more(i)
+        pending = [i for i, buf in enumerate(buffers) if buf is not None and not buf.empty]
+        if not pending:
+            return
+        # แถวที่ key น้อยกว่าแถวสุดท้ายที่อ่านแล้วของทุกไฟล์ที่ยังอ่านไม่หมด ส่งออกได้ (ไม่มีแถวก่อนหน้านี้เหลืออีก)
+        bounds = [last_key[i] for i in pending if not done[i]]
+        frontier = min(bounds) if bounds else None
+        ready = {}
+        for i in pending:
+            buf = buffers[i]
+            if frontier is None:
+                ready[i] = np.ones(len(buf), dtype=bool)
+            else:
+                fd, ft = frontier
+                ready[i] = ((buf['_d'] < fd) | ((buf['_d'] == fd) & (buf['_t'] < ft))).to_numpy()
+        if not any(mask.any() for mask in ready.values()):
+            # ทุกแถวที่ค้างมี key เท่ากับ frontier: อ่านต่อจากไฟล์ที่ค้างอยู่ที่ key นี้จนพ้น
+            for i in pending:
+                if not done[i] and last_key[i] == frontier:
+                    read_more(i)
+            continue
+        parts = []
+        for i in pending:
+            parts.append(buffers[i][ready[i]])
+            buffers[i] = buffers[i][~ready[i]]
+        batch = pd.concat(parts).sort_values(['_d', '_t', '_n', '_src', '_pos'], kind='mergesort')
+        exact, seq = batch['_exact'].to_numpy(), batch['_seq'].to_numpy()
+        dup = batch['_exact'].duplicated().to_numpy() | batch['_seq'].duplicated().to_numpy()
+        for day, idx in batch.groupby('_d', sort=False).indices.items():
+            prior = seen.setdefault(day, set())
+            if prior:
+                prior = np.fromiter(prior, dtype=np.uint64, count=len(prior))
+                dup[idx] |= np.isin(exact[idx], prior) | np.isin(seq[idx], prior)
+        batch, exact, seq = batch[~dup], exact[~dup], seq[~dup]
+        for day, idx in batch.groupby('_d', sort=False).indices.items():
+            seen[day].update(exact[idx].tolist())
+            seen[day].update(seq[idx].tolist())
+        if ordered and not batch.empty:
+            current = batch['_d'].iloc[-1]
+            for day in [d for d in seen if d < current]:
+                del seen[day]
+        if not batch.empty:
+            yield batch.drop(columns=['_d', '_t', '_n', '_src', '_pos', '_exact', '_seq']).reset_index(drop=True)
+
+
 def extract_machine_number(s):
     if not isinstance(s, str):
         return 10**9
@@ -320,17 +1096,73 @@ def extract_machine_number(s):
     return int(m.group(1)) if m else 10**9
 
 
-def detect_cut_iteration(s):
-    if not isinstance(s, str):
-        return 0
-    if "ตัดม้วนที่ครั้ง 2" in s or "ตัดม้วนครั้งที่ 2" in s:
-        return 2
-    if "ตัดม้วนที่ครั้ง 3" in s or "ตัดม้วนครั้งที่ 3" in s:
-        return 3
-    return 0
+# ลำดับสูงสุดต่อวันของ Lot.No ที่จองผ่าน LotLedger (2 หลักตามรูปแบบ YYMMDDnn)
+LEDGER_MAX_SEQUENCE = 99
+
+
+class LotLedger:
+    """ทะเบียน Lot.No ถาวร (ไฟล์ SQLite) ใช้ร่วมกันได้หลาย process
+
+    จองเลขลำดับของทั้งรายงานใน transaction เดียว (BEGIN IMMEDIATE = ล็อกเขียนทั้งไฟล์)
+    เลขที่เคยจองให้ key เดิมแล้วจะได้คืนเลขเดิม (รันซ้ำด้วยข้อมูลชุดเดิมได้ Lot เดิม)
+    """
+
+    def __init__(self, path, timeout=30.0):
+        self.path = path
+        self.timeout = timeout
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS lots ("
+                " date_prefix TEXT NOT NULL,"
+                " seq INTEGER NOT NULL,"
+                " lot_key TEXT NOT NULL,"
+                " PRIMARY KEY (date_prefix, seq),"
+                " UNIQUE (date_prefix, lot_key))"
+            )
+
+    def _connect(self):
+        # isolation_level=None: ควบคุม transaction เอง
+        return sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+
+    def allocate(self, date_prefix, keys, max_sequence=999):
+        """คืน {key: seq} ของทุก key; key ใหม่ได้เลขต่อจากเลขสูงสุดของวันนั้นตามลำดับที่ส่งมา"""
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                known = dict(conn.execute(
+                    "SELECT lot_key, seq FROM lots WHERE date_prefix = ?", (date_prefix,)
+                ).fetchall())
+                seq = max(known.values(), default=0)
+                new_rows = []
+                for key in keys:
+                    if key in known:
+                        continue
+                    seq += 1
+                    if seq > max_sequence:
+                        raise ValueError(
+                            f"sequence number exceeded max_sequence={max_sequence}"
+                        )
+                    known[key] = seq
+                    new_rows.append((date_prefix, seq, key))
+                conn.executemany(
+                    "INSERT INTO lots (date_prefix, seq, lot_key) VALUES (?, ?, ?)", new_rows
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return {key: known[key] for key in keys}
 
 
-def generate_and_assign_lot_no(df, run_date=None, max_sequence=999):
+def generate_and_assign_lot_no(df, run_date=None, max_sequence=999, ledger=None, roll_keys=None,
+                               clock=None):
+    """กำหนด Lot.No = YYMMDD + ลำดับ ให้แถวที่มีความยาวตัดม้วน
+
+    ledger: LotLedger (ถ้ามี) ใช้จองเลขลำดับถาวร โดยใช้ชื่อเครื่อง + roll_keys[ชื่อเครื่อง] (ดู _roll_keys) เป็น key
+        ม้วนเดิมได้ Lot เดิมไม่ว่าจะรันกี่ครั้ง; ลำดับจำกัดที่ LEDGER_MAX_SEQUENCE (YYMMDDnn) เต็มแล้ว ValueError
+    ไม่มี ledger: เริ่มนับ 01 ใหม่ทุกครั้งแบบเดิม
+    clock: ฟังก์ชันคืน datetime ปัจจุบัน ใช้เมื่อไม่กำหนด run_date
+    """
     full_machine_order = PRIMARY_MACHINE_ORDER + CUT2_LIST + CUT3_LIST
     machine_to_order_map = {m: i for i, m in enumerate(full_machine_order)}
     a_vals = pd.to_numeric(
@@ -346,7 +1178,7 @@ def generate_and_assign_lot_no(df, run_date=None, max_sequence=999):
     if not needs.any():
         df.loc[~needs, 'Lot.No'] = ''
         return df
-    now = run_date if run_date is not None else datetime.now(ZoneInfo('Asia/Bangkok'))
+    now = _resolve_run_date(run_date, clock)
     buddhist_year = now.year + 543
     date_prefix = now.strftime(f"{str(buddhist_year)[-2:]}%m%d")
     candidates = df[needs].copy()
@@ -355,14 +1187,22 @@ def generate_and_assign_lot_no(df, run_date=None, max_sequence=999):
 )
     candidates['_num'] = candidates['เครื่อง'].map(lambda v: extract_machine_number(v))
     candidates.sort_values(['_order_idx', '_num'], inplace=True)
-    seq = 1
-    for idx in candidates.index:
-        if seq > max_sequence:
+    if ledger is None:
+        if len(candidates) > max_sequence:
             raise ValueError(
                 f"sequence number exceeded max_sequence={max_sequence}"
 )
-        df.at[idx, 'Lot.No'] = f"{date_prefix}{seq:02d}" if max_sequence < 1000 else f"{date_prefix}{seq:02d}"
-        seq += 1
+        seqs = np.arange(1, len(candidates) + 1)
+    else:
+        machines = candidates['เครื่อง'].astype(str)
+        # ชื่อเครื่องซ้ำในรายงานเดียว (ไม่ควรเกิด) ให้ key ต่างกันด้วยลำดับที่พบ
+        dup_no = machines.groupby(machines).cumcount().astype(str)
+        rolls = machines.map(roll_keys or {}).fillna('')
+        keys = (machines + "|" + rolls + "#" + dup_no).tolist()
+        # เลขที่จองแล้วสะสมทั้งวัน: หยุดก่อน Lot.No ยาวเกิน YYMMDDnn
+        allocated = ledger.allocate(date_prefix, keys, max_sequence=min(max_sequence, LEDGER_MAX_SEQUENCE))
+        seqs = [allocated[k] for k in keys]
+    df.loc[candidates.index, 'Lot.No'] = [f"{date_prefix}{seq:02d}" for seq in seqs]
     return df
 
 
@@ -384,38 +1224,25 @@ def _ensure_cols(df_in):
     return df
 
 
-def build_primary_block(df_a_raw, df_b_raw):
-    def _ensure_cols(df_in):
-        df = df_in.copy()
-        if 'วันที่' not in df.columns:
-            df['วันที่'] = pd.NaT
-        if 'เครื่องทอ NO' not in df.columns:
-            for c in list(df.columns):
-                try:
-                    if isinstance(c, str) and 'เครื่อง' in c and 'NO' in c.upper():
-                        df.rename(columns={c: 'เครื่องทอ NO'}, inplace=True)
-                        print(f"mapped column '{c}' -> 'เครื่องทอ NO'")
-                        break
-                except Exception:
-                    continue
-        if 'เครื่องทอ NO' not in df.columns:
-            df['เครื่องทอ NO'] = ''
-        return df
-    df_a = (_ensure_cols(df_a_raw)
-            .sort_values(by='วันที่', ascending=False)
-            .drop_duplicates('เครื่องทอ NO', keep='first'))
-    df_b = (_ensure_cols(df_b_raw)
-            .sort_values(by='วันที่', ascending=False)
-            .drop_duplicates('เครื่องทอ NO', keep='first'))
-    cols_a = [
+# คอลัมน์ของไฟล์กะ A/B ที่ primary block ใช้
+PRIMARY_SOURCE_COLS = {
+    'A': [
         'เครื่องทอ NO','พนักงานทอ กะ A','ขนาดหน้าผ้า_รหัส','Lot.No','เลขที่ใบสั่งผลิต',
         'ยอดทอ กะ A','ความเร็วรอบ กะ A','ประสิทธิภาพ กะ A','มิเตอร์เริ่มงาน กะ A',
         'มิเตอร์เลิกงาน กะ A','ความยาวตัดม้วน กะ A'
-    ]
-    cols_b = [
+    ],
+    'B': [
         'เครื่องทอ NO','พนักงานทอ กะ B','ขนาดหน้าผ้า_รหัส','ยอดทอ กะ B','ความเร็วรอบ กะ B',
         'ประสิทธิภาพ กะ B','มิเตอร์เริ่มงาน กะ B','มิเตอร์เลิกงาน กะ B','ความยาวตัดม้วน กะ B'
-    ]
+    ],
+}
+
+
+def build_primary_block(df_a_raw, df_b_raw):
+    # รับได้ทั้งข้อมูลดิบหรือผลจาก latest_per_machine (ลดซ้ำได้โดยผลไม่เปลี่ยน)
+    df_a = latest_per_machine(df_a_raw)
+    df_b = latest_per_machine(df_b_raw)
+    cols_a, cols_b = PRIMARY_SOURCE_COLS['A'], PRIMARY_SOURCE_COLS['B']
     merged = pd.merge(df_a[cols_a], df_b[cols_b], on='เครื่องทอ NO', how='outer')
     if 'ขนาดหน้าผ้า_รหัส_x' in merged.columns:
         merged['ขนาดหน้าผ้า_รหัส'] = merged['ขนาดหน้าผ้า_รหัส_x'].combine_first(
@@ -455,94 +1282,71 @@ def build_primary_block(df_a_raw, df_b_raw):
     return export_df
 
 
+# ชื่อเครื่องตัดม้วนเพิ่ม: "<เครื่อง> ตัดม้วนครั้งที่ 2|3" (รองรับคำสะกดเดิม "ตัดม้วนที่ครั้ง")
+_EXTRA_MACHINE_RE = r'^(?P<base>\S+) (?:ตัดม้วนครั้งที่|ตัดม้วนที่ครั้ง) (?P<cut>[23])$'
+
+# คอลัมน์ต้นทางของแต่ละกะ -> คอลัมน์ในรายงาน (ส่วนตัดม้วนเพิ่ม)
+_EXTRA_SHARED_COLS = {
+    'ขนาดหน้าผ้า_รหัส': 'ขนาดหน้าผ้า (รหัส)',
+    'Lot.No': 'Lot.No',
+    'เลขที่ใบสั่งผลิต': 'เลขที่ใบสั่งผลิต',
+}
+_EXTRA_SHIFT_COLS = {
+    shift: {
+        f'พนักงานทอ กะ {shift}': f'พนักงานทอ กะ {shift}',
+        f'ความเร็วรอบ กะ {shift}': f'ความเร็วรอบ กะ {shift}',
+        f'ประสิทธิภาพ กะ {shift}': f'ประสิทธิภาพ (กะ {shift})%',
+        f'มิเตอร์เริ่มงาน กะ {shift}': f'มิเตอร์เริ่มงาน กะ {shift}',
+        f'มิเตอร์เลิกงาน กะ {shift}': f'มิเตอร์เลิกงาน กะ {shift}',
+        f'ความยาวตัดม้วน กะ {shift}': f'ความยาวตัดม้วน กะ {shift} (เดิม)',
+    }
+    for shift in ('A', 'B')
+}
+
+
+# คอลัมน์ที่ต้องอ่านจากไฟล์แต่ละกะ: key ของแถวล่าสุด/ม้วน + primary block + extra block (ตามลำดับในไฟล์)
+REPORT_SOURCE_COLUMNS = {
+    shift: [
+        c for c in RAW_COLUMNS_AB
+        if c in {'เวลาบันทึก', 'ลำดับชุดข้อมูลที่', 'วันที่', 'เครื่องทอ NO'}
+        or c in PRIMARY_SOURCE_COLS[shift]
+        or c in _EXTRA_SHARED_COLS or c in _EXTRA_SHIFT_COLS[shift]
+    ]
+    for shift in ('A', 'B')
+}
+
+
 def build_extra_block(df_a_raw, df_b_raw):
-    extra_machine_order_old_2 = [m + " ตัดม้วนที่ครั้ง 2" for m in PRIMARY_MACHINE_ORDER]
-    extra_machine_order_old_3 = [m + " ตัดม้วนที่ครั้ง 3" for m in PRIMARY_MACHINE_ORDER]
-    full_search_list = (
-        EXTRA_MACHINE_ORDER_FULL +
-        extra_machine_order_old_2 +
-        extra_machine_order_old_3
-)
-    df_a = df_a_raw[df_a_raw['เครื่องทอ NO'].isin(full_search_list)].copy()
-    df_b = df_b_raw[df_b_raw['เครื่องทอ NO'].isin(full_search_list)].copy()
-    if df_a.empty and df_b.empty:
-        return pd.DataFrame()
-    if not df_a.empty:
-        df_a = (_ensure_cols(df_a)
-                .sort_values(by='วันที่', ascending=False)
-                .drop_duplicates('เครื่องทอ NO', keep='first'))
-    if not df_b.empty:
-        df_b = (_ensure_cols(df_b)
-                .sort_values(by='วันที่', ascending=False)
-                .drop_duplicates('เครื่องทอ NO', keep='first'))
-    rows = []
-    def add_row(r, shift):
-        name = r['เครื่องทอ NO']
-        if isinstance(name, str) and "ตัดม้วนที่ครั้ง" in name:
-            name = name.replace("ตัดม้วนที่ครั้ง", "ตัดม้วนครั้งที่")
-        row = {
-            "เครื่อง": name,
-            "พนักงานทอ กะ A": np.nan,
-            "พนักงานทอ กะ B": np.nan,
-            "ขนาดหน้าผ้า (รหัส)": r.get('ขนาดหน้าผ้า_รหัส'),
-            "Lot.No": r.get('Lot.No'),
-            "เลขที่ใบสั่งผลิต": r.get('เลขที่ใบสั่งผลิต'),
-            "ยอดทอ กะ A": np.nan,
-            "ยอดทอ กะ B": np.nan,
-            "ความเร็วรอบ กะ A": np.nan,
-            "ความเร็วรอบ กะ B": np.nan,
-            "ประสิทธิภาพ (กะ A)%": np.nan,
-            "ประสิทธิภาพ (กะ B)%": np.nan,
-            "มิเตอร์เริ่มงาน กะ A": np.nan,
-            "มิเตอร์เลิกงาน กะ A": np.nan,
-            "มิเตอร์เริ่มงาน กะ B": np.nan,
-            "มิเตอร์เลิกงาน กะ B": np.nan,
-            "ความยาวตัดม้วน กะ A (เดิม)": np.nan,
-            "ความยาวตัดม้วน กะ B (เดิม)": np.nan,
-            "น้ำหนักม้วน กะ A": np.nan,
-            "น้ำหนักม้วน กะ B": np.nan,
-            "จำนวนแผล กะ A": np.nan,
-            "จำนวนแผล กะ B": np.nan,
-            "ค่าเฉลี่ย กะ A": np.nan,
-            "ค่าเฉลี่ย กะ B": np.nan,
-            "ค่าแรงพนักงานกะ A": np.nan,
-            "ค่าแรงพนักงานกะ B": np.nan,
-        }
-        if shift == 'A':
-            row.update({
-                "พนักงานทอ กะ A": r.get('พนักงานทอ กะ A'),
-                "ความเร็วรอบ กะ A": r.get('ความเร็วรอบ กะ A'),
-                "ประสิทธิภาพ (กะ A)%": r.get('ประสิทธิภาพ กะ A'),
-                "มิเตอร์เริ่มงาน กะ A": r.get('มิเตอร์เริ่มงาน กะ A'),
-                "มิเตอร์เลิกงาน กะ A": r.get('มิเตอร์เลิกงาน กะ A'),
-                "ความยาวตัดม้วน กะ A (เดิม)": r.get('ความยาวตัดม้วน กะ A'),
-            })
-        else:
-            row.update({
-                "พนักงานทอ กะ B": r.get('พนักงานทอ กะ B'),
-                "ความเร็วรอบ กะ B": r.get('ความเร็วรอบ กะ B'),
-                "ประสิทธิภาพ (กะ B)%": r.get('ประสิทธิภาพ กะ B'),
-                "มิเตอร์เริ่มงาน กะ B": r.get('มิเตอร์เริ่มงาน กะ B'),
-                "มิเตอร์เลิกงาน กะ B": r.get('มิเตอร์เลิกงาน กะ B'),
-                "ความยาวตัดม้วน กะ B (เดิม)": r.get('ความยาวตัดม้วน กะ B'),
-            })
-        row['_sort'] = (
-            extract_machine_number(name),
-            detect_cut_iteration(name),
-            0 if shift == 'A' else 1,
-        )
-        rows.append(row)
-    if not df_a.empty:
-        for _, r in df_a.iterrows():
-            add_row(r, 'A')
-    if not df_b.empty:
-        for _, r in df_b.iterrows():
-            add_row(r, 'B')
-    if not rows:
+    """แถวตัดม้วนครั้งที่ 2/3: กรองด้วย regex ครั้งเดียว, ซ้อนกะ A/B แล้วเรียงครั้งเดียว
+    (เลขเครื่อง, ครั้งที่ตัด, กะ) -> DataFrame คอลัมน์เดียวกับ primary block
+    """
+    base_set = set(PRIMARY_MACHINE_ORDER)
+    parts = []
+    for shift, df_raw in (('A', df_a_raw), ('B', df_b_raw)):
+        if df_raw.empty:
+            continue
+        # regex เฉพาะชื่อเครื่องที่ไม่ซ้ำ แล้วกรองแถวด้วย isin
+        names = pd.Series(df_raw['เครื่องทอ NO'].dropna().unique(), dtype=object)
+        found = names.astype(str).str.extract(_EXTRA_MACHINE_RE)
+        df = df_raw[df_raw['เครื่องทอ NO'].isin(names[found['base'].isin(base_set)])]
+        if df.empty:
+            continue
+        df = latest_per_machine(df)
+        found = df['เครื่องทอ NO'].astype(str).str.extract(_EXTRA_MACHINE_RE)
+        col_map = {**_EXTRA_SHARED_COLS, **_EXTRA_SHIFT_COLS[shift]}
+        part = df.reindex(columns=list(col_map)).rename(columns=col_map)
+        part.insert(0, 'เครื่อง', found['base'] + ' ตัดม้วนครั้งที่ ' + found['cut'])
+        part['_num'] = pd.to_numeric(
+            found['base'].str.upper().str.extract(r'CL(\d+)')[0], errors='coerce'
+        ).fillna(10**9)
+        part['_cut'] = found['cut'].astype(int)
+        part['_shift'] = 0 if shift == 'A' else 1
+        parts.append(part)
+    if not parts:
         return pd.DataFrame()
-    df = pd.DataFrame(rows)
-    df.sort_values('_sort', inplace=True)
-    df.drop(columns=['_sort'], inplace=True)
+    df = pd.concat(parts, ignore_index=True)
+    df.sort_values(['_num', '_cut', '_shift'], kind='mergesort', inplace=True)
+    df = df.reindex(columns=REPORT_COLUMNS)
     df.reset_index(drop=True, inplace=True)
     return df
 
@@ -568,21 +1372,11 @@ def inject_formulas(df, excel_start_row):
             f'IF(LEFT(UPPER(D{r}),3)="FCL", VALUE(MID(D{r},6,2)), '
             f'IF(LEFT(UPPER(D{r}),4)="TEST", VALUE(MID(D{r},5,2)), VALUE(LEFT(D{r},2))))'
         )
-        rate_expr = (
-            f'IFS('
-            f'OR({num_expr}=12,{num_expr}=13,{num_expr}=14,'
-            f'{num_expr}=15,{num_expr}=16,{num_expr}=17),0.13,'
-            f'OR({num_expr}=18,{num_expr}=19,{num_expr}=20,'
-            f'{num_expr}=21,{num_expr}=22),0.14,'
-            f'OR({num_expr}=23,{num_expr}=24,{num_expr}=25),0.15,'
-            f'OR({num_expr}=26,{num_expr}=27,{num_expr}=28,'
-            f'{num_expr}=29,{num_expr}=30),0.18)'
-        )
         f_aa = (
-            f'=IFERROR(({rate_expr})*G{r},0)'
+            f'=IFERROR(VLOOKUP({num_expr},{RATE_TABLE_NAME},2,FALSE)*G{r},0)'
         )
         f_ab = (
-            f'=IFERROR(({rate_expr})*H{r},0)'
+            f'=IFERROR(VLOOKUP({num_expr},{RATE_TABLE_NAME},2,FALSE)*H{r},0)'
         )
         formulas_g.append(f_g)
         formulas_h.append(f_h)
@@ -595,625 +1389,1719 @@ def inject_formulas(df, excel_start_row):
     return df
 
 
-def add_summary_and_extra_format(file_path, sheet_name,
-                                 extra_row_start=None, extra_row_end=None):
+def plan_layout(primary_len, extra_len=0):
+    """คำนวณแถว Excel (นับจาก 1) ของทุกส่วนในรายงานจากจำนวนแถวข้อมูลจริง
+
+    80 เครื่อง: primary 2-83, สรุปยอด 88-100, หัวตาราง extra 109, ข้อมูล extra เริ่ม 110
+    extra_last/cut_summary เป็น None เมื่อไม่มีข้อมูลตัดม้วนเพิ่ม
+    """
+    primary_first = 2
+    primary_last = primary_first + primary_len - 1 + PRIMARY_BLANK_ROWS
+    summary_title = primary_last + SUMMARY_GAP_ROWS + 1
+    layout = {
+        'primary_first': primary_first,
+        'primary_last': primary_last,
+        'summary_title': summary_title,
+        'woven_label': summary_title + 3,
+        'woven_total': summary_title + 5,
+        'woven_sum': summary_title + 6,
+        'cut_label': summary_title + 9,
+        'cut_total': summary_title + 11,
+        'cut_sum': summary_title + 12,
+    }
+    layout['extra_header'] = layout['cut_sum'] + EXTRA_GAP_ROWS + 1
+    layout['extra_first'] = layout['extra_header'] + 1
+    if extra_len:
+        layout['extra_last'] = layout['extra_first'] + extra_len - 1
+        layout['cut_summary'] = layout['extra_last'] + CUT_SUMMARY_GAP_ROWS + 1
+    else:
+        layout['extra_last'] = layout['cut_summary'] = None
+    return layout
+
+
+def _build_report_formats(wb):
+    """สร้าง format ที่ใช้ร่วมกันทั้งรายงาน (xlsxwriter รวม format ที่ซ้ำกันให้เองตอนบันทึก)"""
+    center = {'align': 'center', 'valign': 'vcenter'}
+    base_font = {'font_name': 'Angsana New', 'font_size': 16}
+    header_font = {'font_name': 'Angsana New', 'font_size': 18, 'bold': True}
+    fmts = {
+        'header': wb.add_format({**center, **header_font, 'fg_color': '#DDEBF7', 'border': 1}),
+        'col_text': wb.add_format({**center, **base_font, 'num_format': '@'}),  # TEXT format ป้องกัน Scientific Notation
+        'col_num': wb.add_format({**center, **base_font, 'num_format': '#,##0'}),
+        'summary_title': wb.add_format({**center, 'bg_color': '#D9D9D9', 'border': 1}),
+        'label': wb.add_format({**center, **base_font, 'underline': 1}),
+        'total': wb.add_format({**center, 'num_format': '#,##0', 'border': 1}),
+        'cut_total': wb.add_format({**center, **base_font, 'num_format': '#,##0',
+                                    'border': 1, 'font_color': '#00008B'}),
+        'code_header': wb.add_format({**center, **header_font, 'border': 1, 'bg_color': '#FFD966'}),
+        'code': wb.add_format({**center, **base_font, 'border': 1, 'bg_color': '#FFF2CC'}),
+        'code_woven': wb.add_format({**center, **base_font, 'border': 1,
+                                     'num_format': '#,##0', 'bg_color': '#E2EFDA'}),
+        'code_cut': wb.add_format({**center, **base_font, 'border': 1,
+                                   'num_format': '#,##0', 'bg_color': '#D9E1F2'}),
+    }
+    # เซลล์ข้อมูล: format เดียวต่อชนิดคอลัมน์ (text/num); สีแถวคู่ใช้ conditional format ทั้ง block
+    for kind, num_format in (('text', '@'), ('num', '#,##0')):
+        fmts[('cell', kind)] = wb.add_format(
+            {**center, **base_font, 'border': 1, 'num_format': num_format}
+        )
+    fmts['stripe'] = wb.add_format({'bg_color': '#F3F3F3'})
+    return fmts
+
+
+def _write_block(ws, df, first_row, col_kinds, fmts, last_row=None):
+    """เขียนข้อมูล 1 block เริ่มที่แถว Excel first_row พร้อม border/ฟอนต์ แล้วระบายสีแถวคู่ด้วยกฎเดียว
+    last_row: ถ้ามากกว่าจำนวนข้อมูล จะจัดรูปแบบแถวว่างต่อจนถึงแถวนั้น
+    """
+    rows = list(df.itertuples(index=False, name=None))
+    if last_row is not None and last_row - first_row + 1 > len(rows):
+        rows += [(None,) * len(col_kinds)] * (last_row - first_row + 1 - len(rows))
+    col_fmts = [fmts[('cell', kind)] for kind in col_kinds]
+    for i, values in enumerate(rows):
+        excel_row = first_row + i
+        for col_idx, val in enumerate(values):
+            fmt = col_fmts[col_idx]
+            if val is None or (not isinstance(val, str) and pd.isna(val)):
+                ws.write_blank(excel_row - 1, col_idx, None, fmt)
+                continue
+            if hasattr(val, 'item'):
+                val = val.item()
+            ws.write(excel_row - 1, col_idx, val, fmt)
+        ws.set_row(excel_row - 1, 25)
+    if rows:
+        ws.conditional_format(
+            first_row - 1, 0, first_row + len(rows) - 2, len(col_kinds) - 1,
+            {'type': 'formula', 'criteria': '=MOD(ROW(),2)=0', 'format': fmts['stripe']}
+        )
+
+
+def add_rate_table(wb):
+    """เขียนตารางอัตราค่าแรง (รหัส, อัตรา) ลง sheet ซ่อน และตั้งชื่อช่วง RATE_TABLE ให้ VLOOKUP"""
+    ws = wb.add_worksheet(RATE_SHEET_NAME)
+    ws.write_row(0, 0, ['รหัส', 'อัตรา'])
+    for i, (code, rate) in enumerate(sorted(LABOR_RATE_BY_CODE.items()), start=1):
+        ws.write_row(i, 0, [code, rate])
+    wb.define_name(
+        RATE_TABLE_NAME, f"='{RATE_SHEET_NAME}'!$A$2:$B${len(LABOR_RATE_BY_CODE) + 1}"
+    )
+    ws.hide()
+
+
+def add_summary_and_extra_format(ws, fmts, layout, extra_df=None, run_date=None, clock=None):
+    """เขียนส่วนสรุปใต้ primary block และสรุปตัดม้วนครั้ง 2/3 ใต้ extra block ตามแถวใน layout"""
     try:
-        wb = openpyxl.load_workbook(file_path)
-        sh = wb[sheet_name]
-        center = Alignment(horizontal='center', vertical='center')
-        thin = Side(style='thin', color='000000')
-        border = Border(left=thin, right=thin, top=thin, bottom=thin)
-        base_font = Font(name='Angsana New', size=16)
-        underline = Font(name='Angsana New', size=16, underline="single")
-        blue = Font(name='Angsana New', size=16, color="0000FF")
-        red = Font(name='Angsana New', size=16, color="FF0000")
-        dark_blue_font = Font(name='Angsana New', size=16, color="00008B")
-        gray = PatternFill(start_color="D9D9D9", end_color="D9D9D9", fill_type="solid")
-        gray_row = PatternFill(start_color="F3F3F3", end_color="F3F3F3", fill_type="solid")
-        last_col_letter = get_column_letter(sh.max_column)
-        # ตั้งค่า Header แถวแรก
-        header_font = Font(name='Angsana New', size=18, bold=True)
-        for col in range(1, sh.max_column + 1):
-            cell = sh.cell(row=1, column=col)
-            cell.font = header_font
-            cell.alignment = center
-        sh.row_dimensions[1].height = 35
-        
-        # บังคับให้คอลัมน์รหัสเป็น TEXT format (ป้องกัน Scientific Notation)
-        # คอลัมน์ D (ขนาดหน้าผ้า), E (Lot.No), F (เลขที่ใบสั่งผลิต)
-        for r in range(2, MAX_ROW_FOR_BORDER_PRIMARY + 1):
-            for col_letter in ['D', 'E', 'F']:
-                cell = sh[f'{col_letter}{r}']
-                cell.number_format = '@'  # TEXT format
-        
-        for row in sh[f'A2:{last_col_letter}{MAX_ROW_FOR_BORDER_PRIMARY}']:
-            for c in row:
-                c.border = border
-                c.font = base_font
-                c.alignment = Alignment(horizontal='center', vertical='center')
-                if c.row % 2 == 0:
-                    c.fill = gray_row
-            sh.row_dimensions[row[0].row].height = 25
-        now = datetime.now(ZoneInfo("Asia/Bangkok"))
+        now = _resolve_run_date(run_date, clock)
         th_year = now.year + 543
         date_label = now.strftime(f"%d-%m-{th_year}")
-        sh.merge_cells('A88:B88')
-        a88 = sh['A88']
-        a88.value = f"สรุปยอดผลิตประจำวันที่ ({date_label})"
-        a88.alignment = center
-        a88.fill = gray
-        for row in sh['A88:B88']:
-            for c in row:
-                c.border = border
-        sh['A91'].value = "ยอดทอกะ A ทั้งหมด"
-        sh['A91'].alignment = center
-        sh['A91'].font = underline
-        sh['B91'].value = "ยอดทอกะ B ทั้งหมด"
-        sh['B91'].alignment = center
-        sh['B91'].font = underline
-        sh['A93'].value = f"=SUBTOTAL(109,G2:G{MAX_ROW_FOR_BORDER_PRIMARY})"
-        sh['A93'].alignment = center
-        sh['A93'].number_format = '#,##0'
-        sh['A93'].border = border
-        sh['B93'].value = f"=SUBTOTAL(109,H2:H{MAX_ROW_FOR_BORDER_PRIMARY})"
-        sh['B93'].alignment = center
-        sh['B93'].number_format = '#,##0'
-        sh['B93'].border = border
-        sh.merge_cells('A94:B94')
-        sh['A94'].value = "=A93+B93"
-        sh['A94'].alignment = center
-        sh['A94'].number_format = '#,##0'
-        for row in sh['A94:B94']:
-            for c in row:
-                c.border = border
-        sh['A97'].value = "ยอดตัดม้วนกะ A ทั้งหมด"
-        sh['A97'].alignment = center
-        sh['A97'].font = underline
-        sh['B97'].value = "ยอดตัดม้วนกะ B ทั้งหมด"
-        sh['B97'].alignment = center
-        sh['B97'].font = underline
-        sh['A99'].value = f"=SUBTOTAL(109,Q2:Q{MAX_ROW_FOR_BORDER_PRIMARY})"
-        sh['A99'].alignment = center
-        sh['A99'].number_format = '#,##0'
-        sh['A99'].border = border
-        sh['B99'].value = f"=SUBTOTAL(109,R2:R{MAX_ROW_FOR_BORDER_PRIMARY})"
-        sh['B99'].alignment = center
-        sh['B99'].number_format = '#,##0'
-        sh['B99'].border = border
-        sh.merge_cells('A100:B100')
-        sh['A100'].value = "=A99+B99"
-        sh['A100'].alignment = center
-        sh['A100'].number_format = '#,##0'
-        for row in sh['A100:B100']:
-            for c in row:
-                c.border = border
-        # ตั้งค่า Auto Filter ที่แถว 1 (Excel มีตัวกรองได้แค่ 1 อันต่อ sheet)
-        sh.auto_filter.ref = f"A1:{last_col_letter}{MAX_ROW_FOR_BORDER_PRIMARY}"
-        sh.freeze_panes = 'A2'
-        if extra_row_start and extra_row_end and extra_row_end >= extra_row_start:
-            # ตั้งค่า Header Extra Block
-            for col in range(1, sh.max_column + 1):
-                cell = sh.cell(row=extra_row_start - 1, column=col)
-                cell.font = header_font
-                cell.alignment = center
-            sh.row_dimensions[extra_row_start - 1].height = 35
-            
-            # บังคับให้คอลัมน์รหัสเป็น TEXT format ใน Extra Block
-            for r in range(extra_row_start, extra_row_end + 1):
-                for col_letter in ['D', 'E', 'F']:
-                    cell = sh[f'{col_letter}{r}']
-                    cell.number_format = '@'  # TEXT format
-            
-            for row in sh[f'A{extra_row_start}:{last_col_letter}{extra_row_end}']:
-                for c in row:
-                    c.border = border
-                    c.font = base_font
-                    c.alignment = Alignment(horizontal='center', vertical='center')
-                    if c.row % 2 == 0:
-                        c.fill = gray_row
-                sh.row_dimensions[row[0].row].height = 25
-            cut2_rows = []
-            cut3_rows = []
-            for r in range(extra_row_start, extra_row_end + 1):
-                v = sh[f"A{r}"].value
-                if isinstance(v, str):
-                    if ("ตัดม้วนที่ครั้ง 2" in v) or ("ตัดม้วนครั้งที่ 2" in v):
-                        cut2_rows.append(r)
-                    elif ("ตัดม้วนที่ครั้ง 3" in v) or ("ตัดม้วนครั้งที่ 3" in v):
-                        cut3_rows.append(r)
-            def simple_sum_formula(col, rows):
-                if not rows:
-                    return "0"
-                parts = [f"{col}{r}" for r in rows]
-                return f"=SUM({','.join(parts)})"
-            c2_g = simple_sum_formula("G", cut2_rows)
-            c2_h = simple_sum_formula("H", cut2_rows)
-            c2_q = simple_sum_formula("Q", cut2_rows)
-            c2_r = simple_sum_formula("R", cut2_rows)
-            c3_g = simple_sum_formula("G", cut3_rows)
-            c3_h = simple_sum_formula("H", cut3_rows)
-            c3_q = simple_sum_formula("Q", cut3_rows)
-            c3_r = simple_sum_formula("R", cut3_rows)
-            
-            # คำนวณตำแหน่งแถวเริ่มต้นสำหรับสรุปตัดม้วนครั้ง 2 และ 3 (ด้านล่าง extra block + 2 แถวว่าง)
-            summary_start = extra_row_end + 3
-            
-            # --- สรุปยอดทอตัดม้วนครั้งที่ 2 (คอลัมน์ A, B) ---
-            row_cut2_header = summary_start
-            sh[f'A{row_cut2_header}'].value = "ยอดทอกะ A (ตัดครั้ง 2)"
-            sh[f'A{row_cut2_header}'].alignment = center
-            sh[f'A{row_cut2_header}'].font = underline
-            sh[f'B{row_cut2_header}'].value = "ยอดทอกะ B (ตัดครั้ง 2)"
-            sh[f'B{row_cut2_header}'].alignment = center
-            sh[f'B{row_cut2_header}'].font = underline
-            
-            row_cut2_data = summary_start + 1
-            sh[f'A{row_cut2_data}'].value = c2_g
-            sh[f'A{row_cut2_data}'].alignment = center
-            sh[f'A{row_cut2_data}'].number_format = '#,##0'
-            sh[f'A{row_cut2_data}'].border = border
-            sh[f'A{row_cut2_data}'].font = dark_blue_font
-            sh[f'B{row_cut2_data}'].value = c2_h
-            sh[f'B{row_cut2_data}'].alignment = center
-            sh[f'B{row_cut2_data}'].number_format = '#,##0'
-            sh[f'B{row_cut2_data}'].border = border
-            sh[f'B{row_cut2_data}'].font = dark_blue_font
-            
-            row_cut2_total = summary_start + 2
-            sh.merge_cells(f'A{row_cut2_total}:B{row_cut2_total}')
-            sh[f'A{row_cut2_total}'].value = f"=A{row_cut2_data}+B{row_cut2_data}"
-            sh[f'A{row_cut2_total}'].alignment = center
-            sh[f'A{row_cut2_total}'].number_format = '#,##0'
-            sh[f'A{row_cut2_total}'].font = dark_blue_font
-            for row in sh[f'A{row_cut2_total}:B{row_cut2_total}']:
-                for c in row:
-                    c.border = border
-            
-            # --- สรุปยอดตัดม้วนตัดครั้งที่ 2 ---
-            row_cut2_length_header = summary_start + 4
-            sh[f'A{row_cut2_length_header}'].value = "ยอดตัดม้วนกะ A (ครั้ง 2)"
-            sh[f'A{row_cut2_length_header}'].alignment = center
-            sh[f'A{row_cut2_length_header}'].font = underline
-            sh[f'B{row_cut2_length_header}'].value = "ยอดตัดม้วนกะ B (ครั้ง 2)"
-            sh[f'B{row_cut2_length_header}'].alignment = center
-            sh[f'B{row_cut2_length_header}'].font = underline
-            
-            row_cut2_length_data = summary_start + 5
-            sh[f'A{row_cut2_length_data}'].value = c2_q
-            sh[f'A{row_cut2_length_data}'].alignment = center
-            sh[f'A{row_cut2_length_data}'].number_format = '#,##0'
-            sh[f'A{row_cut2_length_data}'].border = border
-            sh[f'A{row_cut2_length_data}'].font = dark_blue_font
-            sh[f'B{row_cut2_length_data}'].value = c2_r
-            sh[f'B{row_cut2_length_data}'].alignment = center
-            sh[f'B{row_cut2_length_data}'].number_format = '#,##0'
-            sh[f'B{row_cut2_length_data}'].border = border
-            sh[f'B{row_cut2_length_data}'].font = dark_blue_font
-            
-            row_cut2_length_total = summary_start + 6
-            sh.merge_cells(f'A{row_cut2_length_total}:B{row_cut2_length_total}')
-            sh[f'A{row_cut2_length_total}'].value = f"=A{row_cut2_length_data}+B{row_cut2_length_data}"
-            sh[f'A{row_cut2_length_total}'].alignment = center
-            sh[f'A{row_cut2_length_total}'].number_format = '#,##0'
-            sh[f'A{row_cut2_length_total}'].font = dark_blue_font
-            for row in sh[f'A{row_cut2_length_total}:B{row_cut2_length_total}']:
-                for c in row:
-                    c.border = border
-            
-            # --- สรุปยอดทอตัดม้วนครั้งที่ 3 (คอลัมน์ A, B) ---
-            row_cut3_header = summary_start + 9
-            sh[f'A{row_cut3_header}'].value = "ยอดทอกะ A (ตัดครั้ง 3)"
-            sh[f'A{row_cut3_header}'].alignment = center
-            sh[f'A{row_cut3_header}'].font = underline
-            sh[f'B{row_cut3_header}'].value = "ยอดทอกะ B (ตัดครั้ง 3)"
-            sh[f'B{row_cut3_header}'].alignment = center
-            sh[f'B{row_cut3_header}'].font = underline
-            
-            row_cut3_data = summary_start + 10
-            sh[f'A{row_cut3_data}'].value = c3_g
-            sh[f'A{row_cut3_data}'].alignment = center
-            sh[f'A{row_cut3_data}'].number_format = '#,##0'
-            sh[f'A{row_cut3_data}'].border = border
-            sh[f'A{row_cut3_data}'].font = dark_blue_font
-            sh[f'B{row_cut3_data}'].value = c3_h
-            sh[f'B{row_cut3_data}'].alignment = center
-            sh[f'B{row_cut3_data}'].number_format = '#,##0'
-            sh[f'B{row_cut3_data}'].border = border
-            sh[f'B{row_cut3_data}'].font = dark_blue_font
-            
-            row_cut3_total = summary_start + 11
-            sh.merge_cells(f'A{row_cut3_total}:B{row_cut3_total}')
-            sh[f'A{row_cut3_total}'].value = f"=A{row_cut3_data}+B{row_cut3_data}"
-            sh[f'A{row_cut3_total}'].alignment = center
-            sh[f'A{row_cut3_total}'].number_format = '#,##0'
-            sh[f'A{row_cut3_total}'].font = dark_blue_font
-            for row in sh[f'A{row_cut3_total}:B{row_cut3_total}']:
-                for c in row:
-                    c.border = border
-            
-            # --- สรุปยอดตัดม้วนตัดครั้งที่ 3 ---
-            row_cut3_length_header = summary_start + 13
-            sh[f'A{row_cut3_length_header}'].value = "ยอดตัดม้วนกะ A (ครั้ง 3)"
-            sh[f'A{row_cut3_length_header}'].alignment = center
-            sh[f'A{row_cut3_length_header}'].font = underline
-            sh[f'B{row_cut3_length_header}'].value = "ยอดตัดม้วนกะ B (ครั้ง 3)"
-            sh[f'B{row_cut3_length_header}'].alignment = center
-            sh[f'B{row_cut3_length_header}'].font = underline
-            
-            row_cut3_length_data = summary_start + 14
-            sh[f'A{row_cut3_length_data}'].value = c3_q
-            sh[f'A{row_cut3_length_data}'].alignment = center
-            sh[f'A{row_cut3_length_data}'].number_format = '#,##0'
-            sh[f'A{row_cut3_length_data}'].border = border
-            sh[f'A{row_cut3_length_data}'].font = dark_blue_font
-            sh[f'B{row_cut3_length_data}'].value = c3_r
-            sh[f'B{row_cut3_length_data}'].alignment = center
-            sh[f'B{row_cut3_length_data}'].number_format = '#,##0'
-            sh[f'B{row_cut3_length_data}'].border = border
-            sh[f'B{row_cut3_length_data}'].font = dark_blue_font
-            
-            row_cut3_length_total = summary_start + 15
-            sh.merge_cells(f'A{row_cut3_length_total}:B{row_cut3_length_total}')
-            sh[f'A{row_cut3_length_total}'].value = f"=A{row_cut3_length_data}+B{row_cut3_length_data}"
-            sh[f'A{row_cut3_length_total}'].alignment = center
-            sh[f'A{row_cut3_length_total}'].number_format = '#,##0'
-            sh[f'A{row_cut3_length_total}'].font = dark_blue_font
-            for row in sh[f'A{row_cut3_length_total}:B{row_cut3_length_total}']:
-                for c in row:
-                    c.border = border
-        wb.save(file_path)
+        first, last = layout['primary_first'], layout['primary_last']
+        title, woven, cut = layout['summary_title'], layout['woven_label'], layout['cut_label']
+        ws.merge_range(f'A{title}:B{title}', f"สรุปยอดผลิตประจำวันที่ ({date_label})", fmts['summary_title'])
+        ws.write(f'A{woven}', "ยอดทอกะ A ทั้งหมด", fmts['label'])
+        ws.write(f'B{woven}', "ยอดทอกะ B ทั้งหมด", fmts['label'])
+        row = layout['woven_total']
+        ws.write_formula(f'A{row}', f"=SUBTOTAL(109,G{first}:G{last})", fmts['total'])
+        ws.write_formula(f'B{row}', f"=SUBTOTAL(109,H{first}:H{last})", fmts['total'])
+        ws.merge_range(f"A{layout['woven_sum']}:B{layout['woven_sum']}", f"=A{row}+B{row}", fmts['total'])
+        ws.write(f'A{cut}', "ยอดตัดม้วนกะ A ทั้งหมด", fmts['label'])
+        ws.write(f'B{cut}', "ยอดตัดม้วนกะ B ทั้งหมด", fmts['label'])
+        row = layout['cut_total']
+        ws.write_formula(f'A{row}', f"=SUBTOTAL(109,Q{first}:Q{last})", fmts['total'])
+        ws.write_formula(f'B{row}', f"=SUBTOTAL(109,R{first}:R{last})", fmts['total'])
+        ws.merge_range(f"A{layout['cut_sum']}:B{layout['cut_sum']}", f"=A{row}+B{row}", fmts['total'])
+        if layout['extra_last'] is None:
+            return
+        # คอลัมน์ช่วย (ซ่อน) เก็บครั้งที่ตัดม้วนของแต่ละแถว -> สูตรสรุปเป็น SUMIF ความยาวคงที่
+        first, last = layout['extra_first'], layout['extra_last']
+        helper = xl_col_to_name(CUT_HELPER_COL)
+        cuts = extra_df['เครื่อง'].astype(str).str.extract(_EXTRA_MACHINE_RE)['cut']
+        ws.write(layout['extra_header'] - 1, CUT_HELPER_COL, "ตัดม้วนครั้งที่")
+        for i, cut_no in enumerate(cuts):
+            if isinstance(cut_no, str):
+                ws.write_number(first - 1 + i, CUT_HELPER_COL, int(cut_no))
+        ws.set_column(CUT_HELPER_COL, CUT_HELPER_COL, None, None, {'hidden': True})
+
+        def cut_sum_formula(col, cut_no):
+            return (
+                f"=SUMIF(${helper}${first}:${helper}${last},{cut_no},"
+                f"{col}{first}:{col}{last})"
+            )
+
+        def summary_pair(row, label_a, label_b, col_a, col_b, cut_no):
+            # หัวข้อ (ขีดเส้นใต้) -> ยอดกะ A/B -> ผลรวม (merge A:B)
+            ws.write(f'A{row}', label_a, fmts['label'])
+            ws.write(f'B{row}', label_b, fmts['label'])
+            ws.write_formula(f'A{row + 1}', cut_sum_formula(col_a, cut_no), fmts['cut_total'])
+            ws.write_formula(f'B{row + 1}', cut_sum_formula(col_b, cut_no), fmts['cut_total'])
+            ws.merge_range(f'A{row + 2}:B{row + 2}', f"=A{row + 1}+B{row + 1}", fmts['cut_total'])
+
+        # สรุปตัดม้วนครั้ง 2 และ 3 (ด้านล่าง extra block + 2 แถวว่าง)
+        summary_start = layout['cut_summary']
+        summary_pair(summary_start, "ยอดทอกะ A (ตัดครั้ง 2)", "ยอดทอกะ B (ตัดครั้ง 2)",
+                     "G", "H", 2)
+        summary_pair(summary_start + 4, "ยอดตัดม้วนกะ A (ครั้ง 2)", "ยอดตัดม้วนกะ B (ครั้ง 2)",
+                     "Q", "R", 2)
+        summary_pair(summary_start + 9, "ยอดทอกะ A (ตัดครั้ง 3)", "ยอดทอกะ B (ตัดครั้ง 3)",
+                     "G", "H", 3)
+        summary_pair(summary_start + 13, "ยอดตัดม้วนกะ A (ครั้ง 3)", "ยอดตัดม้วนกะ B (ครั้ง 3)",
+                     "Q", "R", 3)
     except Exception as e:
         print(f"[เกิดข้อผิดพลาดส่วนสรุป] {e}")
 
 
+# สระบน/ล่าง ไม้หันอากาศ และวรรณยุกต์ไทย วางซ้อนบนพยัญชนะ จึงไม่เพิ่มความกว้าง
+_THAI_ZERO_WIDTH_RE = '[\u0E31\u0E34-\u0E3A\u0E47-\u0E4E]'
+_WIDE_CHAR_RE = '[^\x00-\xff]'
+WIDE_CHAR_FACTOR = 1.15
+
+
+@functools.lru_cache(maxsize=4096)
+def _text_width(s):
+    zero = len(re.findall(_THAI_ZERO_WIDTH_RE, s))
+    wide = len(re.findall(_WIDE_CHAR_RE, s)) - zero
+    return (len(s) - zero - wide) + wide * WIDE_CHAR_FACTOR
+
+
 def calc_display_width(text):
     if text is None:
         return 0
     s = str(text)
     if s == 'nan':
         return 0
-    wide = sum(1 for ch in s if ord(ch) > 255)
-    narrow = len(s) - wide
-    return narrow + wide * 1.15
+    return _text_width(s)
+
+
+def display_widths(strings):
+    """ความกว้างที่แสดงของข้อความทั้ง Series (vectorized)"""
+    zero = strings.str.count(_THAI_ZERO_WIDTH_RE)
+    wide = strings.str.count(_WIDE_CHAR_RE) - zero
+    return (strings.str.len() - zero - wide) + wide * WIDE_CHAR_FACTOR
+
+
+def _sample_texts(values):
+    """ข้อความไม่ซ้ำของค่าใน Series (ตัดค่าว่าง/'nan' ออก)"""
+    uniq = pd.Series(values.dropna().unique(), dtype=object).astype(str)
+    return uniq[uniq != 'nan']
+
 
 def build_column_width_map(primary_df, extra_df=None, header_list=None,
                             min_w=6, max_w=48, formula_cols=None):
+    """ความกว้างคอลัมน์จากหัวตารางและข้อมูล 500 แถวแรกของแต่ละ block
+
+    ข้อความที่ไม่ซ้ำจากทุกคอลัมน์ถูกวัดรวมกันครั้งเดียว แล้วค่อยหาค่าสูงสุดรายคอลัมน์
+    """
     if header_list is None:
         header_list = list(primary_df.columns)
     if formula_cols is None:
         formula_cols = {
             "ยอดทอ กะ A","ยอดทอ กะ B","ค่าแรงพนักงานกะ A","ค่าแรงพนักงานกะ B"
         }
-    width_map = {}
     dfs = [primary_df]
     if extra_df is not None and not extra_df.empty:
         dfs.append(extra_df)
+    col_texts = {}
+    for col in header_list:
+        if col == 'Lot.No' or col in formula_cols:
+            continue
+        samples = [d[col].head(500) for d in dfs if col in d.columns]
+        if samples:
+            col_texts[col] = _sample_texts(pd.concat(samples, ignore_index=True))
+    all_texts = pd.Series(
+        pd.unique(pd.concat(list(col_texts.values()) or [pd.Series(dtype=object)])), dtype=object
+    )
+    text_width = dict(zip(all_texts, display_widths(all_texts)))
+
+    width_map = {}
     for col in header_list:
         max_width = calc_display_width(col)
-        for d in dfs:
-            if col in d.columns:
-                if col == 'Lot.No':
-                    max_width = max(
-                        max_width,
-                        calc_display_width("68091601") + 2
-)
-                    continue
-                for val in d[col].head(500):
-                    if col in formula_cols:
-                        max_width = max(max_width, 12)
-                    else:
-                        max_width = max(
-                            max_width,
-                            calc_display_width(val)
-)
+        present = [d for d in dfs if col in d.columns]
+        if col == 'Lot.No' and present:
+            max_width = max(max_width, calc_display_width("68091601") + 2)
+        elif col in formula_cols:
+            if any(len(d[col].head(500)) for d in present):
+                max_width = max(max_width, 12)
+        elif col in col_texts and not col_texts[col].empty:
+            max_width = max(max_width, max(text_width[t] for t in col_texts[col]))
         max_width += 2
         max_width = max(min_w, min(max_w, max_width))
         width_map[col] = max_width
     return width_map
 
 
-print("\n[ขั้นที่ 1/2] เลือกไฟล์กะ A (report A)")
-up_a = files.upload()
-if not up_a:
-    raise ValueError("ไม่พบไฟล์กะ A")
-file_a_name = next(iter(up_a))
-file_a_content = up_a[file_a_name]
+def compute_yields(df):
+    """คำนวณยอดทอกะ A/B (ค่าเดียวกับสูตรคอลัมน์ G/H) จากข้อมูลในหน่วยความจำ -> (Series G, Series H)
 
-print("\n[ขั้นที่ 2/2] เลือกไฟล์กะ B (report B)")
-up_b = files.upload()
-if not up_b:
-    raise ValueError("ไม่พบไฟล์กะ B")
-file_b_name = next(iter(up_b))
-file_b_content = up_b[file_b_name]
+    G = MAX(0, IF(M>N, IF(Q<>"", Q-ABS(N-M), R-ABS(N-M)), N-M)); H เหมือนกันแต่ใช้ O/P
+    ช่องว่าง/ข้อความนับเป็น 0 แบบเดียวกับ Excel
+    """
+    def num(col):
+        return pd.to_numeric(df.get(col, pd.Series(np.nan, index=df.index)), errors='coerce')
 
-df_a_raw = read_generic_file(
-    file_a_content, file_a_name, EXPECTED_COLUMN_COUNT_AB, RAW_COLUMNS_AB
-)
-df_b_raw = read_generic_file(
-    file_b_content, file_b_name, EXPECTED_COLUMN_COUNT_AB, RAW_COLUMNS_AB
-)
+    q_raw = num('ความยาวตัดม้วน กะ A (เดิม)')
+    q, r = q_raw.fillna(0), num('ความยาวตัดม้วน กะ B (เดิม)').fillna(0)
+    cut = q.where(q_raw.notna(), r)
 
-if df_a_raw.empty and df_b_raw.empty:
-    raise ValueError("ไม่มีข้อมูลทั้งกะ A และ B")
-primary_df = build_primary_block(df_a_raw, df_b_raw)
-extra_df = build_extra_block(df_a_raw, df_b_raw)
-has_extra = not extra_df.empty
-primary_df = assign_production_code(primary_df)
-if has_extra:
-    extra_df = assign_production_code(extra_df)
-if has_extra:
-    combined_df = pd.concat([primary_df, extra_df], ignore_index=True)
-else:
-    combined_df = primary_df.copy()
-combined_df = generate_and_assign_lot_no(combined_df)
-primary_len = len(primary_df)
-primary_df = combined_df.iloc[:primary_len].copy()
-if has_extra:
-    extra_df = combined_df.iloc[primary_len:].copy()
-primary_df = inject_formulas(primary_df, excel_start_row=2)
-for col in NUMERIC_DATA_COLUMNS:
-    if col in primary_df.columns and col not in ["ยอดทอ กะ A","ยอดทอ กะ B"]:
-        primary_df[col] = pd.to_numeric(primary_df[col], errors='coerce')
-if has_extra:
-    extra_df = inject_formulas(
-        extra_df, excel_start_row=EXTRA_BLOCK_DATA_START_EXCEL_ROW
-)
-    for col in NUMERIC_DATA_COLUMNS:
-        if col in extra_df.columns and col not in ["ยอดทอ กะ A","ยอดทอ กะ B"]:
-            extra_df[col] = pd.to_numeric(extra_df[col], errors='coerce')
-header_display = list(primary_df.columns)
-if 'ความยาวตัดม้วน กะ A (เดิม)' in header_display:
-    idx_a = header_display.index('ความยาวตัดม้วน กะ A (เดิม)')
-    header_display[idx_a] = 'ความยาวตัดม้วน กะ A'
-if 'ความยาวตัดม้วน กะ B (เดิม)' in header_display:
-    idx_b = header_display.index('ความยาวตัดม้วน กะ B (เดิม)')
-    header_display[idx_b] = 'ความยาวตัดม้วน กะ B'
-width_map = build_column_width_map(
-    primary_df, extra_df if has_extra else None, header_display
-)
-now = datetime.now(ZoneInfo('Asia/Bangkok'))
-thai_year = now.year + 543
-timestamp = now.strftime(f"%d-%m-{thai_year}_%H%M%S")
-output_filename = f"รายงานสรุปยอดผลิต-PD2_{timestamp}.xlsx"
-writer = pd.ExcelWriter(output_filename, engine='xlsxwriter')
-wb = writer.book
-ws_name = 'รายงานรวม'
-fmt_header = wb.add_format({
-    'bold': True,
-    'text_wrap': True,
-    'valign': 'vcenter',
-    'align': 'center',
-    'fg_color': '#DDEBF7',
-    'border': 1,
-    'font_name': 'Angsana New',
-    'font_size': 18,
-})
-fmt_text = wb.add_format({
-    'align': 'center',
-    'valign': 'vcenter',
-    'font_name': 'Angsana New',
-    'font_size': 16,
-})
-fmt_num_black = wb.add_format({
-    'align': 'center',
-    'valign': 'vcenter',
-    'num_format': '#,##0',
-    'font_name': 'Angsana New',
-    'font_size': 16,
-})
-fmt_text = wb.add_format({
-    'align': 'center',
-    'valign': 'vcenter',
-    'num_format': '@',  # TEXT format ป้องกัน Scientific Notation
-    'font_name': 'Angsana New',
-    'font_size': 16,
-})
-fmt_blue = wb.add_format({
-    'align': 'center',
-    'valign': 'vcenter',
-    'num_format': '#,##0',
-    'font_color': 'blue',
-    'font_name': 'Angsana New',
-    'font_size': 16,
-})
-fmt_red = wb.add_format({
-    'align': 'center',
-    'valign': 'vcenter',
-    'num_format': '#,##0',
-    'font_color': 'red',
-    'font_name': 'Angsana New',
-    'font_size': 16,
-})
-primary_df.to_excel(
-    writer, sheet_name=ws_name, startrow=1, header=False, index=False
-)
-ws = writer.sheets[ws_name]
-ws.write_row(0, 0, header_display, fmt_header)
-ws.set_row(0, 30)  # กำหนดความสูงแถว Header = 30
-display_to_internal = {
-    disp: internal for disp, internal in zip(header_display, list(primary_df.columns))
-}
-# คอลัมน์ที่ต้องเป็น TEXT format (ป้องกัน Scientific Notation)
-text_columns = ['ขนาดหน้าผ้า (รหัส)', 'Lot.No', 'เลขที่ใบสั่งผลิต']
-
-for col_idx, disp_name in enumerate(header_display):
-    internal_name = display_to_internal[disp_name]
-    width = width_map.get(disp_name, 14)
-    if disp_name in text_columns:
-        ws.set_column(col_idx, col_idx, width, fmt_text)  # TEXT format
-    elif internal_name in NUMERIC_DATA_COLUMNS:
-        ws.set_column(col_idx, col_idx, width, fmt_num_black)
-    else:
-        ws.set_column(col_idx, col_idx, width, fmt_text)
-ws.set_column(16, 16, width_map.get(header_display[16], 14), fmt_num_black)
-ws.set_column(17, 17, width_map.get(header_display[17], 14), fmt_num_black)
-if has_extra:
-    start_data_zero = EXTRA_BLOCK_DATA_START_EXCEL_ROW - 1
-    header_extra_zero = EXTRA_BLOCK_HEADER_EXCEL_ROW - 1
-    extra_df.to_excel(
-        writer, sheet_name=ws_name, startrow=start_data_zero,
-        header=False, index=False
-)
-    ws.write_row(header_extra_zero, 0, header_display, fmt_header)
-    # กำหนด TEXT format สำหรับคอลัมน์รหัสใน Extra Block
-    for col_idx, disp_name in enumerate(header_display):
-        if disp_name in text_columns:
-            ws.set_column(col_idx, col_idx, width_map.get(disp_name, 14), fmt_text)
-    ws.set_column(16, 16, width_map.get(header_display[16], 14), fmt_num_black)
-    ws.set_column(17, 17, width_map.get(header_display[17], 14), fmt_num_black)
-else:
-    print("ไม่มีข้อมูลตัดม้วนเพิ่ม (ครั้ง 2/3)")
-writer.close()
-extra_start = EXTRA_BLOCK_DATA_START_EXCEL_ROW if has_extra else None
-extra_end = (
-    EXTRA_BLOCK_DATA_START_EXCEL_ROW + len(extra_df) - 1 if has_extra else None
-)
-add_summary_and_extra_format(
-    output_filename, ws_name,
-    extra_row_start=extra_start, extra_row_end=extra_end
-)
+    def shift_yield(start_col, end_col):
+        start, end = num(start_col).fillna(0), num(end_col).fillna(0)
+        rolled = cut - (end - start).abs()
+        return rolled.where(start > end, end - start).clip(lower=0)
+
+    return (
+        shift_yield('มิเตอร์เริ่มงาน กะ A', 'มิเตอร์เลิกงาน กะ A'),
+        shift_yield('มิเตอร์เริ่มงาน กะ B', 'มิเตอร์เลิกงาน กะ B'),
+    )
 
-# คำนวณตำแหน่งสำหรับสรุปผลผลิตตามรหัสผ้า (ตรงกับ header ของยอดทอตัดม้วนครั้ง 2)
-size_code_summary_row = (extra_end + 3) if extra_end else None
 
-add_size_code_summaries = None
-def add_size_code_summaries(file_path, sheet_name, start_row):
+def _code_text(v):
+    """ข้อความรหัสผ้าสำหรับจัดกลุ่ม (ตัด .0 ของตัวเลขจำนวนเต็ม, ค่าว่าง -> '')"""
+    if v is None or (not isinstance(v, str) and pd.isna(v)):
+        return ''
+    if isinstance(v, float) and v.is_integer():
+        v = int(v)
+    return str(v).strip()
+
+
+def size_code_totals(blocks):
+    """ยอดทอ (G+H) และยอดตัดม้วน (Q+R) รวมตามรหัสผ้า จาก blocks = [(df, แถว Excel แรก), ...]
+
+    คืน DataFrame index = รหัสผ้า (เรียงตามตัวอักษร), คอลัมน์ woven/cut เฉพาะรหัสที่มียอดรวม > 0
+    """
+    parts = []
+    for df, _first_row in blocks:
+        if df is None or df.empty:
+            continue
+        g, h = compute_yields(df)
+        codes = df['ขนาดหน้าผ้า (รหัส)']
+        parts.append(pd.DataFrame({
+            'code': codes.map(dict((v, _code_text(v)) for v in codes.dropna().unique())).fillna(''),
+            'woven': g + h,
+            'cut': (
+                pd.to_numeric(df['ความยาวตัดม้วน กะ A (เดิม)'], errors='coerce').fillna(0) +
+                pd.to_numeric(df['ความยาวตัดม้วน กะ B (เดิม)'], errors='coerce').fillna(0)
+            ),
+        }))
+    if not parts:
+        return pd.DataFrame(columns=['woven', 'cut'])
+    rows = pd.concat(parts, ignore_index=True)
+    rows = rows[(rows['code'] != '') & (rows['code'].str.lower() != 'nan')]
+    totals = rows.groupby('code', sort=True)[['woven', 'cut']].sum()
+    return totals[(totals['woven'] + totals['cut']) > 0]
+
+
+def add_size_code_summaries(ws, fmts, start_row, blocks):
+    """ตารางสรุปผลผลิตตามรหัสผ้า (คอลัมน์ D-F) จาก blocks = [(df, แถว Excel แรกของ block), ...]"""
     try:
-        wb = openpyxl.load_workbook(file_path)
-        sh = wb[sheet_name]
-        # กำหนด last_data_row ให้ครอบคลุมทั้ง Primary และ Extra Block
-        if extra_end:
-            last_data_row = extra_end
-        else:
-            last_data_row = MAX_ROW_FOR_BORDER_PRIMARY
-        
-        codes = set()  # ใช้ set เพื่อไม่ให้ซ้ำ
-        # ดึงรหัสจาก Primary Block (แถว 2-83)
-        for r in range(2, MAX_ROW_FOR_BORDER_PRIMARY + 1):
-            cell_value = sh.cell(row=r, column=4).value
-            if cell_value:
-                code_str = str(cell_value).strip()
-                if code_str and code_str.lower() != 'nan':
-                    codes.add(code_str)
-        
-        # ดึงรหัสจาก Extra Block (ถ้ามี)
-        if extra_end and extra_end >= EXTRA_BLOCK_DATA_START_EXCEL_ROW:
-            for r in range(EXTRA_BLOCK_DATA_START_EXCEL_ROW, extra_end + 1):
-                cell_value = sh.cell(row=r, column=4).value
-                if cell_value:
-                    code_str = str(cell_value).strip()
-                    if code_str and code_str.lower() != 'nan':
-                        codes.add(code_str)
-        
-        # จัดเรียงรหัสผ้าจากน้อยไปมาก
-        codes = sorted(list(codes))
-        if not codes:
-            wb.save(file_path)
+        totals = size_code_totals(blocks)
+        if totals.empty:
             return
-        thin = Side(style='thin', color='000000')
-        border = Border(left=thin, right=thin, top=thin, bottom=thin)
         header_r = start_row
-        sh.cell(row=header_r, column=4).value = "สรุปผลผลิตตามรหัสผ้า"
-        sh.cell(row=header_r, column=5).value = "สรุปยอดทอ"
-        sh.cell(row=header_r, column=6).value = "สรุปยอดตัดม้วน"
-        header_fill = PatternFill(start_color="FFD966", end_color="FFD966", fill_type="solid")
-        header_font_summary = Font(name='Angsana New', size=18, bold=True)
-        data_font_summary = Font(name='Angsana New', size=16)
-        for c in range(4, 7):
-            cell = sh.cell(row=header_r, column=c)
-            cell.font = header_font_summary
-            cell.border = border
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-            cell.fill = header_fill
-        sh.row_dimensions[header_r].height = 35
-        try:
-            b_header = "Total produced"
-            c_header = "Total cut length"
-            w_b = calc_display_width(b_header) + 4
-            w_c = calc_display_width(c_header) + 4
-            sh.column_dimensions[get_column_letter(5)].width = w_b
-            sh.column_dimensions[get_column_letter(6)].width = w_c
-        except Exception:
-            sh.column_dimensions[get_column_letter(5)].width = 20
-            sh.column_dimensions[get_column_letter(6)].width = 32
-        
-        # วาง formula ชั่วคราวเพื่อตรวจสอบว่ามีข้อมูลหรือไม่
-        temp_data = []
-        for code in codes:
-            # คำนวณยอดทอและยอดตัดม้วน
-            sum_g = 0
-            sum_h = 0
-            sum_q = 0
-            sum_r = 0
-            for r in range(2, last_data_row + 1):
-                if r == EXTRA_BLOCK_HEADER_EXCEL_ROW:  # ข้าม header extra block
-                    continue
-                cell_val = sh.cell(row=r, column=4).value
-                if cell_val and str(cell_val).strip() == code:
-                    try:
-                        val_g = sh.cell(row=r, column=7).value
-                        val_h = sh.cell(row=r, column=8).value
-                        val_q = sh.cell(row=r, column=17).value
-                        val_r = sh.cell(row=r, column=18).value
-                        if val_g and isinstance(val_g, (int, float)):
-                            sum_g += val_g
-                        if val_h and isinstance(val_h, (int, float)):
-                            sum_h += val_h
-                        if val_q and isinstance(val_q, (int, float)):
-                            sum_q += val_q
-                        if val_r and isinstance(val_r, (int, float)):
-                            sum_r += val_r
-                    except:
-                        pass
-            
-            # เพิ่มเฉพาะรหัสที่มีข้อมูล (ยอดทอ + ยอดตัดม้วน > 0)
-            if (sum_g + sum_h + sum_q + sum_r) > 0:
-                temp_data.append(code)
-        
-        # ถ้าไม่มีรหัสที่มีข้อมูล ให้ออกจาก function
-        if not temp_data:
-            wb.save(file_path)
-            return
-        
-        # วาง header และ data
-        for idx, code in enumerate(temp_data):
+        ws.write(header_r - 1, 3, "สรุปผลผลิตตามรหัสผ้า", fmts['code_header'])
+        ws.write(header_r - 1, 4, "สรุปยอดทอ", fmts['code_header'])
+        ws.write(header_r - 1, 5, "สรุปยอดตัดม้วน", fmts['code_header'])
+        ws.set_row(header_r - 1, 35)
+        ws.set_column(4, 4, calc_display_width("Total produced") + 4, fmts['col_text'])
+        ws.set_column(5, 5, calc_display_width("Total cut length") + 4, fmts['col_text'])
+
+        # SUMIF เฉพาะแถวข้อมูลจริง (แถว 2 ถึงแถวสุดท้ายของ block สุดท้าย)
+        last = max(first + len(df) - 1 for df, first in blocks if df is not None and not df.empty)
+        d_rng, g_rng, h_rng = f'$D$2:$D${last}', f'$G$2:$G${last}', f'$H$2:$H${last}'
+        q_rng, r_rng = f'$Q$2:$Q${last}', f'$R$2:$R${last}'
+        for idx, (code, woven, cut) in enumerate(totals.itertuples()):
             r = start_row + 1 + idx
-            sh.cell(row=r, column=4).value = code
-            # สูตรใช้ dynamic range ครอบคลุมทั้ง Primary (2-83) และ Extra (110+) โดยไม่กำหนดขีดจำกัด
-            # ใช้ range 2-10000 เพื่อรองรับการขยายตัวของ Extra Block
-            sh.cell(row=r, column=5).value = (
-                f'=SUMIF($D$2:$D$10000, $D${r}, $G$2:$G$10000) + '
-                f'SUMIF($D$2:$D$10000, $D${r}, $H$2:$H$10000)'
-)
-            sh.cell(row=r, column=6).value = (
-                f'=SUMIF($D$2:$D$10000, $D${r}, $Q$2:$Q$10000) + '
-                f'SUMIF($D$2:$D$10000, $D${r}, $R$2:$R$10000)'
-)
-            col_a_fill = PatternFill(start_color="FFF2CC", end_color="FFF2CC", fill_type="solid")
-            col_b_fill = PatternFill(start_color="E2EFDA", end_color="E2EFDA", fill_type="solid")
-            col_c_fill = PatternFill(start_color="D9E1F2", end_color="D9E1F2", fill_type="solid")
-            for c in range(4, 7):
-                cell = sh.cell(row=r, column=c)
-                cell.border = border
-                cell.font = data_font_summary
-                if c == 4:
-                    cell.alignment = Alignment(horizontal='center', vertical='center')
-                    cell.fill = col_a_fill
-                elif c == 5:
-                    cell.alignment = Alignment(horizontal='center', vertical='center')
-                    cell.number_format = '#,##0'
-                    cell.fill = col_b_fill
-                else:
-                    cell.alignment = Alignment(horizontal='center', vertical='center')
-                    cell.number_format = '#,##0'
-                    cell.fill = col_c_fill
-            sh.row_dimensions[r].height = 25
-        wb.save(file_path)
+            ws.write_string(r - 1, 3, code, fmts['code'])
+            # ค่าที่คำนวณไว้เป็น cached value (โปรแกรมที่ไม่คำนวณสูตรก็เห็นยอด)
+            ws.write_formula(r - 1, 4, (
+                f'=SUMIF({d_rng}, $D${r}, {g_rng}) + '
+                f'SUMIF({d_rng}, $D${r}, {h_rng})'
+            ), fmts['code_woven'], woven)
+            ws.write_formula(r - 1, 5, (
+                f'=SUMIF({d_rng}, $D${r}, {q_rng}) + '
+                f'SUMIF({d_rng}, $D${r}, {r_rng})'
+            ), fmts['code_cut'], cut)
+            ws.set_row(r - 1, 25)
     except Exception as e:
         print(f"[ข้อผิดพลาด add_size_code_summaries] {e}")
 
-if size_code_summary_row:
-    add_size_code_summaries(output_filename, ws_name, start_row=size_code_summary_row)
-print("-" * 72)
-print(f"สร้างรายงานเสร็จ: {output_filename}")
-files.download(output_filename)
\ No newline at end of file
+
+# -------------------------------------------------------------
+# ข้อมูลรายงานแบบคอลัมน์ (Parquet/JSON) สำหรับ dashboard: ค่าที่คำนวณแล้ว ไม่ต้องอ่าน xlsx ซ้ำ
+# -------------------------------------------------------------
+
+# คอลัมน์ที่เป็นข้อความ (นอกนั้นเป็นตัวเลข float)
+REPORT_TEXT_COLUMNS = [
+    "เครื่อง","พนักงานทอ กะ A","พนักงานทอ กะ B","ขนาดหน้าผ้า (รหัส)","Lot.No","เลขที่ใบสั่งผลิต",
+]
+SIZE_CODE_DATA_COLUMNS = ["ขนาดหน้าผ้า (รหัส)", "สรุปยอดทอ", "สรุปยอดตัดม้วน"]
+
+
+def _labor_rate(code):
+    """อัตราค่าแรงของรหัสผ้า (ตรรกะเดียวกับ VLOOKUP ในคอลัมน์ Y/Z; หาไม่พบ = 0)"""
+    upper = code.upper()
+    if upper.startswith('FCL'):
+        part = code[5:7]
+    elif upper.startswith('TEST'):
+        part = code[4:6]
+    else:
+        part = code[:2]
+    try:
+        return LABOR_RATE_BY_CODE.get(float(part.strip()), 0.0)
+    except ValueError:
+        return 0.0
+
+
+def _text_column(s):
+    """คอลัมน์ข้อความแบบ string dtype (ตัวเลขจำนวนเต็มไม่มี .0, ค่าว่าง -> <NA>)"""
+    texts = s.map(dict((v, _code_text(v)) for v in s.dropna().unique()))
+    return texts.where(texts != '').astype('string')
+
+
+def report_values(df):
+    """block รายงานเป็นค่าที่คำนวณแล้ว: ยอดทอ G/H และค่าแรง Y/Z แทนสูตร, ชนิดข้อมูลตามคอลัมน์"""
+    df = df.reindex(columns=REPORT_COLUMNS)
+    out = {}
+    for col in REPORT_COLUMNS:
+        if col in REPORT_TEXT_COLUMNS:
+            out[col] = _text_column(df[col])
+        else:
+            out[col] = pd.to_numeric(df[col], errors='coerce').astype('float64')
+    out = pd.DataFrame(out, index=df.index).reset_index(drop=True)
+    g, h = compute_yields(df)
+    codes = out['ขนาดหน้าผ้า (รหัส)'].fillna('')
+    rates = codes.map(dict((c, _labor_rate(c)) for c in codes.unique())).astype('float64')
+    out['ยอดทอ กะ A'] = g.to_numpy()
+    out['ยอดทอ กะ B'] = h.to_numpy()
+    out['ค่าแรงพนักงานกะ A'] = rates * out['ยอดทอ กะ A']
+    out['ค่าแรงพนักงานกะ B'] = rates * out['ยอดทอ กะ B']
+    return out
+
+
+def report_data_frames(primary_df, extra_df):
+    """ข้อมูลรายงานสำหรับ dashboard -> {'primary', 'extra', 'size_codes': DataFrame}"""
+    totals = size_code_totals([(primary_df, None), (extra_df, None)]).reset_index()
+    totals.columns = SIZE_CODE_DATA_COLUMNS
+    totals[SIZE_CODE_DATA_COLUMNS[0]] = totals[SIZE_CODE_DATA_COLUMNS[0]].astype('string')
+    return {
+        'primary': report_values(primary_df),
+        'extra': report_values(extra_df),
+        'size_codes': totals.astype({c: 'float64' for c in SIZE_CODE_DATA_COLUMNS[1:]}),
+    }
+
+
+def report_data_json(frames, run_date=None):
+    """JSON แบบกะทัดรัด: {"run_date", "<ชื่อตาราง>": {"columns": [...], "data": [[...], ...]}}"""
+    parts = [f'"run_date":"{_resolve_run_date(run_date).strftime("%Y-%m-%d")}"']
+    for name, df in frames.items():
+        parts.append(f'"{name}":' + df.to_json(orient='split', index=False, force_ascii=False))
+    return '{' + ','.join(parts) + '}'
+
+
+def write_report_data(prefix, frames, run_date=None):
+    """เขียน <prefix>.json และ <prefix>_<ชื่อตาราง>.parquet (ต้องมี pyarrow) -> รายการ path ที่เขียน"""
+    paths = [prefix + '.json']
+    with open(paths[0], 'w', encoding='utf-8') as fh:
+        fh.write(report_data_json(frames, run_date=run_date))
+    try:
+        for name, df in frames.items():
+            path = f'{prefix}_{name}.parquet'
+            df.to_parquet(path, index=False)
+            paths.append(path)
+    except ImportError:
+        print("[ข้าม Parquet] ต้องติดตั้ง pyarrow ก่อน (pip install pyarrow)")
+    return paths
+
+
+# -------------------------------------------------------------
+# ขั้นตอนสร้างรายงาน (ใช้ได้ทั้ง Colab, CLI และ import เป็นโมดูล)
+# -------------------------------------------------------------
+
+def _resolve_run_date(run_date=None, clock=None):
+    """คืน datetime ของวันที่ออกรายงาน (รับ date/datetime/'YYYY-MM-DD')
+
+    run_date=None: ใช้ clock() ถ้ากำหนด ไม่เช่นนั้นใช้เวลาปัจจุบัน Asia/Bangkok
+    """
+    if run_date is None:
+        if clock is not None:
+            return clock()
+        try:
+            return datetime.now(ZoneInfo('Asia/Bangkok'))
+        except Exception:  # ไม่มีฐานข้อมูล timezone (เช่น Windows ที่ไม่ได้ติดตั้ง tzdata)
+            return datetime.now()
+    if isinstance(run_date, str):
+        run_date = datetime.strptime(run_date.strip(), '%Y-%m-%d')
+    if isinstance(run_date, datetime):
+        return run_date
+    return datetime(run_date.year, run_date.month, run_date.day)
+
+
+def _day_end(run_date):
+    """เที่ยงคืนถัดจากวันที่ออกรายงาน (ขอบบนแบบไม่รวมของแถวที่ใช้)"""
+    return pd.Timestamp(run_date.year, run_date.month, run_date.day) + pd.Timedelta(days=1)
+
+
+def _report_window(run_date=None, window_days=None, clock=None):
+    """ช่วงวันที่ (start, end) ของแถวที่รายงานใช้ สำหรับ date_window ของ iter_generic_chunks
+
+    end: ตัดแถวที่บันทึกหลังวันที่ออกรายงาน (สร้างรายงานย้อนหลังจากไฟล์สะสม; ไม่กำหนด run_date = ไม่ตัด)
+    start: ใช้เฉพาะ window_days วันล่าสุด นับรวมวันออกรายงาน (None = ทุกแถว)
+    """
+    end = _day_end(run_date) if run_date is not None else None
+    start = None
+    if window_days:
+        start = (end if end is not None else _day_end(_resolve_run_date(None, clock))) - pd.Timedelta(days=window_days)
+    if start is None and end is None:
+        return None
+    return start, end
+
+
+def _load_source(src):
+    """คืน (ชื่อไฟล์, bytes) จาก path หรือ tuple (ชื่อไฟล์, bytes) แบบที่ files.upload() ให้มา (SheetMirror คืนตามเดิม)"""
+    if isinstance(src, (tuple, SheetMirror)):
+        return src
+    with open(src, 'rb') as fh:
+        return os.path.basename(src), fh.read()
+
+
+def _source_digest(src):
+    """hash ของแหล่งข้อมูลที่โหลดแล้ว: เนื้อไฟล์ หรือข้อมูลในสำเนา sheet"""
+    if isinstance(src, SheetMirror):
+        return src.digest()
+    return hashlib.sha256(src[1]).digest()
+
+
+def _source_list(src):
+    """ไฟล์ของกะหนึ่ง -> list ของแหล่งข้อมูล (รับได้ทั้งแหล่งเดียวหรือ list)"""
+    return list(src) if isinstance(src, list) else [src]
+
+
+def _roll_keys(df_a_raw, df_b_raw):
+    """ชื่อเครื่องในรายงาน -> ข้อความระบุม้วนจากแถวล่าสุดของแต่ละกะ ('วันที่', 'เวลาบันทึก', 'ลำดับชุดข้อมูลที่')
+
+    ไม่ขึ้นกับรูปแบบไฟล์: ข้อมูลชุดเดิมที่ export ใหม่หรือบันทึกเป็น .csv แทน .xlsx ได้ข้อความเดิม
+    """
+    keys = {}
+    for shift, df_raw in (('A', df_a_raw), ('B', df_b_raw)):
+        if df_raw.empty:
+            continue
+        df = latest_per_machine(df_raw)
+        names = df['เครื่องทอ NO'].astype(str)
+        # ชื่อเครื่องตัดม้วนเพิ่มให้ตรงกับในรายงาน (build_extra_block)
+        found = names.str.extract(_EXTRA_MACHINE_RE)
+        names = names.where(found['base'].isna(), found['base'] + ' ตัดม้วนครั้งที่ ' + found['cut'])
+        day = pd.to_datetime(df['วันที่'], errors='coerce').dt.strftime('%Y-%m-%d').fillna('')
+        if 'เวลาบันทึก' in df.columns:
+            saved = _parse_timestamp_series(df['เวลาบันทึก']).dt.strftime('%Y-%m-%dT%H:%M:%S').fillna('')
+        else:
+            saved = pd.Series('', index=df.index)
+        seq = pd.to_numeric(df.get('ลำดับชุดข้อมูลที่'), errors='coerce')
+        seq = seq.map(lambda v: '' if pd.isna(v) else f'{v:g}') if seq is not None else ''
+        for name, key in zip(names, f'{shift}:' + day + '/' + saved + '/' + seq):
+            keys[name] = f'{keys[name]};{key}' if name in keys else key
+    return keys
+
+
+def build_report_frames(df_a_raw, df_b_raw, run_date=None, ledger=None, clock=None):
+    """สร้าง primary/extra block พร้อมเลขที่ใบสั่งผลิต, Lot.No และสูตร -> (primary_df, extra_df)
+
+    ledger: ส่งต่อให้ generate_and_assign_lot_no เพื่อจอง Lot.No แบบถาวร (key = เครื่อง + ม้วน ดู _roll_keys)
+    clock: ฟังก์ชันคืน datetime ปัจจุบัน (ใช้เมื่อไม่กำหนด run_date)
+    """
+    if df_a_raw.empty and df_b_raw.empty:
+        raise ValueError("ไม่มีข้อมูลทั้งกะ A และ B")
+    primary_df = build_primary_block(df_a_raw, df_b_raw)
+    extra_df = build_extra_block(df_a_raw, df_b_raw)
+    has_extra = not extra_df.empty
+    primary_df, unmapped = assign_production_code(primary_df, run_date=run_date, clock=clock)
+    if has_extra:
+        extra_df, unmapped_extra = assign_production_code(extra_df, run_date=run_date, clock=clock)
+        unmapped |= unmapped_extra
+    if unmapped:
+        print(f"[รหัสไม่พบใน mapping] ({len(unmapped)}) : {', '.join(sorted(unmapped))}")
+    if has_extra:
+        combined_df = pd.concat([primary_df, extra_df], ignore_index=True)
+    else:
+        combined_df = primary_df.copy()
+    combined_df = generate_and_assign_lot_no(
+        combined_df, run_date=run_date, ledger=ledger, clock=clock,
+        roll_keys=_roll_keys(df_a_raw, df_b_raw) if ledger is not None else None,
+    )
+    primary_len = len(primary_df)
+    primary_df = combined_df.iloc[:primary_len].copy()
+    if has_extra:
+        extra_df = combined_df.iloc[primary_len:].copy()
+    layout = plan_layout(len(primary_df), len(extra_df) if has_extra else 0)
+    primary_df = inject_formulas(primary_df, excel_start_row=layout['primary_first'])
+    for col in NUMERIC_DATA_COLUMNS:
+        if col in primary_df.columns and col not in ["ยอดทอ กะ A","ยอดทอ กะ B"]:
+            primary_df[col] = pd.to_numeric(primary_df[col], errors='coerce')
+    if has_extra:
+        extra_df = inject_formulas(extra_df, excel_start_row=layout['extra_first'])
+        for col in NUMERIC_DATA_COLUMNS:
+            if col in extra_df.columns and col not in ["ยอดทอ กะ A","ยอดทอ กะ B"]:
+                extra_df[col] = pd.to_numeric(extra_df[col], errors='coerce')
+    return primary_df, extra_df
+
+
+class _RowOrderedSheet:
+    """ห่อ worksheet: เก็บคำสั่งเขียนเซลล์ไว้ แล้วส่งต่อเรียงตามแถวตอน flush()
+
+    โหมด constant_memory ของ xlsxwriter เขียนได้เฉพาะแถวที่ยังไม่ผ่านไป แต่ส่วนสรุป/ตารางรหัสผ้า
+    เขียนย้อนแถวกัน จึงต้องจัดลำดับก่อน; คำสั่งที่ไม่ใช่ข้อมูลเซลล์ (set_column ฯลฯ) ส่งต่อทันที
+    """
+    _CELL_METHODS = {
+        'write', 'write_blank', 'write_number', 'write_string', 'write_formula',
+        'write_row', 'write_datetime', 'merge_range', 'set_row',
+    }
+
+    def __init__(self, ws):
+        self._ws = ws
+        self._calls = []
+
+    def __getattr__(self, name):
+        attr = getattr(self._ws, name)
+        if name not in self._CELL_METHODS:
+            return attr
+
+        def record(*args, **kwargs):
+            row = args[0]
+            if isinstance(row, str):  # รูปแบบ 'A1' หรือ 'A1:B1'
+                row = xl_cell_to_rowcol(row.split(':')[0])[0]
+            self._calls.append((row, len(self._calls), attr, args, kwargs))
+        return record
+
+    def flush(self):
+        for _row, _seq, method, args, kwargs in sorted(self._calls, key=lambda c: (c[0], c[1])):
+            method(*args, **kwargs)
+        self._calls = []
+
+
+def open_report_workbook(output, constant_memory=False):
+    """สร้าง Workbook พร้อม sheet รายงานหลัก (sheet แรก) -> (wb, ws)
+
+    output: path ไฟล์ หรือ file object เช่น BytesIO (เขียนในหน่วยความจำ ไม่ใช้ไฟล์ชั่วคราว;
+    xlsxwriter จะไม่ใช้ constant_memory ในกรณีนี้)
+    """
+    if isinstance(output, (str, os.PathLike)):
+        options = {'constant_memory': constant_memory}
+    else:
+        options = {'in_memory': True}
+    wb = xlsxwriter.Workbook(output, options)
+    return wb, wb.add_worksheet('รายงานรวม')
+
+
+def write_report(output_filename, primary_df, extra_df, run_date=None, clock=None):
+    """เขียนรายงานทั้งไฟล์ (ข้อมูล, รูปแบบ, ส่วนสรุป, ตารางสรุปตามรหัสผ้า) ด้วย xlsxwriter รอบเดียว"""
+    wb, ws = open_report_workbook(output_filename)
+    write_report_sheet(wb, ws, primary_df, extra_df, run_date=run_date, clock=clock)
+    wb.close()
+    return output_filename
+
+
+def write_report_sheet(wb, ws, primary_df, extra_df, run_date=None, clock=None):
+    """เขียน sheet รายงานหลักและตารางอัตราค่าแรงลง Workbook ที่เปิดไว้ (ยังไม่ close)"""
+    # วันที่สร้างในคุณสมบัติไฟล์ = วันที่ออกรายงาน (ข้อมูลชุดเดิมได้ไฟล์เหมือนเดิมทุก byte)
+    wb.set_properties({'created': _resolve_run_date(run_date, clock)})
+    ws = _RowOrderedSheet(ws)
+    has_extra = not extra_df.empty
+    layout = plan_layout(len(primary_df), len(extra_df) if has_extra else 0)
+    header_display = list(primary_df.columns)
+    if 'ความยาวตัดม้วน กะ A (เดิม)' in header_display:
+        idx_a = header_display.index('ความยาวตัดม้วน กะ A (เดิม)')
+        header_display[idx_a] = 'ความยาวตัดม้วน กะ A'
+    if 'ความยาวตัดม้วน กะ B (เดิม)' in header_display:
+        idx_b = header_display.index('ความยาวตัดม้วน กะ B (เดิม)')
+        header_display[idx_b] = 'ความยาวตัดม้วน กะ B'
+    width_map = build_column_width_map(
+        primary_df, extra_df if has_extra else None, header_display
+    )
+    fmts = _build_report_formats(wb)
+    # คอลัมน์ที่ต้องเป็น TEXT format (ป้องกัน Scientific Notation)
+    text_columns = ['ขนาดหน้าผ้า (รหัส)', 'Lot.No', 'เลขที่ใบสั่งผลิต']
+    col_kinds = []
+    for col_idx, (disp_name, internal_name) in enumerate(zip(header_display, primary_df.columns)):
+        kind = 'num' if internal_name in NUMERIC_DATA_COLUMNS and disp_name not in text_columns else 'text'
+        col_kinds.append(kind)
+        ws.set_column(col_idx, col_idx, width_map.get(disp_name, 14), fmts['col_' + kind])
+    last_col = len(header_display) - 1
+
+    ws.write_row(0, 0, header_display, fmts['header'])
+    ws.set_row(0, 35)
+    _write_block(ws, primary_df, layout['primary_first'], col_kinds, fmts,
+                 last_row=layout['primary_last'])
+    # ตั้งค่า Auto Filter ที่แถว 1 (Excel มีตัวกรองได้แค่ 1 อันต่อ sheet)
+    ws.autofilter(0, 0, layout['primary_last'] - 1, last_col)
+    ws.freeze_panes(1, 0)
+
+    if has_extra:
+        ws.write_row(layout['extra_header'] - 1, 0, header_display, fmts['header'])
+        ws.set_row(layout['extra_header'] - 1, 35)
+        _write_block(ws, extra_df, layout['extra_first'], col_kinds, fmts)
+    else:
+        print("ไม่มีข้อมูลตัดม้วนเพิ่ม (ครั้ง 2/3)")
+    add_summary_and_extra_format(ws, fmts, layout, extra_df, run_date=run_date, clock=clock)
+
+    # ตารางสรุปผลผลิตตามรหัสผ้า วางตรงกับ header ของยอดทอตัดม้วนครั้ง 2
+    if has_extra:
+        add_size_code_summaries(
+            ws, fmts, start_row=layout['cut_summary'],
+            blocks=[(primary_df, layout['primary_first']), (extra_df, layout['extra_first'])]
+        )
+    ws.flush()
+    add_rate_table(wb)
+
+
+# จำนวนแถวสูงสุดของ sheet Excel
+EXCEL_MAX_ROWS = 1048576
+
+
+class AppendixSheet:
+    """sheet ข้อมูลดิบของกะหนึ่ง (ภาคผนวกให้ผู้ตรวจสอบย้อนดูที่มาของตัวเลข)
+
+    เขียนต่อท้ายทีละ chunk ระหว่างอ่านไฟล์ ใช้กับ Workbook แบบ constant_memory
+    จึงไม่ต้องเก็บทุกแถวไว้ในหน่วยความจำ; เก็บเฉพาะแถวที่ 'วันที่' อยู่ในช่วง [start, end)
+    """
+
+    def __init__(self, wb, name, start, end):
+        self.ws = wb.add_worksheet(name)
+        self.start = start
+        self.end = end
+        self.row = 0
+        self.truncated = False
+        self.date_fmt = wb.add_format({'num_format': 'dd/mm/yyyy'})
+        self.datetime_fmt = wb.add_format({'num_format': 'dd/mm/yyyy hh:mm:ss'})
+
+    def tee(self, chunks):
+        """ส่งต่อ chunk เดิมพร้อมเขียนแถวในช่วงวันที่ลง sheet"""
+        for chunk in chunks:
+            self.append(chunk)
+            yield chunk
+
+    def append(self, chunk):
+        if chunk.empty or self.truncated:
+            return
+        if self.row == 0:
+            self.ws.write_row(0, 0, list(chunk.columns))
+            self.ws.freeze_panes(1, 0)
+            self.row = 1
+        dates = chunk['วันที่']
+        rows = chunk[(dates >= self.start) & (dates < self.end)]
+        if rows.empty:
+            return
+        date_col = list(chunk.columns).index('วันที่')
+        # ค่าวัดจากไฟล์ CSV เป็นข้อความ: เขียนเป็นตัวเลขแบบเดียวกับไฟล์ xlsx (ค่าที่แปลงไม่ได้คงข้อความเดิม)
+        numeric = {}
+        for col in RAW_NUMERIC_COLUMNS_AB:
+            if col in rows.columns and rows[col].dtype.kind not in 'iufb':
+                parsed = pd.to_numeric(rows[col].astype(object).where(rows[col].notna(), None), errors='coerce')
+                numeric[col] = rows[col].astype(object).where(parsed.isna(), parsed)
+        if numeric:
+            rows = rows.assign(**numeric)
+        # แปลงเป็น object ของ Python ทีละ chunk แล้วเรียก write_* ตรงชนิด (เร็วกว่า ws.write ที่ต้องเดาชนิด)
+        values = rows.astype(object).where(rows.notna(), None).to_numpy().tolist()
+        ws = self.ws
+        for record in values:
+            if self.row >= EXCEL_MAX_ROWS:
+                self.truncated = True
+                print(f"[ภาคผนวก] {ws.name} : เกิน {EXCEL_MAX_ROWS:,} แถว ตัดส่วนที่เหลือ")
+                return
+            for col, val in enumerate(record):
+                if val is None:
+                    continue
+                if isinstance(val, str):
+                    ws.write_string(self.row, col, val)
+                elif isinstance(val, (int, float, np.integer, np.floating)) and not isinstance(val, bool):
+                    ws.write_number(self.row, col, val)
+                elif isinstance(val, datetime):
+                    fmt = self.date_fmt if col == date_col else self.datetime_fmt
+                    ws.write_datetime(self.row, col, val, fmt)
+                else:
+                    ws.write(self.row, col, val.item() if hasattr(val, 'item') else val)
+            self.row += 1
+
+
+def default_output_filename(run_date=None, with_time=True):
+    """ชื่อไฟล์รายงาน: รายงานสรุปยอดผลิต-PD2_<dd-mm-ปีพ.ศ.>[_HHMMSS].xlsx"""
+    now = _resolve_run_date(run_date)
+    thai_year = now.year + 543
+    pattern = f"%d-%m-{thai_year}_%H%M%S" if with_time else f"%d-%m-{thai_year}"
+    return f"รายงานสรุปยอดผลิต-PD2_{now.strftime(pattern)}.xlsx"
+
+
+def _read_latest_rows(file_a, file_b, run_date=None, appendices=(), parse_cache=None, layout_cache=None,
+                      window_days=None, clock=None):
+    """อ่านไฟล์กะ A/B ทีละ chunk -> (แถวล่าสุดของแต่ละเครื่องกะ A, กะ B)
+
+    file_a/file_b: ไฟล์เดียว หรือ list ของไฟล์กะเดียวกัน (รวมด้วย merge_export_chunks)
+    อ่านเฉพาะคอลัมน์ที่รายงานใช้ (REPORT_SOURCE_COLUMNS) และแถวในช่วง _report_window
+    ยกเว้นมีภาคผนวก: อ่านทุกคอลัมน์ไปเขียนข้อมูลดิบ แล้วค่อยกรองช่วงวันที่
+    """
+    window = _report_window(run_date, window_days, clock)
+    latest = []
+    for i, srcs in enumerate((file_a, file_b)):
+        srcs = _source_list(srcs)
+        if appendices:
+            columns, date_window = None, ((None, window[1]) if window else None)
+        else:
+            columns, date_window = REPORT_SOURCE_COLUMNS['AB'[i]], window
+        streams = []
+        for src in srcs:
+            src = _load_source(src)
+            if isinstance(src, SheetMirror):
+                streams.append(src.iter_chunks(columns, date_window))
+                continue
+            name, content = src
+            streams.append(iter_generic_chunks(
+                content, name, EXPECTED_COLUMN_COUNT_AB, RAW_COLUMNS_AB,
+                parse_cache=parse_cache, layout_cache=layout_cache,
+                columns=columns, date_window=date_window,
+            ))
+        chunks = streams[0] if len(streams) == 1 else merge_export_chunks(streams)
+        if appendices:
+            chunks = appendices[i].tee(chunks)
+            if window and window[0] is not None:
+                chunks = (_select_rows(c, date_window=window) for c in chunks)
+        # ไฟล์สะสมไม่ต้องโหลดทั้งไฟล์: เก็บเฉพาะแถวล่าสุดของแต่ละเครื่องระหว่างอ่าน
+        latest.append(latest_per_machine(chunks))
+    return latest[0], latest[1]
+
+
+# -------------------------------------------------------------
+# แคชรายงาน: ข้อมูลเข้าชุดเดิม + ค่าตั้งเดิม -> ไฟล์รายงานเดิม (ไม่ต้องสร้างใหม่)
+# -------------------------------------------------------------
+
+REPORT_DATA_SUFFIXES = ['.json', '_primary.parquet', '_extra.parquet', '_size_codes.parquet']
+
+
+@functools.lru_cache(maxsize=None)
+def _program_digest():
+    """hash ของซอร์สโปรแกรมนี้: แก้โปรแกรมแล้วแคชเดิมใช้ไม่ได้อัตโนมัติ"""
+    try:
+        with open(__file__, 'rb') as fh:
+            return hashlib.sha256(fh.read()).hexdigest()
+    except (NameError, OSError):  # รันเป็นเซลล์ใน Colab ไม่มี __file__
+        return ''
+
+
+def report_cache_key(sources, run_date=None, clock=None, **options):
+    """key ของรายงาน = hash ของ bytes ไฟล์ข้อมูลเข้า, mapping รหัส, รายชื่อเครื่อง, วันที่ออกรายงาน และ options
+
+    sources: [(ชื่อไฟล์, bytes), ...] หรือ list ของไฟล์แต่ละกะ [[(ชื่อไฟล์, bytes), ...], ...]
+        (SheetMirror แทนไฟล์ได้ ใช้ hash ของข้อมูลในสำเนา);
+    run_date=None ใช้วันที่จาก clock (รายงานวันเดียวกันใช้แคชร่วมกัน)
+    """
+    h = hashlib.sha256()
+    for src in sources:
+        digests = [_source_digest(s) for s in _source_list(src)]
+        # ไฟล์เดียวต่อกะได้ key เดิม; หลายไฟล์ใช้ hash ของ hash แต่ละไฟล์ตามลำดับ (เหมือน _read_latest_rows)
+        h.update(digests[0] if len(digests) == 1 else hashlib.sha256(b''.join(digests)).digest())
+    report_day = _resolve_run_date(run_date, clock).strftime('%Y-%m-%d')
+    h.update(json.dumps({
+        'code_mapping': sorted(CODE_MAPPING.items()),
+        'machines': PRIMARY_MACHINE_ORDER + EXTRA_MACHINE_ORDER_FULL,
+        'labor_rates': sorted(LABOR_RATE_BY_CODE.items()),
+        'run_date': report_day if run_date is not None else f'now:{report_day}',
+        'options': options,
+        'program': _program_digest(),
+    }, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8'))
+    return h.hexdigest()
+
+
+def _copy_artifact(src, dst):
+    """คัดลอกไฟล์ src ไปยัง path หรือ file object dst"""
+    if isinstance(dst, (str, os.PathLike)):
+        shutil.copyfile(src, dst)
+    else:
+        with open(src, 'rb') as fh:
+            shutil.copyfileobj(fh, dst)
+
+
+def _store_artifact(src, dst):
+    """เขียน src (path หรือ BytesIO) ลงแคชแบบ atomic (process อื่นไม่เห็นไฟล์ที่เขียนไม่ครบ)"""
+    tmp = f'{dst}.{os.getpid()}.tmp'
+    if isinstance(src, (str, os.PathLike)):
+        shutil.copyfile(src, tmp)
+    else:
+        with open(tmp, 'wb') as fh:
+            fh.write(src.getvalue())
+    os.replace(tmp, dst)
+
+
+def _restore_cached_report(cache_dir, key, out, data_out=None):
+    """คัดลอกรายงาน (และไฟล์ข้อมูลถ้าขอ) จากแคช -> True ถ้าพบในแคช"""
+    base = os.path.join(cache_dir, key)
+    if not os.path.exists(base + '.xlsx') or (data_out and not os.path.exists(base + '.json')):
+        return False
+    _copy_artifact(base + '.xlsx', out)
+    if data_out:
+        for suffix in REPORT_DATA_SUFFIXES:
+            if os.path.exists(base + suffix):
+                _copy_artifact(base + suffix, data_out + suffix)
+    return True
+
+
+def _store_cached_report(cache_dir, key, out, data_out=None):
+    os.makedirs(cache_dir, exist_ok=True)
+    base = os.path.join(cache_dir, key)
+    if data_out:
+        for suffix in REPORT_DATA_SUFFIXES:
+            if os.path.exists(data_out + suffix):
+                _store_artifact(data_out + suffix, base + suffix)
+    # xlsx เขียนหลังสุด: มี .xlsx ในแคช = ไฟล์ข้อมูลครบแล้ว
+    _store_artifact(out, base + '.xlsx')
+
+
+def generate_report(file_a, file_b, run_date=None, out=None, lot_ledger=None, appendix_days=None,
+                    data_out=None, cache_dir=None, clock=None, parse_cache=None, layout_cache=None,
+                    window_days=None):
+    """สร้างรายงานจากไฟล์กะ A และ B แล้วคืน path ของไฟล์ที่เขียน
+
+    file_a/file_b: path ของไฟล์ .xlsx/.csv (.gz/.zip ได้), tuple (ชื่อไฟล์, bytes) หรือ SheetMirror (ดู pull_sheet)
+        หรือ list ของไฟล์กะเดียวกันหลายไฟล์ (เช่น sheet ปัจจุบัน + backup) ซึ่งจะรวมและตัดแถวซ้ำให้
+    run_date: วันที่ออกรายงาน (None = วันนี้); ถ้ากำหนด จะไม่ใช้แถวที่บันทึกหลังวันนั้น
+    out: path ไฟล์ผลลัพธ์ หรือ file object เช่น BytesIO (None = ตั้งชื่อตามเวลาปัจจุบันในโฟลเดอร์ที่รันอยู่)
+    lot_ledger: path ไฟล์ SQLite หรือ LotLedger สำหรับจอง Lot.No ถาวร (None = นับ 01 ใหม่ทุกครั้ง)
+    appendix_days: แนบข้อมูลดิบกะ A/B ย้อนหลัง N วัน (นับรวมวันออกรายงาน) เป็น sheet ภาคผนวก
+    data_out: prefix ของไฟล์ข้อมูลสำหรับ dashboard (<prefix>.json, <prefix>_*.parquet) ดู write_report_data
+    cache_dir: โฟลเดอร์แคชรายงาน (ดู report_cache_key); คำขอซ้ำได้ไฟล์จากแคชทันที
+    clock: ฟังก์ชันคืน datetime ปัจจุบัน ใช้แทนเวลาจริงเมื่อไม่กำหนด run_date
+    parse_cache: path โฟลเดอร์ หรือ ParseCache สำหรับเก็บผลอ่านไฟล์กะ A/B (อัพโหลดไฟล์เดิมซ้ำไม่ต้อง parse)
+    layout_cache: path ไฟล์ JSON หรือ LayoutCache สำหรับจำตำแหน่งหัวตารางของ layout ที่เคยพบ
+    window_days: ใช้เฉพาะแถวที่บันทึกใน N วันล่าสุด (นับรวมวันออกรายงาน); เครื่องที่ไม่มีบันทึกในช่วงนี้จะว่าง
+    """
+    if run_date is not None:
+        run_date = _resolve_run_date(run_date)
+    if isinstance(lot_ledger, str):
+        lot_ledger = LotLedger(lot_ledger)
+    if isinstance(parse_cache, str):
+        parse_cache = ParseCache(parse_cache)
+    if isinstance(layout_cache, str):
+        layout_cache = LayoutCache(layout_cache)
+    if out is None:
+        out = default_output_filename(_resolve_run_date(None, clock))
+    sources = [
+        [_load_source(s) for s in src] if isinstance(src, list) else _load_source(src)
+        for src in (file_a, file_b)
+    ]
+    cache_key = None
+    if cache_dir:
+        cache_key = report_cache_key(
+            sources, run_date, clock, appendix_days=appendix_days, window_days=window_days,
+            lot_ledger=os.path.abspath(lot_ledger.path) if lot_ledger is not None else None,
+        )
+        if _restore_cached_report(cache_dir, cache_key, out, data_out):
+            print(f"[ใช้รายงานจากแคช] {cache_key[:16]}")
+            return out
+    # ภาคผนวกเขียนระหว่างอ่านไฟล์ จึงต้องเปิด Workbook ก่อน (constant_memory: เขียนทีละแถว)
+    wb, ws = open_report_workbook(out, constant_memory=bool(appendix_days))
+    appendices = []
+    if appendix_days:
+        day_end = _day_end(_resolve_run_date(run_date, clock))
+        day_start = day_end - pd.Timedelta(days=appendix_days)
+        appendices = [
+            AppendixSheet(wb, f"ข้อมูลดิบ กะ {shift}", day_start, day_end) for shift in ('A', 'B')
+        ]
+    latest_a, latest_b = _read_latest_rows(
+        *sources, run_date, appendices, parse_cache, layout_cache, window_days, clock
+    )
+    primary_df, extra_df = build_report_frames(
+        latest_a, latest_b, run_date=run_date, ledger=lot_ledger, clock=clock,
+    )
+    write_report_sheet(wb, ws, primary_df, extra_df, run_date=run_date, clock=clock)
+    wb.close()
+    if data_out:
+        write_report_data(data_out, report_data_frames(primary_df, extra_df),
+                          run_date=_resolve_run_date(run_date, clock))
+    if cache_key:
+        _store_cached_report(cache_dir, cache_key, out, data_out)
+    return out
+
+
+def generate_report_data(file_a, file_b, run_date=None, lot_ledger=None, clock=None, parse_cache=None,
+                         layout_cache=None, window_days=None):
+    """คำนวณข้อมูลรายงานโดยไม่สร้าง xlsx -> dict ของ DataFrame (ดู report_data_frames)"""
+    if run_date is not None:
+        run_date = _resolve_run_date(run_date)
+    if isinstance(lot_ledger, str):
+        lot_ledger = LotLedger(lot_ledger)
+    if isinstance(parse_cache, str):
+        parse_cache = ParseCache(parse_cache)
+    if isinstance(layout_cache, str):
+        layout_cache = LayoutCache(layout_cache)
+    latest_a, latest_b = _read_latest_rows(
+        file_a, file_b, run_date, parse_cache=parse_cache, layout_cache=layout_cache,
+        window_days=window_days, clock=clock,
+    )
+    primary_df, extra_df = build_report_frames(
+        latest_a, latest_b, run_date=run_date, ledger=lot_ledger, clock=clock,
+    )
+    return report_data_frames(primary_df, extra_df)
+
+
+def generate_report_buffer(file_a, file_b, run_date=None, **kwargs):
+    """สร้างรายงานในหน่วยความจำ คืน BytesIO (ตำแหน่งอ่านอยู่ต้นไฟล์) ไม่เขียนลงดิสก์"""
+    buf = io.BytesIO()
+    generate_report(file_a, file_b, run_date=run_date, out=buf, **kwargs)
+    buf.seek(0)
+    return buf
+
+
+# -------------------------------------------------------------
+# โหมด batch: สร้างรายงานทุกวันจากโฟลเดอร์ไฟล์ export รายวัน
+# -------------------------------------------------------------
+
+# ชื่อไฟล์ต้องมีกะ (เช่น "กะA", "shift_B", "report A") และวันที่ (เช่น 17-09-2568, 2025-09-17)
+_SHIFT_IN_NAME = re.compile(r'(?:กะ|shift|report)\s*[_-]?\s*([AB])(?![A-Za-z])', re.IGNORECASE)
+_DATE_IN_NAME = [
+    (re.compile(r'(\d{4})[-_.](\d{1,2})[-_.](\d{1,2})'), ('y', 'm', 'd')),
+    (re.compile(r'(\d{1,2})[-_.](\d{1,2})[-_.](\d{4})'), ('d', 'm', 'y')),
+]
+
+
+def _parse_export_name(filename):
+    """ดึง (วันที่, กะ) จากชื่อไฟล์ export; ถ้าไม่ครบคืน None"""
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    m_shift = _SHIFT_IN_NAME.search(stem)
+    if not m_shift:
+        return None
+    for regex, order in _DATE_IN_NAME:
+        m_date = regex.search(stem)
+        if not m_date:
+            continue
+        parts = dict(zip(order, (int(g) for g in m_date.groups())))
+        if parts['y'] > 2400:
+            parts['y'] -= 543
+        try:
+            day = datetime(parts['y'], parts['m'], parts['d']).date()
+        except ValueError:
+            continue
+        return day, m_shift.group(1).upper()
+    return None
+
+
+def scan_daily_exports(folder):
+    """จับคู่ไฟล์กะ A/B ในโฟลเดอร์ตามวันที่ -> {date: {'A': [path, ...], 'B': [path, ...]}}
+    ไฟล์กะเดียวกันวันเดียวกันหลายไฟล์ (เช่น export + backup) จะถูกรวมตอนสร้างรายงาน
+    """
+    pairs = {}
+    for name in sorted(os.listdir(folder)):
+        if os.path.splitext(name)[1].lower() not in ('.xlsx', '.csv', '.gz', '.zip'):
+            continue
+        parsed = _parse_export_name(name)
+        if parsed is None:
+            print(f"[ข้ามไฟล์] {name} : ไม่พบกะ/วันที่ในชื่อไฟล์")
+            continue
+        day, shift = parsed
+        pairs.setdefault(day, {}).setdefault(shift, []).append(os.path.join(folder, name))
+    return pairs
+
+
+def _batch_worker(day, file_a, file_b, out_dir, lot_ledger=None, appendix_days=None, with_data=False,
+                  cache_dir=None, parse_cache=None, layout_cache=None, window_days=None):
+    out = os.path.join(out_dir, default_output_filename(day, with_time=False))
+    return generate_report(
+        file_a, file_b, run_date=day, out=out, lot_ledger=lot_ledger, appendix_days=appendix_days,
+        data_out=os.path.splitext(out)[0] if with_data else None, cache_dir=cache_dir,
+        parse_cache=parse_cache, layout_cache=layout_cache, window_days=window_days,
+    )
+
+
+def run_batch(folder, out_dir=None, jobs=None, lot_ledger=None, appendix_days=None, with_data=False,
+              cache_dir=None, parse_cache=None, layout_cache=None, window_days=None):
+    """สร้างรายงานของทุกวันในโฟลเดอร์แบบขนานด้วย process pool; คืน {date: path หรือ Exception}
+
+    with_data: เขียนไฟล์ข้อมูล JSON/Parquet ชื่อเดียวกับรายงานไว้คู่กันด้วย
+    """
+    out_dir = out_dir or folder
+    os.makedirs(out_dir, exist_ok=True)
+    pairs = scan_daily_exports(folder)
+    results = {}
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {}
+        for day, slot in sorted(pairs.items()):
+            if 'A' not in slot or 'B' not in slot:
+                missing = 'A' if 'A' not in slot else 'B'
+                print(f"[ข้ามวันที่] {day} : ไม่พบไฟล์กะ {missing}")
+                continue
+            futures[pool.submit(
+                _batch_worker, day, slot['A'], slot['B'], out_dir, lot_ledger, appendix_days, with_data,
+                cache_dir, parse_cache, layout_cache, window_days,
+            )] = day
+        for fut in as_completed(futures):
+            day = futures[fut]
+            try:
+                results[day] = fut.result()
+                print(f"[เสร็จ] {day} -> {results[day]}")
+            except Exception as e:
+                results[day] = e
+                print(f"[ล้มเหลว] {day} : {e}")
+    return results
+
+
+# -------------------------------------------------------------
+# ดึงข้อมูลจาก Google Sheets (แผนกผลิต2_กะA/B ที่ apps-script-A/B-COMPLETE.js เขียน) แบบเฉพาะแถวใหม่
+# -------------------------------------------------------------
+
+SHEETS_API_URL = 'https://sheets.googleapis.com'
+# (spreadsheet id, ชื่อ sheet) ของแต่ละกะ ตาม CONFIG ใน apps-script-A/B-COMPLETE.js
+SHEETS_SOURCES = {
+    'A': ('1K9e_VNW34yF_nVFCXW3v6W8v7FAt33Gr9xnuwCHBadc', 'แผนกผลิต2_กะA'),
+    'B': ('1ZhDdKmzZSK0koExN2u_JsiF_SLAOanYyGtuewNAkFYU', 'แผนกผลิต2_กะB'),
+}
+# ขนาดช่วงแถวต่อ range และจำนวน range ต่อคำขอ values:batchGet
+SHEETS_BLOCK_ROWS = 2000
+SHEETS_BLOCKS_PER_REQUEST = 5
+
+
+def _a1_range(sheet_name, first_row, last_row, width=EXPECTED_COLUMN_COUNT_AB):
+    quoted = "'" + sheet_name.replace("'", "''") + "'"
+    return f"{quoted}!A{first_row}:{xl_col_to_name(width - 1)}{last_row}"
+
+
+class SheetsClient:
+    """อ่านค่าจาก Google Sheets API v4 (values:batchGet) ผ่าน HTTP connection เดียวที่เปิดค้างไว้ (keep-alive)
+
+    base_url: SHEETS_API_URL หรือ URL ของ fake-sheets ในเครื่อง
+    api_key: API key (sheet ที่เปิดให้อ่านได้), token: OAuth access token (sheet ส่วนตัว)
+    """
+
+    def __init__(self, base_url=SHEETS_API_URL, api_key=None, token=None, timeout=30.0):
+        parts = urlsplit(base_url)
+        self._connection_class = HTTPSConnection if parts.scheme == 'https' else HTTPConnection
+        self._host = parts.netloc
+        self._prefix = parts.path.rstrip('/')
+        self.api_key = api_key
+        self.token = token
+        self.timeout = timeout
+        self._conn = None
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _get(self, path, params):
+        if self.api_key:
+            params = params + [('key', self.api_key)]
+        url = f"{self._prefix}{path}?{urlencode(params, quote_via=quote)}"
+        headers = {'Accept': 'application/json'}
+        if self.token:
+            headers['Authorization'] = f'Bearer {self.token}'
+        # connection ที่ค้างไว้อาจถูกปลายทางปิดไปแล้ว: เปิดใหม่แล้วลองอีกครั้งเดียว
+        for attempt in range(2):
+            if self._conn is None:
+                self._conn = self._connection_class(self._host, timeout=self.timeout)
+            try:
+                self._conn.request('GET', url, headers=headers)
+                resp = self._conn.getresponse()
+                body = resp.read()
+                break
+            except (ConnectionError, http.client.RemoteDisconnected, http.client.CannotSendRequest):
+                self.close()
+                if attempt:
+                    raise
+        if resp.status != 200:
+            try:
+                message = json.loads(body)['error']['message']
+            except (ValueError, KeyError, TypeError):
+                message = body[:200].decode('utf-8', 'replace')
+            raise RuntimeError(f"Sheets API ตอบ {resp.status}: {message}")
+        return json.loads(body)
+
+    def batch_get(self, spreadsheet_id, ranges):
+        """ค่าของแต่ละ range (FORMATTED_VALUE แบบเดียวกับไฟล์ CSV ที่ export จาก Sheets) -> [[แถว, ...], ...]"""
+        data = self._get(
+            f"/v4/spreadsheets/{quote(spreadsheet_id, safe='')}/values:batchGet",
+            [('ranges', r) for r in ranges] + [('majorDimension', 'ROWS'),
+                                                ('valueRenderOption', 'FORMATTED_VALUE')],
+        )
+        return [vr.get('values', []) for vr in data.get('valueRanges', [])]
+
+
+def _sheet_rows_frame(rows, width=EXPECTED_COLUMN_COUNT_AB):
+    """แถวจาก Sheets API (ตัดช่องว่างท้ายแถวมาแล้ว) -> DataFrame ข้อความแบบเดียวกับอ่าน CSV (ช่องว่าง = NaN)"""
+    padded = [list(row[:width]) + [''] * (width - len(row)) for row in rows]
+    df = pd.DataFrame(padded, columns=range(width), dtype='str')
+    return df.replace('', np.nan)
+
+
+class SheetMirror:
+    """สำเนาในเครื่องของ sheet กะ A/B: ดึงเฉพาะแถวที่ต่อจากที่เคยดึง แล้วต่อท้ายในแคชผลอ่านไฟล์
+
+    เก็บใน <parse_cache>/sheets/<spreadsheet id>_<hash ชื่อ sheet>/ เป็น part-NNNNNN.parquet (รูปแบบเดียวกับ
+    ParseCache) และ state.json (แถวถัดไปที่ต้องอ่าน, ค่าของแถวหัวตารางและแถวสุดท้ายที่ดึงแล้ว)
+    ตำแหน่งอ่านต่อใช้เลขแถวของ sheet: 'ลำดับชุดข้อมูลที่' นับใหม่ทุกครั้งที่บันทึก จึงใช้ระบุแถวใหม่ไม่ได้
+    ใช้เป็นไฟล์กะ A/B ของ generate_report ได้โดยตรง (หรือใน list รวมกับไฟล์ export)
+    """
+
+    def __init__(self, parse_cache, spreadsheet_id, sheet_name):
+        root = parse_cache.path if isinstance(parse_cache, ParseCache) else parse_cache
+        sheet_hash = hashlib.sha256(sheet_name.encode('utf-8')).hexdigest()[:12]
+        self.path = os.path.join(root, 'sheets', f'{spreadsheet_id}_{sheet_hash}')
+        self.spreadsheet_id = spreadsheet_id
+        self.sheet_name = sheet_name
+        # part ของ sheet ต้องอยู่ครบ: ไม่ลบตามขนาดแบบแคชทั่วไป
+        self.parts = ParseCache(self.path, max_bytes=float('inf'))
+        try:
+            with open(self._state_file, encoding='utf-8') as fh:
+                self.state = json.load(fh)
+        except (FileNotFoundError, ValueError):
+            self.state = self._empty_state()
+
+    @property
+    def _state_file(self):
+        return os.path.join(self.path, 'state.json')
+
+    @staticmethod
+    def _empty_state():
+        return {'next_row': 1, 'header_idx': None, 'col_map': {}, 'header': None, 'parts': 0, 'rows': 0,
+                'last': None}
+
+    def _save_state(self):
+        tmp = f'{self._state_file}.{os.getpid()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as fh:
+            json.dump(self.state, fh, ensure_ascii=False, indent=1)
+        os.replace(tmp, self._state_file)
+
+    def reset(self):
+        """ลบสำเนาทั้งหมด (ครั้งถัดไปดึงใหม่ทั้ง sheet)"""
+        for name in os.listdir(self.path):
+            if name.startswith('part-') or name == 'state.json':
+                os.remove(os.path.join(self.path, name))
+        self.state = self._empty_state()
+
+    def digest(self):
+        """hash ของข้อมูลในสำเนา (ใช้แทน hash ของเนื้อไฟล์ใน key ของรายงาน)"""
+        payload = [self.spreadsheet_id, self.sheet_name, self.state['rows'], self.state['last']]
+        return hashlib.sha256(json.dumps(payload, ensure_ascii=False).encode('utf-8')).digest()
+
+    def pull(self, client, block_rows=SHEETS_BLOCK_ROWS, blocks_per_request=SHEETS_BLOCKS_PER_REQUEST):
+        """ดึงแถวที่ต่อจากแถวสุดท้ายที่เคยดึงด้วย values:batchGet ทีละหลาย range -> จำนวนแถวข้อมูลใหม่
+
+        คำขอแรกอ่านแถวหัวตารางและแถวสุดท้ายที่เคยดึงซ้ำด้วย: ถ้าค่าไม่ตรง (หัวตารางถูกแก้ หรือแถวก่อนหน้าถูกลบ/แทรก
+        ทำให้แถวเลื่อน) ล้างสำเนาแล้วดึงใหม่ทั้ง sheet; แถวกลาง sheet ที่ถูกแก้ค่าในที่เดิมตรวจไม่พบ ให้เรียก reset()
+        แถวใหม่ทั้งหมดของการดึงหนึ่งครั้งเขียนเป็น part เดียว; ล้มเหลวกลางทาง = ไม่บันทึกอะไรเลย
+        """
+        state = dict(self.state)
+        checks = [c for c in (state.get('header'), state['last']) if c is not None]
+        row = state['next_row']
+        new_rows = 0
+        part_key = f"part-{state['parts'] + 1:06d}"
+        meta = {'spreadsheet_id': self.spreadsheet_id, 'sheet_name': self.sheet_name}
+        with self.parts.writer(part_key, meta) as write:
+            while True:
+                ranges = [
+                    _a1_range(self.sheet_name, row + k * block_rows, row + (k + 1) * block_rows - 1)
+                    for k in range(blocks_per_request)
+                ]
+                ranges = [_a1_range(self.sheet_name, c['row'], c['row']) for c in checks] + ranges
+                blocks = client.batch_get(self.spreadsheet_id, ranges)
+                if checks:
+                    seen, blocks = blocks[:len(checks)], blocks[len(checks):]
+                    changed = [c['row'] for c, block in zip(checks, seen)
+                               if (block[0] if block else []) != c['cells']]
+                    if changed:
+                        print(f"[sheet เปลี่ยน] {self.sheet_name}: แถวที่ {changed[0]} ไม่ตรงกับที่ดึงไว้ ดึงใหม่ทั้ง sheet")
+                        break
+                    checks = []
+                rows = []
+                at_end = False
+                for block in blocks:
+                    rows.extend(block)
+                    if len(block) < block_rows:
+                        at_end = True
+                        break
+                first_row, row = row, row + len(rows)
+                for offset in range(len(rows) - 1, -1, -1):
+                    if rows[offset]:
+                        state['last'] = {'row': first_row + offset, 'cells': rows[offset]}
+                        break
+                if state['header_idx'] is None and rows:
+                    header_idx, col_map = detect_header(_sheet_rows_frame(rows[:HEADER_SCAN_ROWS]))
+                    state['header_idx'], state['col_map'] = header_idx, col_map
+                    if header_idx != -1:
+                        state['header'] = {'row': first_row + header_idx, 'cells': rows[header_idx]}
+                    # ลำดับแถวใน sheet เริ่มที่ 1: ข้ามแถวจนถึงหัวตาราง
+                    rows = rows[header_idx + 1:]
+                if rows:
+                    df = _sheet_rows_frame(rows)
+                    df = _label_chunk(df, list(df.columns), RAW_COLUMNS_AB[:df.shape[1]])
+                    df = df.dropna(subset=['วันที่', 'เครื่องทอ NO'])
+                    if not df.empty:
+                        write(df.reset_index(drop=True))
+                        new_rows += len(df)
+                if at_end:
+                    break
+        if checks:
+            self.reset()
+            return self.pull(client, block_rows, blocks_per_request)
+        state['next_row'] = row
+        if new_rows:
+            state['parts'] += 1
+            state['rows'] += new_rows
+        self.state = state
+        self._save_state()
+        return new_rows
+
+    def iter_chunks(self, columns=None, date_window=None, chunksize=READ_CHUNK_ROWS):
+        """chunk ของแถวในสำเนาตามลำดับใน sheet (เลือกคอลัมน์/ช่วงวันที่แบบเดียวกับ iter_generic_chunks)"""
+        if columns is not None:
+            columns = set(columns) | {'วันที่', 'เครื่องทอ NO'}
+        for n in range(1, self.state['parts'] + 1):
+            df = self.parts.load(f'part-{n:06d}', columns=columns, date_window=date_window)
+            if df is None:
+                raise FileNotFoundError(f"สำเนา sheet {self.sheet_name} ไม่ครบ (ไม่พบ part {n}) ลบ {self.path} แล้วดึงใหม่")
+            for start in range(0, len(df), chunksize):
+                yield _select_rows(df.iloc[start:start + chunksize], columns).reset_index(drop=True)
+
+
+def pull_sheet(parse_cache, spreadsheet_id, sheet_name, client=None, **client_options):
+    """ดึงแถวใหม่ของ sheet ลงสำเนาในแคชผลอ่านไฟล์ -> SheetMirror (client=None เปิด SheetsClient ใหม่)"""
+    mirror = SheetMirror(parse_cache, spreadsheet_id, sheet_name)
+    own_client = client is None
+    client = client or SheetsClient(**client_options)
+    try:
+        new_rows = mirror.pull(client)
+    finally:
+        if own_client:
+            client.close()
+    print(f"[ดึง sheet] {sheet_name}: แถวใหม่ {new_rows} แถว (รวม {mirror.state['rows']} แถว)")
+    return mirror
+
+
+# -------------------------------------------------------------
+# โหมด serve: บริการ HTTP ในเครื่อง (หน้า upload-module และโปรแกรมอื่นเรียกสร้างรายงาน)
+# -------------------------------------------------------------
+
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+XLSX_MIME = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+def _parse_multipart(content_type, body):
+    """แยกฟอร์ม multipart/form-data -> {ชื่อฟิลด์: [(ชื่อไฟล์ หรือ None, bytes), ...]} (ฟิลด์ชื่อซ้ำได้หลายค่า)"""
+    msg = BytesParser(policy=email_policy.HTTP).parsebytes(
+        b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + body
+    )
+    if not msg.is_multipart():
+        raise ValueError("ต้องส่งแบบ multipart/form-data")
+    fields = {}
+    for part in msg.iter_parts():
+        name = part.get_param('name', header='content-disposition')
+        if name:
+            fields.setdefault(name, []).append((part.get_filename(), part.get_payload(decode=True) or b''))
+    return fields
+
+
+def _report_bytes_worker(file_a, file_b, run_date, cache_dir=None, parse_cache=None, layout_cache=None):
+    return generate_report_buffer(
+        file_a, file_b, run_date=run_date, cache_dir=cache_dir, parse_cache=parse_cache,
+        layout_cache=layout_cache,
+    ).getvalue()
+
+
+def _report_json_worker(file_a, file_b, run_date, cache_dir=None, parse_cache=None, layout_cache=None):
+    # แคชรายงานเก็บเฉพาะไฟล์ xlsx; JSON คำนวณใหม่ทุกครั้ง (ไม่สร้าง workbook จึงเร็วอยู่แล้ว)
+    frames = generate_report_data(
+        file_a, file_b, run_date=run_date, parse_cache=parse_cache, layout_cache=layout_cache
+    )
+    return report_data_json(frames, run_date=run_date).encode('utf-8')
+
+
+class ReportRequestHandler(BaseHTTPRequestHandler):
+    """POST /report (ฟิลด์ A, B ส่งซ้ำได้หลายไฟล์ต่อกะ และ C ที่ไม่บังคับ, date=YYYY-MM-DD) -> ไฟล์ xlsx
+    POST /report.json (ฟิลด์เดียวกัน) -> ข้อมูลที่คำนวณแล้วเป็น JSON (report_data_json); GET /health
+    """
+    server_version = 'PD2Report/1.0'
+
+    def _send(self, status, body, content_type='text/plain; charset=utf-8', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_OPTIONS(self):
+        self._send(204, b'', headers={
+            'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+            'Access-Control-Allow-Headers': 'Content-Type',
+        })
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/health':
+            self._send(200, b'ok')
+        else:
+            self._send(404, b'not found')
+
+    def do_POST(self):
+        route = self.path.split('?')[0].rstrip('/')
+        if route not in ('/report', '/report.json'):
+            return self._send(404, b'not found')
+        if self.headers.get('Content-Length') is None:
+            return self._send(411, "ต้องระบุ Content-Length ของข้อมูลที่ส่งมา".encode('utf-8'))
+        try:
+            length = int(self.headers['Content-Length'])
+        except ValueError:
+            length = -1
+        if length <= 0:
+            return self._send(400, "ไม่มีข้อมูลที่ส่งมา (ต้องส่งไฟล์กะ A และ B แบบ multipart/form-data)".encode('utf-8'))
+        if length > MAX_UPLOAD_BYTES:
+            return self._send(413, f"ขนาดไฟล์ต้องไม่เกิน {MAX_UPLOAD_BYTES} bytes".encode('utf-8'))
+        body = self.rfile.read(length)
+        try:
+            fields = _parse_multipart(self.headers.get('Content-Type', ''), body)
+            if 'A' not in fields or 'B' not in fields:
+                raise ValueError("ต้องมีไฟล์กะ A และ B (ฟิลด์ A, B)")
+            if 'C' in fields:
+                # ไฟล์เสริม C ของหน้า upload-module ยังไม่มีส่วนที่ใช้ในรายงานนี้
+                self.log_message("ignored optional file C (%s)", fields['C'][0][0])
+            # ส่งฟิลด์ A/B ซ้ำได้หลายไฟล์ต่อกะ (รวมและตัดแถวซ้ำตอนสร้างรายงาน)
+            sources = [
+                [(filename or f'{k}.xlsx', data) for filename, data in fields[k]] for k in ('A', 'B')
+            ]
+            run_date = fields['date'][0][1].decode('utf-8').strip() if 'date' in fields else None
+            run_date = _resolve_run_date(run_date or None)
+        except ValueError as e:
+            return self._send(400, str(e).encode('utf-8'))
+        if not self.server.slots.acquire(blocking=False):
+            return self._send(503, "เครื่องกำลังสร้างรายงานเต็มคิว ลองใหม่อีกครั้ง".encode('utf-8'))
+        try:
+            worker = _report_json_worker if route == '/report.json' else _report_bytes_worker
+            data = self.server.pool.submit(
+                worker, *sources, run_date,
+                self.server.cache_dir, self.server.parse_cache, self.server.layout_cache,
+            ).result()
+        except ValueError as e:
+            return self._send(400, str(e).encode('utf-8'))
+        except Exception as e:
+            return self._send(500, f"สร้างรายงานไม่สำเร็จ: {e}".encode('utf-8'))
+        finally:
+            self.server.slots.release()
+        if route == '/report.json':
+            return self._send(200, data, 'application/json; charset=utf-8')
+        filename = default_output_filename(run_date)
+        self._send(200, data, XLSX_MIME, headers={
+            'Content-Disposition': f"attachment; filename*=UTF-8''{quote(filename)}",
+        })
+
+
+def serve_reports(host='127.0.0.1', port=8765, jobs=None, queue_size=None, cache_dir=None,
+                  parse_cache=None, layout_cache=None):
+    """เปิดบริการ HTTP สร้างรายงาน; process pool เตรียมไว้ล่วงหน้า (ไลบรารีโหลดครั้งเดียว)
+
+    jobs: จำนวน process สร้างรายงาน; queue_size: จำนวนคำขอที่รับพร้อมกันสูงสุด (เกินตอบ 503)
+    cache_dir: โฟลเดอร์แคชรายงาน (กดสร้างซ้ำด้วยไฟล์ชุดเดิมได้ผลทันที)
+    parse_cache: โฟลเดอร์แคชผลอ่านไฟล์ (ไฟล์สะสมเดิมที่อัพโหลดซ้ำไม่ต้อง parse ใหม่)
+    layout_cache: ไฟล์ JSON ทะเบียน layout ของไฟล์ export (ข้ามการหาหัวตาราง)
+    """
+    jobs = jobs or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        # เริ่ม worker ทุกตัวก่อนรับคำขอแรก
+        for fut in [pool.submit(int) for _ in range(jobs)]:
+            fut.result()
+        server = ThreadingHTTPServer((host, port), ReportRequestHandler)
+        server.pool = pool
+        server.slots = threading.BoundedSemaphore(queue_size or jobs * 2)
+        server.cache_dir = cache_dir
+        server.parse_cache = parse_cache
+        server.layout_cache = layout_cache
+        print(f"บริการสร้างรายงานพร้อมที่ http://{host}:{server.server_port}/report")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+
+# -------------------------------------------------------------
+# โหมด fake-sheets: Sheets API v4 จำลองในเครื่อง (ทดสอบการดึงแถวใหม่แบบ offline)
+# -------------------------------------------------------------
+
+_A1_SHEET = re.compile(r"^(?:'((?:[^']|'')+)'|([^'!]+))(?:!(.*))?$")
+_A1_CELLS = re.compile(r"^([A-Z]+)(\d+):([A-Z]+)(\d+)$")
+
+
+def _sheet_cell(v):
+    # ค่าแบบ FORMATTED_VALUE: ทุกช่องเป็นข้อความ, ช่องว่าง = ''
+    if v is None or (isinstance(v, float) and np.isnan(v)):
+        return ''
+    return str(_xlsx_cell(v))
+
+
+def export_sheet_values(file_content, filename):
+    """แถวทั้งหมดของไฟล์ export (รวมแถวหัวตาราง) เป็นข้อความแบบที่ Sheets API ส่งมา"""
+    member = _pick_export_member(file_content, filename, RAW_COLUMNS_AB)
+    if member is None:
+        return []
+    _name, ext, container = member
+    rows = []
+    for chunk in _iter_raw_chunks(file_content, ext, READ_CHUNK_ROWS, None, {}, container=container):
+        for row in chunk.itertuples(index=False):
+            cells = [_sheet_cell(v) for v in row]
+            while cells and cells[-1] == '':
+                cells.pop()
+            rows.append(cells)
+    return rows
+
+
+class FakeSheetsHandler(BaseHTTPRequestHandler):
+    """GET /v4/spreadsheets/<id>/values:batchGet?ranges=... และ POST /v4/spreadsheets/<id>/values/<range>:append
+    ข้อมูลอยู่ใน server.sheets = {spreadsheet id: {ชื่อ sheet: [แถว, ...]}}; รองรับ keep-alive (HTTP/1.1)
+    """
+    server_version = 'PD2FakeSheets/1.0'
+    protocol_version = 'HTTP/1.1'
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status, message):
+        self._send_json(status, {'error': {'code': status, 'message': message}})
+
+    def _sheet(self, spreadsheet_id, a1):
+        """(ชื่อ sheet, rows, ส่วน cell ของ range) ของ range แบบ A1; ไม่พบ sheet คืน None"""
+        m = _A1_SHEET.match(a1)
+        if not m:
+            return None
+        name = m.group(1).replace("''", "'") if m.group(1) else m.group(2)
+        rows = self.server.sheets.get(spreadsheet_id, {}).get(name)
+        if rows is None:
+            return None
+        return name, rows, m.group(3) or ''
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        m = re.fullmatch(r'/v4/spreadsheets/([^/]+)/values:batchGet', parts.path)
+        if not m:
+            return self._error(404, 'not found')
+        spreadsheet_id = unquote(m.group(1))
+        if spreadsheet_id not in self.server.sheets:
+            return self._error(404, 'Requested entity was not found.')
+        value_ranges = []
+        with self.server.lock:
+            for a1 in parse_qs(parts.query).get('ranges', []):
+                found = self._sheet(spreadsheet_id, a1)
+                cells_m = _A1_CELLS.match(found[2]) if found is not None else None
+                if cells_m is None:
+                    return self._error(400, f'Unable to parse range: {a1}')
+                rows = found[1]
+                first, last = int(cells_m.group(2)), int(cells_m.group(4))
+                first_col = xl_cell_to_rowcol(f'{cells_m.group(1)}1')[1]
+                last_col = xl_cell_to_rowcol(f'{cells_m.group(3)}1')[1]
+                values = []
+                for row in rows[first - 1:last]:
+                    cells = row[first_col:last_col + 1]
+                    while cells and cells[-1] == '':
+                        cells = cells[:-1]
+                    values.append(list(cells))
+                # เหมือน API จริง: ตัดแถวว่างท้าย range และไม่ส่ง values ถ้าว่างทั้ง range
+                while values and not values[-1]:
+                    values.pop()
+                entry = {'range': a1, 'majorDimension': 'ROWS'}
+                if values:
+                    entry['values'] = values
+                value_ranges.append(entry)
+        self._send_json(200, {'spreadsheetId': spreadsheet_id, 'valueRanges': value_ranges})
+
+    def do_POST(self):
+        parts = urlsplit(self.path)
+        m = re.fullmatch(r'/v4/spreadsheets/([^/]+)/values/(.+):append', parts.path)
+        if not m:
+            return self._error(404, 'not found')
+        spreadsheet_id, a1 = unquote(m.group(1)), unquote(m.group(2))
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            values = json.loads(self.rfile.read(length) or b'{}').get('values', [])
+        except ValueError:
+            return self._error(400, 'Invalid JSON payload received.')
+        with self.server.lock:
+            found = self._sheet(spreadsheet_id, a1)
+            if found is None:
+                return self._error(400, f'Unable to parse range: {a1}')
+            name, rows, _cells = found
+            start = len(rows) + 1
+            rows.extend([_sheet_cell(v) for v in row] for row in values)
+        self._send_json(200, {'spreadsheetId': spreadsheet_id, 'updates': {
+            'updatedRange': _a1_range(name, start, start + len(values) - 1),
+            'updatedRows': len(values),
+        }})
+
+
+def serve_fake_sheets(sheets, host='127.0.0.1', port=8780):
+    """เปิด Sheets API จำลอง; sheets = {spreadsheet id: {ชื่อ sheet: [แถว, ...]}} (แก้ไขได้ระหว่างทำงานด้วย append)"""
+    server = ThreadingHTTPServer((host, port), FakeSheetsHandler)
+    server.sheets = sheets
+    server.lock = threading.Lock()
+    print(f"Sheets API จำลองพร้อมที่ http://{host}:{server.server_port} (ใช้กับ --sheets-url)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def _sheet_spec(arg):
+    """'sheets:A', 'sheets:B' หรือ 'sheets:<spreadsheet id>/<ชื่อ sheet>' -> (spreadsheet id, ชื่อ sheet); อื่น ๆ คืน None"""
+    if not arg.startswith('sheets:'):
+        return None
+    spec = arg[len('sheets:'):]
+    if spec.upper() in SHEETS_SOURCES:
+        return SHEETS_SOURCES[spec.upper()]
+    spreadsheet_id, sep, sheet_name = spec.partition('/')
+    if not sep or not spreadsheet_id or not sheet_name:
+        raise ValueError(f"ระบุ sheet ไม่ถูกต้อง: {arg} (ใช้ sheets:A, sheets:B หรือ sheets:<id>/<ชื่อ sheet>)")
+    return spreadsheet_id, sheet_name
+
+
+def _add_sheets_options(p):
+    p.add_argument('--sheets-url', default=SHEETS_API_URL,
+                   help="URL ของ Sheets API (เช่น http://127.0.0.1:8780 ของ fake-sheets)")
+    p.add_argument('--sheets-key', default=os.environ.get('PD2_SHEETS_API_KEY'),
+                   help="API key ของ Sheets API (ค่าเริ่มต้น: ตัวแปร PD2_SHEETS_API_KEY)")
+    p.add_argument('--sheets-token', default=os.environ.get('PD2_SHEETS_TOKEN'),
+                   help="OAuth access token (ค่าเริ่มต้น: ตัวแปร PD2_SHEETS_TOKEN)")
+
+
+def _pull_sheet_args(files, parse_cache, args):
+    """แทน 'sheets:...' ใน files ด้วย SheetMirror ที่ดึงแถวใหม่แล้ว (ใช้ connection เดียวกันทุก sheet)"""
+    client = SheetsClient(args.sheets_url, api_key=args.sheets_key, token=args.sheets_token)
+    try:
+        return [
+            pull_sheet(parse_cache, *_sheet_spec(f), client=client) if _sheet_spec(f) else f
+            for f in files
+        ]
+    finally:
+        client.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="สร้างใบรายงานสรุปยอดผลิต PD2 จากไฟล์ export กะ A/B"
+    )
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_report = sub.add_parser('report', help="สร้างรายงาน 1 ฉบับจากไฟล์กะ A และ B")
+    p_report.add_argument('file_a', help="ไฟล์กะ A (.xlsx/.csv หรือ .gz/.zip) หรือ sheets:A (ดึงแถวใหม่จาก sheet ก่อน)")
+    p_report.add_argument('file_b', help="ไฟล์กะ B (.xlsx/.csv หรือ .gz/.zip) หรือ sheets:B")
+    p_report.add_argument('--add-a', action='append', default=[], metavar='FILE',
+                          help="ไฟล์กะ A เพิ่มเติม (เช่น backup จาก Drive) รวมกับ file_a และตัดแถวซ้ำ; ระบุซ้ำได้")
+    p_report.add_argument('--add-b', action='append', default=[], metavar='FILE',
+                          help="ไฟล์กะ B เพิ่มเติม รวมกับ file_b และตัดแถวซ้ำ; ระบุซ้ำได้")
+    p_report.add_argument('--date', help="วันที่ออกรายงาน YYYY-MM-DD (ค่าเริ่มต้น: วันนี้)")
+    p_report.add_argument('-o', '--out', help="path ไฟล์ผลลัพธ์")
+    p_report.add_argument('--lot-ledger', help="ไฟล์ SQLite สำหรับจอง Lot.No ถาวร (รันซ้ำได้ Lot เดิม)")
+    p_report.add_argument('--appendix-days', type=int, default=None,
+                          help="แนบข้อมูลดิบกะ A/B ย้อนหลัง N วันเป็น sheet ภาคผนวก")
+    p_report.add_argument('--data-out', help="prefix ไฟล์ข้อมูลสำหรับ dashboard (<prefix>.json, <prefix>_*.parquet)")
+    p_report.add_argument('--cache-dir', help="โฟลเดอร์แคชรายงาน (ไฟล์ชุดเดิม + วันที่เดิม ได้ไฟล์จากแคช)")
+    p_report.add_argument('--parse-cache', help="โฟลเดอร์แคชผลอ่านไฟล์กะ A/B (Parquet, ต้องมี pyarrow)")
+    p_report.add_argument('--layout-cache', help="ไฟล์ JSON จำตำแหน่งหัวตารางของ layout ไฟล์ export ที่เคยพบ")
+    p_report.add_argument('--window-days', type=int, default=None,
+                          help="ใช้เฉพาะแถวที่บันทึกใน N วันล่าสุด (ค่าเริ่มต้น: ทุกแถว)")
+    _add_sheets_options(p_report)
+    p_batch = sub.add_parser('batch', help="สร้างรายงานทุกวันจากโฟลเดอร์ไฟล์ export รายวัน")
+    p_batch.add_argument('folder', help="โฟลเดอร์ที่มีไฟล์กะ A/B (ชื่อไฟล์มีกะและวันที่)")
+    p_batch.add_argument('-o', '--out-dir', help="โฟลเดอร์เก็บรายงาน (ค่าเริ่มต้น: โฟลเดอร์เดียวกับไฟล์)")
+    p_batch.add_argument('-j', '--jobs', type=int, default=None, help="จำนวน process (ค่าเริ่มต้น: จำนวน CPU)")
+    p_batch.add_argument('--lot-ledger', help="ไฟล์ SQLite สำหรับจอง Lot.No ถาวร (ใช้ร่วมกันทุก process)")
+    p_batch.add_argument('--appendix-days', type=int, default=None,
+                         help="แนบข้อมูลดิบกะ A/B ย้อนหลัง N วันเป็น sheet ภาคผนวก")
+    p_batch.add_argument('--data', action='store_true',
+                         help="เขียนไฟล์ข้อมูล JSON/Parquet คู่กับรายงานแต่ละวัน")
+    p_batch.add_argument('--cache-dir', help="โฟลเดอร์แคชรายงาน (ใช้ร่วมกันทุก process)")
+    p_batch.add_argument('--parse-cache', help="โฟลเดอร์แคชผลอ่านไฟล์กะ A/B (Parquet, ต้องมี pyarrow)")
+    p_batch.add_argument('--layout-cache', help="ไฟล์ JSON จำตำแหน่งหัวตารางของ layout ไฟล์ export ที่เคยพบ")
+    p_batch.add_argument('--window-days', type=int, default=None,
+                         help="ใช้เฉพาะแถวที่บันทึกใน N วันล่าสุดของแต่ละวัน (ค่าเริ่มต้น: ทุกแถว)")
+    p_serve = sub.add_parser('serve', help="เปิดบริการ HTTP สร้างรายงาน (POST /report)")
+    p_serve.add_argument('--host', default='127.0.0.1', help="ที่อยู่ที่รับคำขอ (ค่าเริ่มต้น: 127.0.0.1)")
+    p_serve.add_argument('--port', type=int, default=8765, help="พอร์ต (ค่าเริ่มต้น: 8765)")
+    p_serve.add_argument('-j', '--jobs', type=int, default=None, help="จำนวน process (ค่าเริ่มต้น: จำนวน CPU)")
+    p_serve.add_argument('--cache-dir', help="โฟลเดอร์แคชรายงาน")
+    p_serve.add_argument('--parse-cache', help="โฟลเดอร์แคชผลอ่านไฟล์กะ A/B (Parquet, ต้องมี pyarrow)")
+    p_serve.add_argument('--layout-cache', help="ไฟล์ JSON จำตำแหน่งหัวตารางของ layout ไฟล์ export ที่เคยพบ")
+    p_pull = sub.add_parser('pull', help="ดึงแถวใหม่จาก Google Sheets กะ A/B ลงแคชผลอ่านไฟล์")
+    p_pull.add_argument('sheets', nargs='*', default=['sheets:A', 'sheets:B'],
+                        help="sheets:A, sheets:B หรือ sheets:<id>/<ชื่อ sheet> (ค่าเริ่มต้น: ทั้งสองกะ)")
+    p_pull.add_argument('--parse-cache', required=True, help="โฟลเดอร์แคชผลอ่านไฟล์ (เก็บสำเนา sheet)")
+    _add_sheets_options(p_pull)
+    p_fake = sub.add_parser('fake-sheets', help="เปิด Sheets API จำลองจากไฟล์ export กะ A/B (ทดสอบ offline)")
+    p_fake.add_argument('file_a', help="ไฟล์กะ A ที่ใช้เป็นเนื้อหา sheet แผนกผลิต2_กะA")
+    p_fake.add_argument('file_b', help="ไฟล์กะ B ที่ใช้เป็นเนื้อหา sheet แผนกผลิต2_กะB")
+    p_fake.add_argument('--host', default='127.0.0.1', help="ที่อยู่ที่รับคำขอ (ค่าเริ่มต้น: 127.0.0.1)")
+    p_fake.add_argument('--port', type=int, default=8780, help="พอร์ต (ค่าเริ่มต้น: 8780)")
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        serve_reports(args.host, args.port, jobs=args.jobs, cache_dir=args.cache_dir,
+                      parse_cache=args.parse_cache, layout_cache=args.layout_cache)
+        return 0
+    if args.command == 'fake-sheets':
+        sheets = {}
+        for shift, path in (('A', args.file_a), ('B', args.file_b)):
+            spreadsheet_id, sheet_name = SHEETS_SOURCES[shift]
+            name, content = _load_source(path)
+            sheets.setdefault(spreadsheet_id, {})[sheet_name] = export_sheet_values(content, name)
+        serve_fake_sheets(sheets, args.host, args.port)
+        return 0
+    if args.command == 'pull':
+        for arg in args.sheets:
+            if _sheet_spec(arg) is None:
+                parser.error(f"ระบุ sheet ไม่ถูกต้อง: {arg}")
+        _pull_sheet_args(args.sheets, args.parse_cache, args)
+        return 0
+    if args.command == 'report':
+        files_a, files_b = [args.file_a] + args.add_a, [args.file_b] + args.add_b
+        if any(_sheet_spec(f) for f in files_a + files_b):
+            if not args.parse_cache:
+                parser.error("ใช้ sheets: ต้องระบุ --parse-cache (เก็บสำเนา sheet)")
+            files = _pull_sheet_args(files_a + files_b, args.parse_cache, args)
+            files_a, files_b = files[:len(files_a)], files[len(files_a):]
+        path = generate_report(
+            files_a, files_b, run_date=args.date, out=args.out,
+            lot_ledger=args.lot_ledger, appendix_days=args.appendix_days, data_out=args.data_out,
+            cache_dir=args.cache_dir, parse_cache=args.parse_cache, layout_cache=args.layout_cache,
+            window_days=args.window_days,
+        )
+        print(f"สร้างรายงานเสร็จ: {path}")
+        return 0
+    results = run_batch(
+        args.folder, out_dir=args.out_dir, jobs=args.jobs,
+        lot_ledger=args.lot_ledger, appendix_days=args.appendix_days, with_data=args.data,
+        cache_dir=args.cache_dir, parse_cache=args.parse_cache, layout_cache=args.layout_cache,
+        window_days=args.window_days,
+    )
+    failed = [d for d, r in results.items() if isinstance(r, Exception)]
+    print("-" * 72)
+    print(f"สร้างรายงานเสร็จ {len(results) - len(failed)}/{len(results)} วัน")
+    return 1 if failed else 0
+
+
+def run_colab():
+    """ขั้นตอนเดิมบน Colab: อัพโหลดไฟล์กะ A/B แล้วดาวน์โหลดรายงาน"""
+    # เลือกได้หลายไฟล์ต่อกะ (เช่น sheet ปัจจุบัน + backup) จะรวมและตัดแถวซ้ำให้
+    print("\n[ขั้นที่ 1/2] เลือกไฟล์กะ A (report A)")
+    up_a = files.upload()
+    if not up_a:
+        raise ValueError("ไม่พบไฟล์กะ A")
+
+    print("\n[ขั้นที่ 2/2] เลือกไฟล์กะ B (report B)")
+    up_b = files.upload()
+    if not up_b:
+        raise ValueError("ไม่พบไฟล์กะ B")
+
+    output_filename = generate_report(list(up_a.items()), list(up_b.items()))
+    print("-" * 72)
+    print(f"สร้างรายงานเสร็จ: {output_filename}")
+    files.download(output_filename)
+
+
+if __name__ == '__main__':
+    if files is not None:
+        run_colab()
+    else:
+        sys.exit(main())